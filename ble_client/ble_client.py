@@ -1,14 +1,23 @@
 import asyncio
+import collections
+import functools
+import logging
 import struct
 import socketio
-import math
 import time
 from bleak import BleakClient, BleakScanner
 from bleak.exc import BleakError
 
+from fusion import ComplementaryFilter, MadgwickFilter, complementary_convention
+from logs import SampleStats, setup_logging
+from rate_control import SampleRateController
+from stream_health import StreamHealth
+from telemetry import TelemetryRecorder
+
 # BLE UUIDs from ESP32
 SERVICE_UUID = "c10299b1-b9ba-451a-ad8c-17baeecd9480"
 CHARACTERISTIC_UUID = "657b9056-09f8-4e0f-9d37-f76b6756e95e"
+TIMER_INTERVAL_WRITE_UUID = "a7b3e6c8-4d2f-11ed-b878-0242ac120002"
 
 # Flask server WebSocket endpoint
 SERVER_URL = "http://localhost:5000"
@@ -16,128 +25,209 @@ SERVER_URL = "http://localhost:5000"
 # Device name
 DEVICE_NAME = "ESP32_MPU6050_BLE"
 
+# Multi-device settings: every brick advertising DEVICE_NAME is connected (up to
+# MAX_DEVICES) and tagged with a device id - its BLE address unless mapped here,
+# e.g. {"AA:BB:CC:DD:EE:FF": "brick-1"}. Map a brick to "default" to show it on
+# the web page without a ?device_id= parameter.
+MAX_DEVICES = 8
+DEVICE_IDS = {}
+SCAN_INTERVAL = 15.0  # Seconds between scans for new bricks
+SCAN_INTERVAL_MAX = 120.0  # Scan interval backs off to this while no new brick shows up
+SCAN_TIMEOUT = 10.0  # Scan duration while no brick is connected
+SCAN_TIMEOUT_CONNECTED = 3.0  # Shorter scans while bricks are connected, to leave them the radio
+
 # Reconnection settings
 MAX_RECONNECT_ATTEMPTS = 5
 RECONNECT_DELAY_BASE = 2  # Base delay in seconds (will use exponential backoff)
 CONNECTION_TIMEOUT = 10.0  # Connection timeout in seconds
+STATUS_UPDATE_INTERVAL = 2.0  # Send BLE status of each brick every 2 seconds
+
+# WebSocket send queue: BLE notifications only enqueue messages and a background
+# task emits them, so server round-trips and reconnects never stall sensor
+# processing. When full, the oldest message is dropped.
+SEND_QUEUE_SIZE = 100
+WEBSOCKET_RECONNECT_DELAY_MIN = 1  # Seconds between WebSocket connection attempts (doubling)
+WEBSOCKET_RECONNECT_DELAY_MAX = 5
+
+# Sensor fusion: 'complementary' sends Euler angles (x, y, z), 'madgwick'
+# sends quaternions (qw, qx, qy, qz) end-to-end to the Unity viewer
+FILTER_MODE = 'complementary'
+FILTER_ALPHA = 0.98  # Complementary filter gyroscope weight
+GYRO_DEADBAND = 3.0  # Ignore gyro values below this (°/s) to reduce drift
+MADGWICK_BETA = 0.1  # Madgwick filter gain
+
+# Batched binary transport: rotation samples are packed as little-endian
+# (uint32 timestamp ms, float32 x, y, z) frames - (qw, qx, qy, qz) in
+# 'madgwick' mode - and sent N at a time in a single 'rotation_batch' event
+# instead of one JSON dict per sample
+USE_BINARY_BATCHES = True
+ROTATION_FRAME = struct.Struct('<I3f')
+QUATERNION_FRAME = struct.Struct('<I4f')
+BATCH_MAX_SAMPLES = 10  # Flush once this many samples are buffered
+BATCH_MAX_DELAY = 0.05  # Flush once the oldest buffered sample is this old (seconds)
+
+# Server-side fusion: send the raw 28-byte notifications in 'raw_batch' events
+# (batched like rotation frames) and let the server run the filter, configured
+# per device through its /api/fusion endpoint. FILTER_MODE is then unused
+SERVER_FUSION = False
+
+# Telemetry recording: when set, every raw notification is appended with its
+# arrival time to a per-device log in this directory, for replay.py
+RECORD_DIR = None
+
+# Logging: records are written by a background thread. Per-sample RAW/FILTERED
+# lines are logged at DEBUG for 1 in LOG_SAMPLE_EVERY samples; every
+# LOG_SUMMARY_INTERVAL seconds each brick logs its rate, mean dt and jitter
+LOG_LEVEL = 'INFO'
+LOG_FILE = None
+LOG_SAMPLE_EVERY = 100
+LOG_SUMMARY_INTERVAL = 10.0
+
+# Adaptive sample rate: the ESP32 timer interval follows the brick's angular
+# speed (fast while moving, slow at rest), limited by what the BLE link
+# delivers and by the server's 'server_load' feedback
+ADAPTIVE_RATE = True
+DEFAULT_SAMPLE_INTERVAL = 100  # ms, the firmware's interval after connecting
+RATE_MIN_INTERVAL = 20  # ms while moving fast
+RATE_MAX_INTERVAL = 250  # ms at rest
+RATE_STILL_SPEED = 5.0  # °/s below which the brick counts as at rest
+RATE_FAST_SPEED = 120.0  # °/s that gets the fastest rate
+RATE_RELEASE_TIME = 2.0  # Seconds of calm before the rate is lowered
+MANUAL_RATE_HOLD = 60.0  # Seconds a rate set from the UI overrides the adaptive one
+
+# Axis mapping configuration
+AXIS_MAPPING = {
+    'unity_x': ('x', False),  # Pitch (front/back tilt)
+    'unity_y': ('z', False),  # Yaw (rotation)
+    'unity_z': ('y', True),  # Roll (left/right tilt)
+}
+
+
+class BrickSession:
+    """Filter, rotation and connection state of one ESP32 brick"""
+    def __init__(self, address, name=DEVICE_NAME):
+        self.address = address
+        self.name = name
+        self.device_id = DEVICE_IDS.get(address, address)
+
+        # Filters with deadband
+        self.comp_filter = ComplementaryFilter(alpha=FILTER_ALPHA, gyro_deadband=GYRO_DEADBAND)
+        self.madgwick_filter = MadgwickFilter(beta=MADGWICK_BETA, gyro_deadband=GYRO_DEADBAND)
+
+        # Timestamp checks (loss, duplicates, reordering, dt clamping) and
+        # link quality statistics reported in ble_status
+        self.health = StreamHealth(DEFAULT_SAMPLE_INTERVAL)
+
+        # Sample rate and dt statistics for the periodic log summary
+        self.stats = SampleStats(time.time())
+
+        # Arrival time (Unix seconds) of the latest notification, sent with
+        # rotation samples for end-to-end latency measurement
+        self.last_received_at = None
+
+        # Rotation state
+        self.current_rotation = {"x": 0.0, "y": 0.0, "z": 0.0}
+        self.current_quaternion = {"qw": 1.0, "qx": 0.0, "qy": 0.0, "qz": 0.0}
+
+        # Pending rotation frames for the next batch
+        self.rotation_batch = bytearray()
+        self.rotation_batch_count = 0
+        self.rotation_batch_started = 0.0
+        self.rotation_batch_timer = None  # Flushes the batch BATCH_MAX_DELAY after its first frame
+
+        # BLE connection state
+        self.ble_connected = False
+
+        # Timer interval requested from the UI or the rate controller, written
+        # by the connection loop as soon as interval_wakeup is set
+        self.pending_interval = None
+        self.interval_wakeup = asyncio.Event()
+        self.sample_interval = DEFAULT_SAMPLE_INTERVAL  # Last interval written to the brick
+        self.rate_controller = SampleRateController(
+            min_interval=RATE_MIN_INTERVAL, max_interval=RATE_MAX_INTERVAL,
+            still_speed=RATE_STILL_SPEED, fast_speed=RATE_FAST_SPEED,
+            release_time=RATE_RELEASE_TIME, interval=DEFAULT_SAMPLE_INTERVAL)
+        self.manual_until = 0.0  # Monotonic time until which a UI-set interval holds
+
+    def request_interval(self, interval):
+        """Have the connection loop write a new timer interval to the brick"""
+        self.pending_interval = interval
+        self.interval_wakeup.set()
+
+
+logger = logging.getLogger('ble_client')
+
+# Bricks handled by this client, by device id
+sessions = {}
 
-# Rotation state
-current_rotation = {"x": 0.0, "y": 0.0, "z": 0.0}
+# Asyncio WebSocket client; reconnection is handled by websocket_keepalive()
+sio = socketio.AsyncClient(reconnection=False)
 
-# BLE connection state
-ble_connected = False
-ble_device_name = None
+# Events whose payload gets a 'sent_at' timestamp when actually emitted
+TIMESTAMPED_EVENTS = ('rotation_update', 'rotation_batch', 'raw_batch')
 
-# WebSocket client with reconnection enabled
-sio = socketio.Client(reconnection=True, reconnection_attempts=0, reconnection_delay=1, reconnection_delay_max=5)
+# Outgoing (event, payload) messages, drained by websocket_sender()
+send_queue = collections.deque(maxlen=SEND_QUEUE_SIZE)
+send_queue_dropped = 0
+send_wakeup = None  # asyncio.Event, created once the event loop runs
+websocket_tasks = []
+
+# Raw notification recorder, created when RECORD_DIR is set
+recorder = None
 
 # WebSocket event handlers
 @sio.on('connect')
 def on_connect():
     """Handle connection to WebSocket server"""
-    print("✓ Connected to WebSocket server")
-    # Re-send current BLE status when WebSocket reconnects
-    if ble_connected:
-        send_ble_status(True, ble_device_name)
-    else:
-        send_ble_status(False)
+    logger.info("✓ Connected to WebSocket server")
+    # Re-send current BLE status of every brick when WebSocket reconnects
+    for session in list(sessions.values()):
+        send_ble_status(session, session.ble_connected)
+    # Flush anything queued while disconnected
+    if send_wakeup is not None:
+        send_wakeup.set()
 
 @sio.on('disconnect')
 def on_disconnect():
     """Handle disconnection from WebSocket server"""
-    print("✗ Disconnected from WebSocket server")
+    logger.warning("✗ Disconnected from WebSocket server")
 
 @sio.on('rotation_update')
 def on_rotation_update(data):
     """Handle rotation updates from server (for bidirectional communication)"""
-    print(f"← Received rotation update from server: {data}")
+    logger.debug("← Received rotation update from server: %s", data)
 
 @sio.on('error')
 def on_error(data):
     """Handle error messages from server"""
-    print(f"✗ Server error: {data.get('message', 'Unknown error')}")
+    logger.error("✗ Server error: %s", data.get('message', 'Unknown error'))
 
 @sio.on('update_timer_interval')
 def on_timer_interval_update(data):
     """Handle timer interval update request from server"""
     interval = data.get('interval', 100)
-    print(f"← Received timer interval update request: {interval}ms")
-    # Store for writing to BLE
-    if hasattr(on_timer_interval_update, 'pending_interval'):
-        on_timer_interval_update.pending_interval = interval
+    device_id = data.get('device_id')
+    logger.info("← Received timer interval update request for %s: %sms", device_id, interval)
+    # Store for writing to BLE by the brick's connection loop
+    session = sessions.get(device_id)
+    if session is not None:
+        # Hold the manual rate for a while before adapting again
+        session.manual_until = time.monotonic() + MANUAL_RATE_HOLD
+        session.rate_controller.set_interval(interval)
+        session.request_interval(interval)
     else:
-        on_timer_interval_update.pending_interval = interval
-
-# Axis mapping configuration
-AXIS_MAPPING = {
-    'unity_x': ('x', False),  # Pitch (front/back tilt)
-    'unity_y': ('z', False),  # Yaw (rotation)
-    'unity_z': ('y', True),  # Roll (left/right tilt)
-}
+        logger.warning("✗ Unknown device: %s", device_id)
 
-class ComplementaryFilter:
-    """
-    Complementary filter with drift compensation
-    """
-    def __init__(self, alpha=0.98, gyro_deadband=2.0):
-        """
-        Args:
-            alpha: Weight for gyroscope (0.98 = standard)
-            gyro_deadband: Ignore gyro values below this (°/s) to reduce drift
-        """
-        self.alpha = alpha
-        self.gyro_deadband = gyro_deadband
-        self.angle_x = 0.0
-        self.angle_y = 0.0
-        self.angle_z = 0.0
-        self.stationary_counter = 0
-
-    def update(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=0.1):
-        """
-        Update filter with drift compensation
-        """
-        # Calculate tilt angles from accelerometer
-        acc_angle_x = math.atan2(-acc_y, math.sqrt(acc_x**2 + acc_z**2)) * 180 / math.pi # y is inverted to match Unity's coordinate system
-        acc_angle_y = math.atan2(acc_x, math.sqrt(acc_y**2 + acc_z**2)) * 180 / math.pi
-
-        # Apply deadband to gyroscope (ignore small values that cause drift)
-        gyro_x_filtered = gyro_x if abs(gyro_x) > self.gyro_deadband else 0.0
-        gyro_y_filtered = gyro_y if abs(gyro_y) > self.gyro_deadband else 0.0
-        gyro_z_filtered = gyro_z if abs(gyro_z) > self.gyro_deadband else 0.0
-
-        # Integrate gyroscope
-        gyro_angle_x = self.angle_x + gyro_x_filtered * dt
-        gyro_angle_y = self.angle_y + gyro_y_filtered * dt
-        gyro_angle_z = self.angle_z + gyro_z_filtered * dt
-
-        # Complementary filter
-        self.angle_x = self.alpha * gyro_angle_x + (1 - self.alpha) * acc_angle_x
-        self.angle_y = self.alpha * gyro_angle_y + (1 - self.alpha) * acc_angle_y
-
-        # Yaw handling with drift compensation
-        if abs(gyro_z) < self.gyro_deadband:
-            self.stationary_counter += 1
-            # If stationary for 2 seconds (20 updates at 100ms), slowly decay yaw
-            if self.stationary_counter > 20:
-                self.angle_z *= 0.98  # Decay by 2% each update
-        else:
-            self.stationary_counter = 0
-            self.angle_z = gyro_angle_z
+@sio.on('server_load')
+def on_server_load(data):
+    """Apply the server's minimum sample interval while it is loaded"""
+    min_interval = data.get('min_interval', 0)
+    for session in sessions.values():
+        if session.rate_controller.server_floor != min_interval:
+            logger.info("← Server load %.2f: minimum interval of %s %sms",
+                        data.get('load', 0), session.device_id, min_interval)
+        session.rate_controller.server_floor = min_interval
 
-        # Keep yaw in range
-        if self.angle_z > 360:
-            self.angle_z -= 360
-        elif self.angle_z < -360:
-            self.angle_z += 360
-
-        return self.angle_x, self.angle_y, self.angle_z
-
-
-# Update global filter with deadband
-comp_filter = ComplementaryFilter(alpha=0.98, gyro_deadband=3.0)
-
-# Last timestamp for dt calculation
-last_timestamp = None
 
 class SensorData:
     """Class to parse the binary sensor data from ESP32"""
@@ -153,256 +243,483 @@ class SensorData:
                 f"Gyro: X={self.gyro_x:.1f} Y={self.gyro_y:.1f} Z={self.gyro_z:.1f}")
 
 
-def send_rotation_to_api():
-    """Send current rotation to Flask server via WebSocket"""
-    try:
-        if sio.connected:
-            sio.emit('rotation_update', current_rotation)
-            print(f"→ Sent rotation: X={current_rotation['x']:.1f}° "
-                  f"Y={current_rotation['y']:.1f}° Z={current_rotation['z']:.1f}°")
-        else:
-            print("✗ WebSocket not connected, skipping rotation update")
-    except Exception as e:
-        print(f"✗ Failed to send rotation: {e}")
+def queue_emit(event, payload):
+    """Queue a message for the WebSocket sender without blocking (drops the oldest when full)"""
+    global send_queue_dropped
+
+    if len(send_queue) == send_queue.maxlen:
+        send_queue_dropped += 1
+        if send_queue_dropped % SEND_QUEUE_SIZE == 1:
+            logger.warning("⚠ WebSocket send queue full, dropped %d message(s) so far", send_queue_dropped)
+    send_queue.append((event, payload))
+    if send_wakeup is not None:
+        send_wakeup.set()
+
+
+async def emit_message(event, payload):
+    """Emit one queued message, stamping rotation payloads with the send time"""
+    if event in TIMESTAMPED_EVENTS:
+        payload['sent_at'] = time.time()
+    await sio.emit(event, payload)
+
+
+async def websocket_sender():
+    """Emit queued messages whenever the WebSocket is connected"""
+    while True:
+        await send_wakeup.wait()
+        send_wakeup.clear()
+        while send_queue and sio.connected:
+            event, payload = send_queue.popleft()
+            try:
+                await emit_message(event, payload)
+            except Exception as e:
+                logger.error("✗ Failed to send %s: %s", event, e)
+
+
+async def websocket_keepalive():
+    """Connect to the WebSocket server and reconnect in the background whenever it drops"""
+    delay = WEBSOCKET_RECONNECT_DELAY_MIN
+    while True:
+        if not sio.connected:
+            try:
+                logger.info("Connecting to WebSocket server at %s...", SERVER_URL)
+                await sio.connect(SERVER_URL)
+                delay = WEBSOCKET_RECONNECT_DELAY_MIN
+            except Exception as e:
+                logger.warning("✗ WebSocket connection failed: %s", e)
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WEBSOCKET_RECONNECT_DELAY_MAX)
+                continue
+        await asyncio.sleep(1)
 
 
-def send_ble_status(connected, device_name=None):
-    """Send BLE connection status to server via WebSocket"""
-    global ble_connected, ble_device_name
+def start_websocket():
+    """Start the WebSocket connection and sender tasks on the running event loop"""
+    global send_wakeup
+    send_wakeup = asyncio.Event()
+    websocket_tasks.append(asyncio.create_task(websocket_keepalive()))
+    websocket_tasks.append(asyncio.create_task(websocket_sender()))
 
-    # Update tracked state
-    ble_connected = connected
-    ble_device_name = device_name if device_name else DEVICE_NAME
 
-    try:
-        if sio.connected:
-            status = {
-                'connected': connected,
-                'device_name': ble_device_name
-            }
-            sio.emit('ble_status', status)
-            print(f"→ BLE Status: {'Connected' if connected else 'Disconnected'} to {ble_device_name}")
-        else:
-            print("✗ WebSocket not connected, cannot send BLE status")
-    except Exception as e:
-        print(f"✗ Failed to send BLE status: {e}")
+async def close_websocket():
+    """Send what is still queued, then stop the WebSocket tasks and disconnect"""
+    for task in websocket_tasks:
+        task.cancel()
+    websocket_tasks.clear()
+    while send_queue and sio.connected:
+        event, payload = send_queue.popleft()
+        try:
+            await emit_message(event, payload)
+        except Exception:
+            break
+    if sio.connected:
+        await sio.disconnect()
+
+
+def format_rotation(session):
+    """Current rotation of a brick as a short display string"""
+    if FILTER_MODE == 'madgwick':
+        q = session.current_quaternion
+        return (f"W={q['qw']:.3f} X={q['qx']:.3f} "
+                f"Y={q['qy']:.3f} Z={q['qz']:.3f}")
+    r = session.current_rotation
+    return f"X={r['x']:.1f}° Y={r['y']:.1f}° Z={r['z']:.1f}°"
 
 
-async def notification_handler(sender, data):
-    """Handle BLE notifications from ESP32"""
-    global last_timestamp
+def send_rotation_to_api(session, timestamp=0):
+    """Send current rotation of a brick to Flask server via WebSocket"""
+    if USE_BINARY_BATCHES:
+        queue_rotation_frame(session, timestamp)
+        return
 
+    rotation = session.current_quaternion if FILTER_MODE == 'madgwick' else session.current_rotation
+    queue_emit('rotation_update', {'device_id': session.device_id, **rotation,
+                                   'ts': timestamp, 'received_at': session.last_received_at})
+    session.stats.sent += 1
+
+
+def queue_rotation_frame(session, timestamp):
+    """Append current rotation to the brick's pending batch"""
+    if FILTER_MODE == 'madgwick':
+        q = session.current_quaternion
+        queue_batch_frame(session, QUATERNION_FRAME.pack(timestamp, q['qw'], q['qx'], q['qy'], q['qz']))
+    else:
+        r = session.current_rotation
+        queue_batch_frame(session, ROTATION_FRAME.pack(timestamp, r['x'], r['y'], r['z']))
+
+
+def queue_batch_frame(session, frame):
+    """Append a packed frame to the brick's pending batch and flush it when full or stale"""
+    if session.rotation_batch_count == 0:
+        session.rotation_batch_started = time.monotonic()
+        # Bound the latency of the batch's last frame even if no further notification arrives
+        session.rotation_batch_timer = asyncio.get_running_loop().call_later(
+            BATCH_MAX_DELAY, flush_rotation_batch, session)
+    session.rotation_batch.extend(frame)
+    session.rotation_batch_count += 1
+
+    if (session.rotation_batch_count >= BATCH_MAX_SAMPLES or
+            time.monotonic() - session.rotation_batch_started >= BATCH_MAX_DELAY):
+        flush_rotation_batch(session)
+
+
+def flush_rotation_batch(session):
+    """Send all pending frames of a brick in one binary 'rotation_batch' (or 'raw_batch') event"""
+    if session.rotation_batch_timer is not None:
+        session.rotation_batch_timer.cancel()
+        session.rotation_batch_timer = None
+    if session.rotation_batch_count == 0:
+        return
+    frames = bytes(session.rotation_batch)
+    count = session.rotation_batch_count
+    session.rotation_batch.clear()
+    session.rotation_batch_count = 0
+
+    if SERVER_FUSION:
+        queue_emit('raw_batch', {
+            'device_id': session.device_id,
+            'frames': frames,
+            'interval': session.health.interval,  # The server clamps time steps like StreamHealth
+            'received_at': session.last_received_at
+        })
+        session.stats.sent += count
+        logger.debug("→ Sent %d raw frame(s) [%s]", count, session.device_id)
+        return
+
+    queue_emit('rotation_batch', {
+        'device_id': session.device_id,
+        'frames': frames,
+        'format': 'quaternion' if FILTER_MODE == 'madgwick' else 'euler',
+        'received_at': session.last_received_at  # Arrival of the last frame's notification
+    })
+    session.stats.sent += count
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("→ Sent %d rotation sample(s) [%s]: %s", count, session.device_id, format_rotation(session))
+
+
+def send_ble_status(session, connected):
+    """Send BLE connection status of a brick to server via WebSocket"""
+    # Update tracked state; the periodic re-sends are only logged at DEBUG
+    changed = session.ble_connected != connected
+    session.ble_connected = connected
+
+    status = {
+        'device_id': session.device_id,
+        'connected': connected,
+        'device_name': session.name,
+        'sample_interval': session.sample_interval,
+        'send_queue': len(send_queue),
+        'send_queue_dropped': send_queue_dropped,
+        'link': session.health.report()
+    }
+    queue_emit('ble_status', status)
+    logger.log(logging.INFO if changed else logging.DEBUG, "→ BLE Status: %s to %s [%s]",
+               'Connected' if connected else 'Disconnected', session.name, session.device_id)
+
+
+async def notification_handler(session, sender, data):
+    """Handle BLE notifications from an ESP32 brick"""
+    session.last_received_at = time.time()
+    started = time.perf_counter()
     try:
+        if recorder is not None:
+            recorder.record(session.device_id, data)
+
         # Parse the binary data
         sensor_data = SensorData(data)
 
-        # Calculate dt from timestamp
-        if last_timestamp is None:
-            dt = 0.1  # Default for first reading
+        # Calculate dt from timestamp; duplicated and late packets are dropped
+        timestep = session.health.timestep(sensor_data.timestamp, time.monotonic())
+        if timestep is None:
+            return
+        measured_dt, dt = timestep
+
+        # Log raw sensor data and dt for 1 in LOG_SAMPLE_EVERY samples only
+        session.stats.add(measured_dt)
+        log_sample = session.stats.samples % LOG_SAMPLE_EVERY == 0 and logger.isEnabledFor(logging.DEBUG)
+        if log_sample:
+            logger.debug("RAW [%s]: %s | dt=%.1fms", session.device_id, sensor_data, measured_dt * 1000)
+
+        if ADAPTIVE_RATE and time.monotonic() >= session.manual_until:
+            interval = session.rate_controller.update(sensor_data.gyro_x, sensor_data.gyro_y,
+                                                      sensor_data.gyro_z, time.monotonic())
+            if interval is not None:
+                session.request_interval(interval)
+
+        if SERVER_FUSION:
+            # Raw notifications are fused by the server
+            queue_batch_frame(session, data)
+            session.health.processed(time.perf_counter() - started)
+            return
+
+        if FILTER_MODE == 'madgwick':
+            # Apply Madgwick filter (returns orientation quaternion)
+            qw, qx, qy, qz = complementary_convention(session.madgwick_filter.update(
+                sensor_data.acc_x,
+                sensor_data.acc_y,
+                sensor_data.acc_z,
+                sensor_data.gyro_x,
+                sensor_data.gyro_y,
+                sensor_data.gyro_z,
+                dt=dt
+            ))
+
+            # Apply axis mapping to the quaternion's vector part (now signed like the Euler angles)
+            sensor_vector = {'x': qx, 'y': qy, 'z': qz}
+            session.current_quaternion['qw'] = qw
+            for unity_axis, (sensor_axis, invert) in AXIS_MAPPING.items():
+                value = sensor_vector[sensor_axis]
+                if invert:
+                    value = -value
+                session.current_quaternion['q' + unity_axis.split('_')[1]] = value
         else:
-            dt = (sensor_data.timestamp - last_timestamp) / 1000.0  # Convert ms to seconds
-        last_timestamp = sensor_data.timestamp
-
-        # Print raw sensor data and dt
-        print(f"RAW: {sensor_data} | dt={dt*1000:.1f}ms")
-
-        # Apply complementary filter (returns filtered angles directly)
-        angle_x, angle_y, angle_z = comp_filter.update(
-            sensor_data.acc_x,
-            sensor_data.acc_y,
-            sensor_data.acc_z,
-            sensor_data.gyro_x,
-            sensor_data.gyro_y,
-            sensor_data.gyro_z,
-            dt=dt
-        )
-
-        # Store angles for axis mapping
-        filtered_angles = {
-            'x': angle_x,  # Roll
-            'y': angle_y,  # Pitch
-            'z': angle_z   # Yaw
-        }
-
-        # Apply axis mapping to Unity coordinate system
-        for unity_axis, (sensor_axis, invert) in AXIS_MAPPING.items():
-            value = filtered_angles.get(sensor_axis, 0)
-            if invert:
-                value = -value
-            current_rotation[unity_axis.split('_')[1]] = value
-
-        # Print filtered rotation
-        print(f"FILTERED: X={current_rotation['x']:.1f}° "
-              f"Y={current_rotation['y']:.1f}° Z={current_rotation['z']:.1f}°")
+            # Apply complementary filter (returns filtered angles directly)
+            angle_x, angle_y, angle_z = session.comp_filter.update(
+                sensor_data.acc_x,
+                sensor_data.acc_y,
+                sensor_data.acc_z,
+                sensor_data.gyro_x,
+                sensor_data.gyro_y,
+                sensor_data.gyro_z,
+                dt=dt
+            )
+
+            # Store angles for axis mapping
+            filtered_angles = {
+                'x': angle_x,  # Roll
+                'y': angle_y,  # Pitch
+                'z': angle_z   # Yaw
+            }
+
+            # Apply axis mapping to Unity coordinate system
+            for unity_axis, (sensor_axis, invert) in AXIS_MAPPING.items():
+                value = filtered_angles.get(sensor_axis, 0)
+                if invert:
+                    value = -value
+                session.current_rotation[unity_axis.split('_')[1]] = value
+
+        if log_sample:
+            logger.debug("FILTERED [%s]: %s", session.device_id, format_rotation(session))
 
         # Send to Flask API
-        send_rotation_to_api()
+        send_rotation_to_api(session, sensor_data.timestamp)
+        session.health.processed(time.perf_counter() - started)
 
     except Exception as e:
-        print(f"Error processing notification: {e}")
+        logger.error("Error processing notification from %s: %s", session.device_id, e)
+
 
+async def find_devices(timeout=SCAN_TIMEOUT, connected=0):
+    """
+    Scan for all advertising ESP32 bricks, returning their BLE addresses
 
-async def find_device():
-    """Scan for and find the ESP32 device"""
-    print(f"Scanning for '{DEVICE_NAME}'...")
+    Args:
+        connected: Bricks already connected; their periodic rescans finding
+            nothing new are the normal case and only logged at DEBUG level
+    """
+    level = logging.DEBUG if connected else logging.INFO
+    logger.log(level, "Scanning for '%s' devices...", DEVICE_NAME)
 
-    devices = await BleakScanner.discover(timeout=10.0)
+    devices = await BleakScanner.discover(timeout=timeout)
 
+    addresses = []
     for device in devices:
         if device.name == DEVICE_NAME:
-            print(f"Found {DEVICE_NAME} at {device.address}")
-            return device.address
+            logger.info("Found %s at %s", DEVICE_NAME, device.address)
+            addresses.append(device.address)
 
-    print(f"✗ Could not find {DEVICE_NAME}")
-    return None
+    if not addresses:
+        if connected:
+            logger.debug("No new %s found (%d connected)", DEVICE_NAME, connected)
+        else:
+            logger.warning("✗ Could not find %s", DEVICE_NAME)
+    return addresses
 
 
-async def connect_and_listen():
-    """Main function to connect to ESP32 and listen for data with reconnection support"""
+async def listen_to_device(session):
+    """Connect to one brick and listen for data with reconnection support"""
     reconnect_count = 0
 
-    # Connect to WebSocket server first
-    try:
-        print(f"Connecting to WebSocket server at {SERVER_URL}...")
-        sio.connect(SERVER_URL)
-        # Send initial BLE status (disconnected) upon WebSocket connection
-        send_ble_status(False)
-    except Exception as e:
-        print(f"✗ Failed to connect to WebSocket server: {e}")
-        print("Continuing anyway, will attempt to connect later...")
-
     while reconnect_count < MAX_RECONNECT_ATTEMPTS:
         try:
-            # Find the device
-            address = await find_device()
-            if address is None:
-                reconnect_count += 1
-                if reconnect_count < MAX_RECONNECT_ATTEMPTS:
-                    delay = RECONNECT_DELAY_BASE * (2 ** reconnect_count)
-                    print(f"Retrying in {delay} seconds... (Attempt {reconnect_count + 1}/{MAX_RECONNECT_ATTEMPTS})")
-                    await asyncio.sleep(delay)
-                continue
-
-            # Reset reconnect counter on successful device discovery
-            reconnect_count = 0
-
             # Connect to the device with timeout
-            print(f"Connecting to {address}...")
+            logger.info("Connecting to %s...", session.address)
 
-            async with BleakClient(address, timeout=CONNECTION_TIMEOUT) as client:
-                print(f"Connected to {DEVICE_NAME}")
+            async with BleakClient(session.address, timeout=CONNECTION_TIMEOUT) as client:
+                logger.info("Connected to %s [%s]", session.name, session.device_id)
+                reconnect_count = 0
 
                 # Send BLE connected status
-                send_ble_status(True, DEVICE_NAME)
+                send_ble_status(session, True)
 
-                # Find writable characteristic for timer interval
-                TIMER_INTERVAL_WRITE_UUID = "a7b3e6c8-4d2f-11ed-b878-0242ac120002"
+                # New stream: the gap since the last connection is not packet loss
+                session.health.restart()
+                session.health.set_interval(DEFAULT_SAMPLE_INTERVAL)
 
                 # Enable notifications
-                await client.start_notify(CHARACTERISTIC_UUID, notification_handler)
-                print("Listening for sensor data...")
-                print("=" * 80)
+                await client.start_notify(CHARACTERISTIC_UUID,
+                                          functools.partial(notification_handler, session))
+                logger.info("Listening for sensor data from %s...", session.device_id)
+
+                # The brick starts at its default interval; restore the adapted one
+                session.sample_interval = DEFAULT_SAMPLE_INTERVAL
+                if session.pending_interval is None and session.rate_controller.interval != DEFAULT_SAMPLE_INTERVAL:
+                    session.request_interval(session.rate_controller.interval)
 
                 # Track last status update time
                 last_status_update = time.time()
-                STATUS_UPDATE_INTERVAL = 2.0  # Send status every 2 seconds
 
                 # Keep the connection alive
                 try:
                     while True:
                         # Check if still connected
                         if not client.is_connected:
-                            print("\n⚠ Connection lost! Attempting to reconnect...")
-                            send_ble_status(False)
+                            logger.warning("⚠ Connection to %s lost! Attempting to reconnect...", session.device_id)
+                            send_ble_status(session, False)
                             break
 
-                        # Check WebSocket connection and reconnect if needed
-                        if not sio.connected:
-                            print("\n⚠ WebSocket disconnected! Attempting to reconnect...")
-                            try:
-                                sio.connect(SERVER_URL)
-                                # Re-send BLE status after reconnection
-                                if ble_connected:
-                                    send_ble_status(True, ble_device_name)
-                            except Exception as ws_error:
-                                print(f"✗ WebSocket reconnection failed: {ws_error}")
-
                         # Periodically send BLE status (every 2 seconds)
                         current_time = time.time()
                         if current_time - last_status_update >= STATUS_UPDATE_INTERVAL:
-                            send_ble_status(True, DEVICE_NAME)
+                            send_ble_status(session, True)
                             last_status_update = current_time
 
+                        # Periodic rate / dt summary instead of per-sample lines
+                        if current_time - session.stats.started >= LOG_SUMMARY_INTERVAL:
+                            logger.info("[%s] %s", session.device_id, session.stats.summary(current_time))
+
                         # Check for pending timer interval update
-                        if hasattr(on_timer_interval_update, 'pending_interval'):
-                            interval = on_timer_interval_update.pending_interval
-                            delattr(on_timer_interval_update, 'pending_interval')
+                        session.interval_wakeup.clear()
+                        if session.pending_interval is not None:
+                            interval = session.pending_interval
+                            session.pending_interval = None
                             try:
                                 # Write interval as 4-byte unsigned integer (little-endian)
                                 interval_bytes = struct.pack('<I', interval)
                                 await client.write_gatt_char(TIMER_INTERVAL_WRITE_UUID, interval_bytes)
-                                print(f"✓ Updated timer interval to {interval}ms")
+                                session.sample_interval = interval
+                                session.health.set_interval(interval)
+                                logger.info("✓ Updated timer interval of %s to %sms", session.device_id, interval)
                             except Exception as e:
-                                print(f"✗ Failed to write timer interval: {e}")
+                                logger.error("✗ Failed to write timer interval to %s: %s", session.device_id, e)
 
-                        await asyncio.sleep(1)
-                except KeyboardInterrupt:
-                    print("\nStopping...")
-                    await client.stop_notify(CHARACTERISTIC_UUID)
-                    print("Disconnected")
-                    # Send BLE disconnected status
-                    send_ble_status(False)
-                    # Disconnect from WebSocket
-                    if sio.connected:
-                        sio.disconnect()
-                    return  # Exit completely on user interrupt
+                        # Wake up early when a new interval is requested
+                        try:
+                            await asyncio.wait_for(session.interval_wakeup.wait(), 1)
+                        except asyncio.TimeoutError:
+                            pass
                 finally:
+                    flush_rotation_batch(session)
                     if client.is_connected:
                         await client.stop_notify(CHARACTERISTIC_UUID)
                     # Send BLE disconnected status
-                    send_ble_status(False)
+                    send_ble_status(session, False)
 
         except asyncio.TimeoutError:
             reconnect_count += 1
-            print(f"\n✗ Connection timeout!")
-            send_ble_status(False)
-            if reconnect_count < MAX_RECONNECT_ATTEMPTS:
-                delay = RECONNECT_DELAY_BASE * (2 ** reconnect_count)
-                print(f"Retrying in {delay} seconds... (Attempt {reconnect_count + 1}/{MAX_RECONNECT_ATTEMPTS})")
-                await asyncio.sleep(delay)
+            logger.error("✗ Connection timeout (%s)!", session.device_id)
+            send_ble_status(session, False)
 
         except BleakError as e:
             reconnect_count += 1
-            print(f"\n✗ BLE Error: {e}")
-            send_ble_status(False)
-            if reconnect_count < MAX_RECONNECT_ATTEMPTS:
-                delay = RECONNECT_DELAY_BASE * (2 ** reconnect_count)
-                print(f"Retrying in {delay} seconds... (Attempt {reconnect_count + 1}/{MAX_RECONNECT_ATTEMPTS})")
-                await asyncio.sleep(delay)
+            logger.error("✗ BLE Error (%s): %s", session.device_id, e)
+            send_ble_status(session, False)
 
         except Exception as e:
             reconnect_count += 1
-            print(f"\n✗ Unexpected error: {e}")
-            if reconnect_count < MAX_RECONNECT_ATTEMPTS:
-                delay = RECONNECT_DELAY_BASE * (2 ** reconnect_count)
-                print(f"Retrying in {delay} seconds... (Attempt {reconnect_count + 1}/{MAX_RECONNECT_ATTEMPTS})")
-                await asyncio.sleep(delay)
+            logger.exception("✗ Unexpected error (%s): %s", session.device_id, e)
 
-    print(f"\n✗ Failed to connect after {MAX_RECONNECT_ATTEMPTS} attempts. Exiting.")
+        if 0 < reconnect_count < MAX_RECONNECT_ATTEMPTS:
+            delay = RECONNECT_DELAY_BASE * (2 ** reconnect_count)
+            logger.info("Retrying %s in %d seconds... (Attempt %d/%d)",
+                        session.device_id, delay, reconnect_count + 1, MAX_RECONNECT_ATTEMPTS)
+            await asyncio.sleep(delay)
+
+    logger.error("✗ Giving up on %s after %d attempts (will reconnect if it is found again)",
+                 session.device_id, MAX_RECONNECT_ATTEMPTS)
 
-    # Disconnect from WebSocket on exit
-    if sio.connected:
-        sio.disconnect()
+
+async def connect_and_listen():
+    """Main function: discover bricks and keep a connection to each of them"""
+    global recorder
+    failed_scans = 0
+    device_tasks = {}
+    scan_interval = SCAN_INTERVAL
+
+    if RECORD_DIR:
+        recorder = TelemetryRecorder(RECORD_DIR)
+        logger.info("Recording raw notifications to %s", RECORD_DIR)
+
+    # Connect to WebSocket server in the background; BLE status of each brick
+    # is sent by on_connect
+    start_websocket()
+
+    try:
+        while True:
+            # Forget bricks whose connection task has given up; scan for them again soon
+            for address, task in list(device_tasks.items()):
+                if task.done():
+                    del device_tasks[address]
+                    scan_interval = SCAN_INTERVAL
+
+            # Find new bricks (connected bricks stop advertising). Scanning
+            # slows down live connections on many adapters: skip it once every
+            # brick listed in DEVICE_IDS is connected, keep it short otherwise
+            addresses = []
+            expected_connected = DEVICE_IDS and all(address in device_tasks for address in DEVICE_IDS)
+            if len(device_tasks) < MAX_DEVICES and not expected_connected:
+                timeout = SCAN_TIMEOUT_CONNECTED if device_tasks else SCAN_TIMEOUT
+                addresses = [address for address in await find_devices(timeout, len(device_tasks))
+                             if address not in device_tasks]
+
+            for address in addresses[:MAX_DEVICES - len(device_tasks)]:
+                session = sessions.get(DEVICE_IDS.get(address, address)) or BrickSession(address)
+                sessions[session.device_id] = session
+                device_tasks[address] = asyncio.create_task(listen_to_device(session))
+
+            # Exit when no brick shows up at all
+            if device_tasks:
+                failed_scans = 0
+                # Back off while the set of bricks is stable; wake up when one is given up
+                scan_interval = SCAN_INTERVAL if addresses else min(scan_interval * 2, SCAN_INTERVAL_MAX)
+                await asyncio.wait(list(device_tasks.values()), timeout=scan_interval,
+                                   return_when=asyncio.FIRST_COMPLETED)
+                continue
+
+            failed_scans += 1
+            if failed_scans >= MAX_RECONNECT_ATTEMPTS:
+                logger.error("✗ Failed to find any device after %d attempts. Exiting.", MAX_RECONNECT_ATTEMPTS)
+                break
+            delay = RECONNECT_DELAY_BASE * (2 ** failed_scans)
+            logger.info("Retrying in %d seconds... (Attempt %d/%d)", delay, failed_scans + 1, MAX_RECONNECT_ATTEMPTS)
+            await asyncio.sleep(delay)
+
+    finally:
+        logger.info("Stopping...")
+        for task in device_tasks.values():
+            task.cancel()
+        await asyncio.gather(*device_tasks.values(), return_exceptions=True)
+        logger.info("Disconnected")
+
+        # Disconnect from WebSocket on exit
+        await close_websocket()
+
+        if recorder is not None:
+            recorder.close()
 
 
 def main():
     """Entry point"""
+    setup_logging(LOG_LEVEL, LOG_FILE)
     print("=" * 80)
     print("ESP32 BLE to LEGO Brick Rotator with WebSocket")
     print("=" * 80)
-    print(f"Looking for device: {DEVICE_NAME}")
+    print(f"Looking for devices: {DEVICE_NAME} (up to {MAX_DEVICES})")
     print(f"WebSocket server: {SERVER_URL}")
-    print(f"Filter alpha: {comp_filter.alpha} (98% gyro, 2% accel)")
+    if FILTER_MODE == 'madgwick':
+        print(f"Filter: Madgwick (beta={MADGWICK_BETA})")
+    else:
+        print(f"Filter alpha: {FILTER_ALPHA} ({FILTER_ALPHA:.0%} gyro, {1 - FILTER_ALPHA:.0%} accel)")
     print(f"Max reconnection attempts: {MAX_RECONNECT_ATTEMPTS}")
     print(f"Connection timeout: {CONNECTION_TIMEOUT}s")
     print("=" * 80)
@@ -411,13 +728,9 @@ def main():
     try:
         asyncio.run(connect_and_listen())
     except KeyboardInterrupt:
-        print("\nProgram terminated by user")
-        if sio.connected:
-            sio.disconnect()
+        logger.info("Program terminated by user")
     except Exception as e:
-        print(f"\n✗ Fatal error: {e}")
-        if sio.connected:
-            sio.disconnect()
+        logger.exception("✗ Fatal error: %s", e)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,327 @@
+"""Sensor fusion filters turning MPU6050 accelerometer/gyroscope samples into rotation angles."""
+import math
+
+import numpy as np
+
+
+class ComplementaryFilter:
+    """
+    Complementary filter with drift compensation
+    """
+    STATIONARY_UPDATES = 20  # Updates with low yaw rate before yaw starts decaying
+    YAW_DECAY = 0.98  # Yaw multiplier per update once stationary
+
+    def __init__(self, alpha=0.98, gyro_deadband=2.0):
+        """
+        Args:
+            alpha: Weight for gyroscope (0.98 = standard)
+            gyro_deadband: Ignore gyro values below this (°/s) to reduce drift
+        """
+        self.alpha = alpha
+        self.gyro_deadband = gyro_deadband
+        self.angle_x = 0.0
+        self.angle_y = 0.0
+        self.angle_z = 0.0
+        self.stationary_counter = 0
+
+    def update(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=0.1):
+        """
+        Update filter with drift compensation
+        """
+        # Calculate tilt angles from accelerometer
+        acc_angle_x = math.atan2(-acc_y, math.sqrt(acc_x**2 + acc_z**2)) * 180 / math.pi # y is inverted to match Unity's coordinate system
+        acc_angle_y = math.atan2(acc_x, math.sqrt(acc_y**2 + acc_z**2)) * 180 / math.pi
+
+        # Apply deadband to gyroscope (ignore small values that cause drift)
+        gyro_x_filtered = gyro_x if abs(gyro_x) > self.gyro_deadband else 0.0
+        gyro_y_filtered = gyro_y if abs(gyro_y) > self.gyro_deadband else 0.0
+        gyro_z_filtered = gyro_z if abs(gyro_z) > self.gyro_deadband else 0.0
+
+        # Integrate gyroscope
+        gyro_angle_x = self.angle_x + gyro_x_filtered * dt
+        gyro_angle_y = self.angle_y + gyro_y_filtered * dt
+        gyro_angle_z = self.angle_z + gyro_z_filtered * dt
+
+        # Complementary filter
+        self.angle_x = self.alpha * gyro_angle_x + (1 - self.alpha) * acc_angle_x
+        self.angle_y = self.alpha * gyro_angle_y + (1 - self.alpha) * acc_angle_y
+
+        # Yaw handling with drift compensation
+        if abs(gyro_z) < self.gyro_deadband:
+            self.stationary_counter += 1
+            # If stationary for 2 seconds (20 updates at 100ms), slowly decay yaw
+            if self.stationary_counter > self.STATIONARY_UPDATES:
+                self.angle_z *= self.YAW_DECAY  # Decay by 2% each update
+        else:
+            self.stationary_counter = 0
+            self.angle_z = gyro_angle_z
+
+        # Keep yaw in range
+        if self.angle_z > 360:
+            self.angle_z -= 360
+        elif self.angle_z < -360:
+            self.angle_z += 360
+
+        return self.angle_x, self.angle_y, self.angle_z
+
+
+# NumPy layout of one SensorData notification (matches struct format '<I6f'),
+# so raw 28-byte BLE payloads can be viewed with np.frombuffer(data, SENSOR_DTYPE)
+SENSOR_DTYPE = np.dtype([
+    ('timestamp', '<u4'),
+    ('acc_x', '<f4'), ('acc_y', '<f4'), ('acc_z', '<f4'),
+    ('gyro_x', '<f4'), ('gyro_y', '<f4'), ('gyro_z', '<f4'),
+])
+
+# Samples per block when solving the filter recurrences in closed form. Blocks
+# are shortened so the running product of the coefficients stays above
+# RECURRENCE_MIN_PRODUCT (1 / product must stay well inside float64 range);
+# coefficients too small for blocks of two are solved sample by sample
+RECURRENCE_BLOCK = 128
+RECURRENCE_MIN_PRODUCT = 1e-200
+
+# Yaw is wrapped back by 360° once it leaves this range (as in ComplementaryFilter)
+YAW_LIMIT = 360.0
+
+
+def _linear_recurrence(c, u, y0):
+    """
+    Solve y[n] = c[n] * y[n-1] + u[n] along axis 0 for arrays shaped (T, D)
+    """
+    out = np.empty_like(u)
+    smallest = c.min() if c.size else 1.0
+    if smallest >= 1:
+        block_size = RECURRENCE_BLOCK
+    elif smallest > 0:
+        block_size = min(RECURRENCE_BLOCK, int(math.log(RECURRENCE_MIN_PRODUCT) / math.log(smallest)))
+    else:
+        block_size = 0
+    if block_size < 2:
+        for n in range(len(u)):
+            y0 = c[n] * y0 + u[n]
+            out[n] = y0
+        return out
+
+    for start in range(0, len(u), block_size):
+        block = slice(start, start + block_size)
+        p = np.cumprod(c[block], axis=0)
+        out[block] = p * (y0 + np.cumsum(u[block] / p, axis=0))
+        y0 = out[block][-1]
+    return out
+
+
+class FusionEngine:
+    """
+    Vectorized ComplementaryFilter for many samples and many devices at once
+
+    Produces the same angles as feeding the samples one by one through
+    ComplementaryFilter.update (up to floating-point rounding), including the
+    gyro deadband, stationary yaw decay and yaw wrapping.
+    """
+    def __init__(self, num_devices=1, alpha=0.98, gyro_deadband=2.0):
+        """
+        Args:
+            num_devices: Number of independent sensors fused side by side
+            alpha: Weight for gyroscope (0.98 = standard)
+            gyro_deadband: Ignore gyro values below this (°/s) to reduce drift
+        """
+        self.num_devices = num_devices
+        self.alpha = alpha
+        self.gyro_deadband = gyro_deadband
+        self.angles = np.zeros((num_devices, 3))  # x, y, z per device
+        self.stationary_counter = np.zeros(num_devices, dtype=np.int64)
+        self.last_timestamp = np.full(num_devices, -1, dtype=np.int64)
+
+    def process(self, samples, dt=None):
+        """
+        Fuse a block of samples
+
+        Args:
+            samples: SENSOR_DTYPE array shaped (T,) for a single device or
+                (T, num_devices) for many devices sampled together
+            dt: Optional time steps in seconds (scalar or shaped like samples);
+                derived from the ESP32 timestamps when omitted
+        Returns:
+            float64 array of (x, y, z) angles shaped samples.shape + (3,)
+        """
+        single = samples.ndim == 1
+        if single:
+            samples = samples[:, None]
+        if samples.shape[1] != self.num_devices:
+            raise ValueError(f'Expected {self.num_devices} device column(s), got {samples.shape[1]}')
+        if len(samples) == 0:
+            return np.empty((0, 3) if single else (0, self.num_devices, 3))
+
+        acc_x = samples['acc_x'].astype(np.float64)
+        acc_y = samples['acc_y'].astype(np.float64)
+        acc_z = samples['acc_z'].astype(np.float64)
+        gyro = np.stack([samples['gyro_x'], samples['gyro_y'], samples['gyro_z']], axis=-1).astype(np.float64)
+
+        if dt is None:
+            dt = self._timestamps_to_dt(samples['timestamp'])
+        else:
+            dt = np.asarray(dt, dtype=np.float64)
+            if single and dt.ndim == 1:
+                dt = dt[:, None]
+            dt = np.broadcast_to(dt, samples.shape)
+
+        # Tilt angles from accelerometer (y is inverted to match Unity's coordinate system)
+        acc_angle_x = np.degrees(np.arctan2(-acc_y, np.sqrt(acc_x ** 2 + acc_z ** 2)))
+        acc_angle_y = np.degrees(np.arctan2(acc_x, np.sqrt(acc_y ** 2 + acc_z ** 2)))
+
+        # Deadband on gyroscope
+        gyro_filtered = np.where(np.abs(gyro) > self.gyro_deadband, gyro, 0.0)
+
+        # Pitch / roll: x[n] = alpha * (x[n-1] + gyro * dt) + (1 - alpha) * acc_angle
+        alpha = np.full(samples.shape, self.alpha)
+        angle_x = _linear_recurrence(
+            alpha, self.alpha * gyro_filtered[..., 0] * dt + (1 - self.alpha) * acc_angle_x,
+            self.angles[:, 0])
+        angle_y = _linear_recurrence(
+            alpha, self.alpha * gyro_filtered[..., 1] * dt + (1 - self.alpha) * acc_angle_y,
+            self.angles[:, 1])
+
+        angle_z = self._process_yaw(gyro[..., 2], gyro_filtered[..., 2], dt)
+
+        self.angles[:, 0] = angle_x[-1]
+        self.angles[:, 1] = angle_y[-1]
+        self.angles[:, 2] = angle_z[-1]
+
+        result = np.stack([angle_x, angle_y, angle_z], axis=-1)
+        return result[:, 0] if single else result
+
+    def update(self, samples, dt=None):
+        """
+        Fuse one sample per device (samples shaped (num_devices,)), like
+        ComplementaryFilter.update for all devices at once
+        """
+        return self.process(samples[None, :], None if dt is None else np.asarray(dt)[None, ...])[0]
+
+    def _timestamps_to_dt(self, timestamps):
+        """Time steps in seconds from ESP32 millisecond timestamps (0.1 s for a first sample)"""
+        timestamps = timestamps.astype(np.int64)
+        previous = np.vstack([self.last_timestamp[None, :], timestamps[:-1]])
+        self.last_timestamp = timestamps[-1].copy()
+        return np.where(previous < 0, 0.1, (timestamps - previous) / 1000.0)
+
+    def _process_yaw(self, gyro_z, gyro_z_filtered, dt):
+        """Yaw integration with stationary decay and wrapping"""
+        count = len(gyro_z)
+        stationary = np.abs(gyro_z) < self.gyro_deadband
+
+        # Stationary counter: run length of stationary samples, continuing the
+        # run carried over from the previous block
+        index = np.arange(count)[:, None]
+        last_moving = np.maximum.accumulate(np.where(stationary, -1, index), axis=0)
+        counter = np.where(last_moving >= 0, index - last_moving,
+                           self.stationary_counter + index + 1)
+        self.stationary_counter = counter[-1].copy()
+
+        # z[n] = decay * z[n-1] + step: integrate while moving, hold while
+        # briefly stationary, decay once stationary for long enough
+        decay = np.where(stationary & (counter > ComplementaryFilter.STATIONARY_UPDATES),
+                         ComplementaryFilter.YAW_DECAY, 1.0)
+        step = np.where(stationary, 0.0, gyro_z_filtered * dt)
+
+        # Solved block by block, so a wrap only recomputes the rest of its block
+        angle_z = np.empty_like(step)
+        start, z0 = 0, self.angles[:, 2].copy()
+        while start < count:
+            stop = min(count, start + RECURRENCE_BLOCK)
+            block = _linear_recurrence(decay[start:stop], step[start:stop], z0)
+            wrapped = np.flatnonzero(np.any(np.abs(block) > YAW_LIMIT, axis=1))
+            if not len(wrapped):
+                angle_z[start:stop] = block
+                z0 = block[-1]
+                start = stop
+                continue
+
+            # Wrap at the first sample leaving the range and resume from there
+            row = wrapped[0]
+            angle_z[start:start + row + 1] = block[:row + 1]
+            z = angle_z[start + row]
+            z[z > YAW_LIMIT] -= 360
+            z[z < -YAW_LIMIT] += 360
+            z0 = z.copy()
+            start += row + 1
+
+        return angle_z
+
+
+def complementary_convention(q):
+    """
+    Madgwick quaternion (w, x, y, z) in ComplementaryFilter's sign convention
+
+    ComplementaryFilter measures tilts from the accelerometer with the opposite
+    sign (so they match Unity), while its yaw integrates the gyro like the
+    Madgwick filter. A half turn about z flips the x and y rotations and keeps
+    yaw, so AXIS_MAPPING applies to the result's vector part as to the Euler angles.
+    """
+    w, x, y, z = q
+    return w, -x, -y, z
+
+
+class MadgwickFilter:
+    """
+    Madgwick IMU filter (accelerometer + gyroscope) working directly on a
+    quaternion, so there is no Euler integration or gimbal lock
+    """
+    def __init__(self, beta=0.1, gyro_deadband=2.0):
+        """
+        Args:
+            beta: Gradient-descent gain; higher trusts the accelerometer more
+            gyro_deadband: Ignore gyro values below this (°/s) to reduce drift
+        """
+        self.beta = beta
+        self.gyro_deadband = gyro_deadband
+        self.q = (1.0, 0.0, 0.0, 0.0)  # w, x, y, z
+
+    def update(self, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=0.1):
+        """
+        Update the orientation with one sample (gyro in °/s) and return the
+        quaternion as (w, x, y, z)
+        """
+        q0, q1, q2, q3 = self.q
+
+        # Deadband, then degrees/s to radians/s
+        gx = math.radians(gyro_x) if abs(gyro_x) > self.gyro_deadband else 0.0
+        gy = math.radians(gyro_y) if abs(gyro_y) > self.gyro_deadband else 0.0
+        gz = math.radians(gyro_z) if abs(gyro_z) > self.gyro_deadband else 0.0
+
+        # Rate of change of quaternion from gyroscope
+        q_dot0 = 0.5 * (-q1 * gx - q2 * gy - q3 * gz)
+        q_dot1 = 0.5 * (q0 * gx + q2 * gz - q3 * gy)
+        q_dot2 = 0.5 * (q0 * gy - q1 * gz + q3 * gx)
+        q_dot3 = 0.5 * (q0 * gz + q1 * gy - q2 * gx)
+
+        # Accelerometer correction (skipped in free fall)
+        norm = math.sqrt(acc_x * acc_x + acc_y * acc_y + acc_z * acc_z)
+        if norm > 0.0:
+            ax, ay, az = acc_x / norm, acc_y / norm, acc_z / norm
+
+            _2q0, _2q1, _2q2, _2q3 = 2.0 * q0, 2.0 * q1, 2.0 * q2, 2.0 * q3
+            _4q0, _4q1, _4q2 = 4.0 * q0, 4.0 * q1, 4.0 * q2
+            _8q1, _8q2 = 8.0 * q1, 8.0 * q2
+            q0q0, q1q1, q2q2, q3q3 = q0 * q0, q1 * q1, q2 * q2, q3 * q3
+
+            # Gradient of the objective function
+            s0 = _4q0 * q2q2 + _2q2 * ax + _4q0 * q1q1 - _2q1 * ay
+            s1 = _4q1 * q3q3 - _2q3 * ax + 4.0 * q0q0 * q1 - _2q0 * ay - _4q1 + _8q1 * q1q1 + _8q1 * q2q2 + _4q1 * az
+            s2 = 4.0 * q0q0 * q2 + _2q0 * ax + _4q2 * q3q3 - _2q3 * ay - _4q2 + _8q2 * q1q1 + _8q2 * q2q2 + _4q2 * az
+            s3 = 4.0 * q1q1 * q3 - _2q1 * ax + 4.0 * q2q2 * q3 - _2q2 * ay
+            s_norm = math.sqrt(s0 * s0 + s1 * s1 + s2 * s2 + s3 * s3)
+            if s_norm > 0.0:
+                q_dot0 -= self.beta * s0 / s_norm
+                q_dot1 -= self.beta * s1 / s_norm
+                q_dot2 -= self.beta * s2 / s_norm
+                q_dot3 -= self.beta * s3 / s_norm
+
+        # Integrate and normalise
+        q0 += q_dot0 * dt
+        q1 += q_dot1 * dt
+        q2 += q_dot2 * dt
+        q3 += q_dot3 * dt
+        norm = math.sqrt(q0 * q0 + q1 * q1 + q2 * q2 + q3 * q3)
+        self.q = (q0 / norm, q1 / norm, q2 / norm, q3 / norm)
+
+        return self.q
@@ -0,0 +1,79 @@
+"""Logging for the BLE client.
+
+Log records go through a queue to a background thread that formats and
+writes them, so BLE notification handling never waits for console or file
+I/O. Per-sample details are logged at DEBUG for 1 in LOG_SAMPLE_EVERY
+samples only; SampleStats aggregates every sample into periodic INFO
+summaries (rate, mean dt, jitter) instead.
+"""
+import atexit
+import logging
+import logging.handlers
+import math
+import queue
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(message)s'
+
+
+def setup_logging(level='INFO', log_file=None):
+    """
+    Send all log records through a queue to a console (and optional file) writer thread
+
+    Args:
+        level: Root log level name or number
+        log_file: Optional file to append records to as well
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flushes records still queued at exit
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
+
+
+class SampleStats:
+    """Sample count and dt statistics of one device, reset by every summary"""
+    def __init__(self, now):
+        self.reset(now)
+
+    def reset(self, now):
+        self.started = now
+        self.samples = 0
+        self.sent = 0  # Samples handed to the WebSocket send queue
+        self.dt_sum = 0.0
+        self.dt_sq_sum = 0.0
+        self.dt_min = math.inf
+        self.dt_max = 0.0
+
+    def add(self, dt):
+        """Count one sample and its time step (seconds)"""
+        self.samples += 1
+        self.dt_sum += dt
+        self.dt_sq_sum += dt * dt
+        if dt < self.dt_min:
+            self.dt_min = dt
+        if dt > self.dt_max:
+            self.dt_max = dt
+
+    def summary(self, now):
+        """One-line summary of the samples since the last summary, and reset"""
+        elapsed = max(now - self.started, 1e-9)
+        if self.samples:
+            mean = self.dt_sum / self.samples
+            jitter = math.sqrt(max(0.0, self.dt_sq_sum / self.samples - mean * mean))
+            text = (f"{self.samples / elapsed:.1f} samples/s, {self.sent / elapsed:.1f} sent/s, "
+                    f"dt mean {mean * 1000:.1f}ms jitter {jitter * 1000:.1f}ms "
+                    f"(min {self.dt_min * 1000:.1f}, max {self.dt_max * 1000:.1f})")
+        else:
+            text = "no samples"
+        self.reset(now)
+        return text
@@ -0,0 +1,118 @@
+"""Adaptive ESP32 sample rate control.
+
+Picks the notification interval from the brick's angular speed: fast
+sampling while it moves, slow sampling at rest. Speed-ups apply at once;
+slow-downs only after the brick has been calm for a while. Two limits cap
+the rate: the interval the BLE link actually delivers, and a floor the
+server sends when it is loaded.
+"""
+import math
+
+FIRMWARE_MIN_INTERVAL = 10  # ms, limits accepted by the ESP32 firmware
+FIRMWARE_MAX_INTERVAL = 1000
+
+
+class SampleRateController:
+    """Chooses the ESP32 timer interval of one brick from its gyro readings"""
+    LINK_PROBE_TIME = 30.0  # Seconds before a faster rate than the link delivered is tried again
+    LINK_WARMUP = 20  # Samples at a new interval before judging the link
+    SPEED_DECAY = 0.3  # Smoothing of decreasing angular speed per sample
+    MIN_CHANGE = 0.2  # Relative interval change worth a BLE write
+
+    def __init__(self, min_interval=20, max_interval=250, still_speed=5.0, fast_speed=120.0,
+                 release_time=2.0, interval=100):
+        """
+        Args:
+            min_interval: Interval (ms) while moving at fast_speed or faster
+            max_interval: Interval (ms) while slower than still_speed
+            still_speed: Angular speed (°/s) below which the brick counts as at rest
+            fast_speed: Angular speed (°/s) that gets the fastest rate
+            release_time: Seconds the brick must stay calmer before the rate is lowered
+            interval: Interval (ms) the brick currently uses
+        """
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.still_speed = still_speed
+        self.fast_speed = fast_speed
+        self.release_time = release_time
+        self.interval = interval
+
+        self.speed = 0.0  # Angular speed (°/s): rises at once, decays smoothly
+        self.calm_since = None  # Arrival time since which a slower rate has been wanted
+
+        # Measured BLE delivery: smoothed notification interval (ms) and the
+        # fastest interval the link is known to sustain, re-probed after LINK_PROBE_TIME
+        self.link_interval = None
+        self.link_samples = 0
+        self.link_floor = 0
+        self.link_floor_since = None
+        self.last_arrival = None
+
+        self.server_floor = 0  # Minimum interval (ms) requested by the server under load
+
+    def target_interval(self, speed):
+        """Interval (ms) for an angular speed, interpolated on a log scale"""
+        if speed <= self.still_speed:
+            return self.max_interval
+        if speed >= self.fast_speed:
+            return self.min_interval
+        fraction = math.log(speed / self.still_speed) / math.log(self.fast_speed / self.still_speed)
+        return round(self.max_interval * (self.min_interval / self.max_interval) ** fraction)
+
+    def update(self, gyro_x, gyro_y, gyro_z, arrival):
+        """
+        Feed one sample
+
+        Args:
+            gyro_x, gyro_y, gyro_z: Angular velocity in °/s
+            arrival: Notification arrival time (monotonic seconds)
+        Returns:
+            New interval (ms) to write to the brick, None to keep the current one
+        """
+        speed = math.sqrt(gyro_x * gyro_x + gyro_y * gyro_y + gyro_z * gyro_z)
+        if speed >= self.speed:
+            self.speed = speed
+        else:
+            self.speed += self.SPEED_DECAY * (speed - self.speed)
+
+        self._measure_link(arrival)
+
+        target = max(self.target_interval(self.speed), self.link_floor, self.server_floor)
+        target = min(max(target, FIRMWARE_MIN_INTERVAL), FIRMWARE_MAX_INTERVAL)
+
+        if abs(target - self.interval) < self.MIN_CHANGE * self.interval:
+            self.calm_since = None
+            return None
+        if target > self.interval:
+            # Slow down only after release_time of calm
+            if self.calm_since is None:
+                self.calm_since = arrival
+            if arrival - self.calm_since < self.release_time:
+                return None
+        self.set_interval(target)
+        return target
+
+    def _measure_link(self, arrival):
+        if self.last_arrival is not None:
+            measured = (arrival - self.last_arrival) * 1000
+            if self.link_interval is None:
+                self.link_interval = measured
+            else:
+                self.link_interval += 0.1 * (measured - self.link_interval)
+            self.link_samples += 1
+        self.last_arrival = arrival
+
+        if self.link_floor and arrival - self.link_floor_since >= self.LINK_PROBE_TIME:
+            self.link_floor = 0
+        # Notifications arrive much slower than requested: the link is saturated
+        if self.link_samples >= self.LINK_WARMUP and self.link_interval > 1.5 * self.interval:
+            self.link_floor = max(self.link_floor, round(self.link_interval))
+            self.link_floor_since = arrival
+
+    def set_interval(self, interval):
+        """Record a newly requested interval (also for manual changes from the UI)"""
+        self.interval = interval
+        self.calm_since = None
+        # Measure the link afresh at the new rate
+        self.link_interval = None
+        self.link_samples = 0
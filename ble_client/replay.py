@@ -0,0 +1,184 @@
+"""Replay recorded BLE telemetry through the client pipeline without hardware.
+
+Recordings are made by ble_client.py when RECORD_DIR is set. Usage:
+
+    python replay.py recordings/                  # real time, sent to SERVER_URL
+    python replay.py recordings/ --speed 0        # as fast as possible (load generator)
+    python replay.py recordings/ --offline        # filter only, nothing sent
+    python replay.py recordings/ --save-baseline baseline.npz
+    python replay.py recordings/ --check-baseline baseline.npz
+
+Baselines hold what notification_handler emits for every recorded frame
+(timestamp and rotation), so a check covers the whole client pipeline:
+timestamp checks, filter, and axis mapping.
+"""
+import argparse
+import asyncio
+import sys
+
+import numpy as np
+
+import ble_client
+from logs import setup_logging
+from telemetry import load_recordings
+
+BASELINE_TOLERANCE = 1e-6  # Degrees or quaternion components
+
+
+async def replay(recordings, speed=1.0, offline=False, connect_timeout=10.0):
+    """
+    Feed recorded notifications, merged by arrival time, through
+    ble_client.notification_handler
+
+    Args:
+        recordings: {device_id: records} as returned by load_recordings
+        speed: Playback speed relative to recording (2.0 = twice as fast); 0 = no pacing
+        offline: Only run the filters, don't connect to the server
+    Returns:
+        (frames replayed, elapsed seconds)
+    """
+    loop = asyncio.get_running_loop()
+    device_ids = list(recordings)
+
+    # Raw 28-byte payloads are the bytes after the float64 arrival time
+    payloads = [np.asarray(recordings[device_id]).view(np.uint8)
+                .reshape(len(recordings[device_id]), -1)[:, 8:] for device_id in device_ids]
+    arrivals = np.concatenate([recordings[device_id]['arrival'] for device_id in device_ids])
+    owners = np.concatenate([np.full(len(recordings[device_id]), index)
+                             for index, device_id in enumerate(device_ids)])
+    positions = np.concatenate([np.arange(len(recordings[device_id])) for device_id in device_ids])
+    order = np.argsort(arrivals, kind='stable')
+    if not len(order):
+        return 0, 0.0
+
+    sessions = []
+    for device_id in device_ids:
+        session = ble_client.BrickSession(device_id)
+        session.device_id = device_id  # Keep recorded ids even if DEVICE_IDS maps addresses
+        ble_client.sessions[device_id] = session
+        sessions.append(session)
+
+    if not offline:
+        ble_client.start_websocket()
+        waited = 0.0
+        while not ble_client.sio.connected and waited < connect_timeout:
+            await asyncio.sleep(0.1)
+            waited += 0.1
+        for session in sessions:
+            ble_client.send_ble_status(session, True)
+
+    first_arrival = arrivals[order[0]]
+    start = loop.time()
+    for k in order:
+        if speed > 0:
+            delay = (arrivals[k] - first_arrival) / speed - (loop.time() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)  # Let the WebSocket sender run
+
+        await ble_client.notification_handler(sessions[owners[k]], None,
+                                              payloads[owners[k]][positions[k]].tobytes())
+    elapsed = loop.time() - start
+
+    for session in sessions:
+        ble_client.flush_rotation_batch(session)
+        if not offline:
+            ble_client.send_ble_status(session, False)
+    if not offline:
+        await ble_client.close_websocket()
+
+    return len(order), elapsed
+
+
+def replay_baseline(recordings):
+    """
+    Rotations notification_handler emits for the recordings, replayed offline
+    at full speed with the client's own fusion (not SERVER_FUSION)
+
+    Returns:
+        {device_id: (N, 4) timestamp, x, y, z or (N, 5) timestamp, qw, qx, qy, qz}
+    """
+    emitted = {device_id: [] for device_id in recordings}
+
+    def capture(session, timestamp=0):
+        rotation = (session.current_quaternion if ble_client.FILTER_MODE == 'madgwick'
+                    else session.current_rotation)
+        emitted[session.device_id].append((timestamp, *rotation.values()))
+
+    send_rotation, server_fusion = ble_client.send_rotation_to_api, ble_client.SERVER_FUSION
+    ble_client.send_rotation_to_api = capture
+    ble_client.SERVER_FUSION = False
+    ble_client.ADAPTIVE_RATE = False  # No brick to change the rate of
+    try:
+        asyncio.run(replay(recordings, speed=0, offline=True))
+    finally:
+        ble_client.send_rotation_to_api, ble_client.SERVER_FUSION = send_rotation, server_fusion
+        ble_client.sessions.clear()
+        ble_client.send_queue.clear()
+
+    columns = 5 if ble_client.FILTER_MODE == 'madgwick' else 4
+    return {device_id: np.array(rows, dtype=np.float64).reshape(-1, columns)
+            for device_id, rows in emitted.items()}
+
+
+def check_baseline(recordings, path):
+    """Compare the replayed pipeline's rotations against a saved baseline; True when every device matches"""
+    expected = np.load(path)
+    ok = True
+    for device_id, angles in replay_baseline(recordings).items():
+        if device_id not in expected:
+            print(f"✗ {device_id}: not in baseline")
+            ok = False
+            continue
+        reference = expected[device_id]
+        if reference.shape != angles.shape:
+            print(f"✗ {device_id}: {angles.shape} values, baseline has {reference.shape}")
+            ok = False
+            continue
+        error = float(np.abs(reference - angles).max()) if len(angles) else 0.0
+        matches = error <= BASELINE_TOLERANCE
+        ok = ok and matches
+        print(f"{'✓' if matches else '✗'} {device_id}: max error {error:.3g}")
+    return ok
+
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser(description='Replay recorded ESP32 telemetry without hardware')
+    parser.add_argument('directory', help='Recording directory (RECORD_DIR of ble_client.py)')
+    parser.add_argument('--speed', type=float, default=1.0,
+                        help='Playback speed, 1 = real time, 0 = as fast as possible')
+    parser.add_argument('--offline', action='store_true', help="Don't connect to the server")
+    parser.add_argument('--server', default=ble_client.SERVER_URL, help='WebSocket server URL')
+    parser.add_argument('--save-baseline', metavar='FILE', help='Save the replayed rotations as a baseline')
+    parser.add_argument('--check-baseline', metavar='FILE', help='Compare the replayed rotations to a baseline')
+    args = parser.parse_args()
+
+    recordings = load_recordings(args.directory)
+    total = sum(len(records) for records in recordings.values())
+    print(f"Loaded {total} frames from {len(recordings)} device(s)")
+
+    if args.save_baseline:
+        np.savez(args.save_baseline, **replay_baseline(recordings))
+        print(f"✓ Saved baseline to {args.save_baseline}")
+        return
+    if args.check_baseline:
+        sys.exit(0 if check_baseline(recordings, args.check_baseline) else 1)
+
+    setup_logging(ble_client.LOG_LEVEL, ble_client.LOG_FILE)
+    ble_client.SERVER_URL = args.server
+    ble_client.ADAPTIVE_RATE = False  # No brick to change the rate of
+    try:
+        count, elapsed = asyncio.run(replay(recordings, speed=args.speed, offline=args.offline))
+    except KeyboardInterrupt:
+        print("\nReplay stopped by user")
+        return
+    rate = count / elapsed if elapsed > 0 else float('inf')
+    print(f"✓ Replayed {count} frames in {elapsed:.2f}s ({rate:.0f} frames/s)")
+    if not args.offline:
+        print(f"  {ble_client.send_queue_dropped} message(s) dropped by the send queue")
+
+
+if __name__ == "__main__":
+    main()
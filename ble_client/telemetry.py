@@ -0,0 +1,131 @@
+"""Recording of raw SensorData notifications for hardware-free replay.
+
+Each device gets its own log file: a 64-byte header (magic + device id)
+followed by fixed-size records of a float64 arrival time (Unix seconds) and
+the raw 28-byte notification, so a log can be memory-mapped as a NumPy
+record array without parsing.
+"""
+import os
+import re
+import struct
+import time
+
+import numpy as np
+
+from fusion import FusionEngine, SENSOR_DTYPE
+from stream_health import StreamHealth
+
+MAGIC = b'LEGOREC1'
+HEADER_SIZE = 64
+HEADER = struct.Struct(f'<8sH{HEADER_SIZE - 10}s')  # magic, device id length, device id
+ARRIVAL = struct.Struct('<d')
+
+# One log record: arrival time followed by the SensorData fields
+RECORD_DTYPE = np.dtype([('arrival', '<f8')] + [(name, SENSOR_DTYPE.fields[name][0])
+                                                 for name in SENSOR_DTYPE.names])
+
+
+def log_filename(device_id):
+    """File name of a device's log (device ids such as BLE addresses made path-safe)"""
+    return re.sub(r'[^A-Za-z0-9_.-]', '-', device_id) + '.bin'
+
+
+class TelemetryRecorder:
+    """Appends raw BLE notifications of every device to per-device log files"""
+    def __init__(self, directory):
+        self.directory = directory
+        self.files = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, device_id, data, arrival=None):
+        """Append one 28-byte notification with its arrival time (now by default)"""
+        log = self.files.get(device_id)
+        if log is None:
+            log = self._open(device_id)
+        log.write(ARRIVAL.pack(time.time() if arrival is None else arrival))
+        log.write(data)
+
+    def _open(self, device_id):
+        encoded = device_id.encode()
+        if len(encoded) > HEADER_SIZE - 10:
+            raise ValueError(f'Device id too long to record: {device_id}')
+
+        path = os.path.join(self.directory, log_filename(device_id))
+        log = open(path, 'ab')
+        if log.tell() == 0:
+            log.write(HEADER.pack(MAGIC, len(encoded), encoded))
+        self.files[device_id] = log
+        return log
+
+    def flush(self):
+        """Flush buffered records to disk"""
+        for log in self.files.values():
+            log.flush()
+
+    def close(self):
+        """Close all log files"""
+        for log in self.files.values():
+            log.close()
+        self.files.clear()
+
+
+def load_recording(path):
+    """
+    Memory-map a device log
+
+    Returns:
+        (device_id, records) with records a read-only RECORD_DTYPE array
+    """
+    with open(path, 'rb') as log:
+        magic, length, encoded = HEADER.unpack(log.read(HEADER_SIZE))
+    if magic != MAGIC:
+        raise ValueError(f'Not a telemetry log: {path}')
+
+    # Ignore a partially written last record
+    count = (os.path.getsize(path) - HEADER_SIZE) // RECORD_DTYPE.itemsize
+    records = np.memmap(path, dtype=RECORD_DTYPE, mode='r', offset=HEADER_SIZE, shape=(count,))
+    return encoded[:length].decode(), records
+
+
+def load_recordings(directory):
+    """Memory-map every device log in a directory, as {device_id: records}"""
+    recordings = {}
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.bin'):
+            device_id, records = load_recording(os.path.join(directory, name))
+            recordings[device_id] = records
+    return recordings
+
+
+def sensor_frames(records):
+    """SensorData frames (SENSOR_DTYPE) of log records, in order"""
+    frames = np.empty(len(records), dtype=SENSOR_DTYPE)
+    for name in SENSOR_DTYPE.names:
+        frames[name] = records[name]
+    return frames
+
+
+def fuse_recording(records, alpha=0.98, gyro_deadband=3.0, interval=100):
+    """
+    Fuse a device log offline with FusionEngine, with the live client's time steps
+
+    Every frame goes through StreamHealth first, as in notification_handler:
+    duplicate and late frames are dropped and long gaps clamped.
+
+    Args:
+        interval: Sample interval (ms) the brick was configured with
+    Returns:
+        (timestamps, angles): ESP32 timestamps (T,) and angles (T, 3) of the kept frames
+    """
+    frames = sensor_frames(records)
+    health = StreamHealth(interval)
+    keep = np.zeros(len(frames), dtype=bool)
+    dt = np.empty(len(frames))
+    for index, timestamp in enumerate(frames['timestamp'].tolist()):
+        timestep = health.timestep(timestamp)
+        if timestep is not None:
+            keep[index] = True
+            dt[index] = timestep[1]
+    frames, dt = frames[keep], dt[keep]
+    engine = FusionEngine(num_devices=1, alpha=alpha, gyro_deadband=gyro_deadband)
+    return frames['timestamp'], engine.process(frames, dt)
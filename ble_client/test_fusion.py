@@ -0,0 +1,148 @@
+"""FusionEngine must match ComplementaryFilter sample for sample, and both filter
+modes must show the same rotation. Run with pytest."""
+import asyncio
+import math
+import struct
+
+import numpy as np
+import pytest
+
+from fusion import SENSOR_DTYPE, ComplementaryFilter, FusionEngine
+
+
+def scalar_angles(samples, alpha, gyro_deadband):
+    """Angles of ComplementaryFilter.update fed one sample at a time, dt from the timestamps"""
+    comp_filter = ComplementaryFilter(alpha=alpha, gyro_deadband=gyro_deadband)
+    angles = []
+    last_timestamp = None
+    for sample in samples.tolist():
+        timestamp, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z = sample
+        dt = 0.1 if last_timestamp is None else (timestamp - last_timestamp) / 1000.0
+        last_timestamp = timestamp
+        angles.append(comp_filter.update(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=dt))
+    return np.array(angles)
+
+
+def random_samples(count, seed=1):
+    """Noisy motion with still stretches and irregular sample spacing"""
+    rng = np.random.default_rng(seed)
+    samples = np.zeros(count, dtype=SENSOR_DTYPE)
+    samples['timestamp'] = np.cumsum(rng.integers(5, 30, count))
+    for key in ('acc_x', 'acc_y', 'acc_z'):
+        samples[key] = rng.normal(0, 1, count)
+    moving = rng.random(count) < 0.7
+    for key in ('gyro_x', 'gyro_y', 'gyro_z'):
+        samples[key] = rng.normal(0, 100, count) * moving
+    return samples
+
+
+@pytest.mark.parametrize('alpha', [0.0, 1e-300, 1e-5, 0.003, 0.5, 0.98, 1.0])
+def test_matches_scalar_filter(alpha):
+    samples = random_samples(2000)
+    engine = FusionEngine(alpha=alpha, gyro_deadband=3.0)
+    # Two blocks: filter state must carry over between process() calls
+    angles = np.concatenate([engine.process(samples[:700]), engine.process(samples[700:])])
+    assert np.isfinite(angles).all()
+    np.testing.assert_allclose(angles, scalar_angles(samples, alpha, 3.0), rtol=0, atol=1e-9)
+
+
+def test_yaw_wraps_like_scalar_filter():
+    # Constant 400°/s yaw: wraps every 90 samples
+    samples = np.zeros(5000, dtype=SENSOR_DTYPE)
+    samples['timestamp'] = np.arange(5000) * 10
+    samples['acc_z'] = 1.0
+    samples['gyro_z'] = 400.0
+    angles = FusionEngine(alpha=0.98, gyro_deadband=3.0).process(samples)
+    assert np.abs(angles[:, 2]).max() <= 360
+    np.testing.assert_allclose(angles, scalar_angles(samples, 0.98, 3.0), rtol=0, atol=1e-9)
+
+
+def quaternion_product(a, b):
+    w1, x1, y1, z1 = a
+    w2, x2, y2, z2 = b
+    return (w1 * w2 - x1 * x2 - y1 * y2 - z1 * z2,
+            w1 * x2 + x1 * w2 + y1 * z2 - z1 * y2,
+            w1 * y2 - x1 * z2 + y1 * w2 + z1 * x2,
+            w1 * z2 + x1 * y2 - y1 * x2 + z1 * w2)
+
+
+def unity_euler(x, y, z):
+    """Unity's Quaternion.Euler(x, y, z) as (w, x, y, z): z first, then x, then y"""
+    def turn(angle, axis):
+        half = math.radians(angle) / 2
+        vector = [0.0, 0.0, 0.0]
+        vector[axis] = math.sin(half)
+        return (math.cos(half), *vector)
+    return quaternion_product(quaternion_product(turn(y, 1), turn(x, 0)), turn(z, 2))
+
+
+def rotation_between(a, b):
+    """Angle (degrees) between two orientations"""
+    return math.degrees(2 * math.acos(min(1.0, abs(sum(p * q for p, q in zip(a, b))))))
+
+
+def filter_mode_rotations(monkeypatch, frames):
+    """Unity rotation of each filter mode after feeding raw notifications to notification_handler"""
+    import ble_client
+    monkeypatch.setattr(ble_client, 'send_rotation_to_api', lambda session, timestamp=0: None)
+    sessions = {}
+    for mode in ('complementary', 'madgwick'):
+        monkeypatch.setattr(ble_client, 'FILTER_MODE', mode)
+        session = sessions[mode] = ble_client.BrickSession('AA:BB:CC:DD:EE:FF')
+
+        async def feed():
+            for frame in frames:
+                await ble_client.notification_handler(session, None, frame)
+        asyncio.run(feed())
+    euler = sessions['complementary'].current_rotation
+    quaternion = sessions['madgwick'].current_quaternion
+    return (unity_euler(euler['x'], euler['y'], euler['z']),
+            (quaternion['qw'], quaternion['qx'], quaternion['qy'], quaternion['qz']))
+
+
+@pytest.mark.parametrize('axis, angle', [(0, 30), (0, -20), (1, 30), (1, -45)])
+def test_filter_modes_agree_on_static_tilt(monkeypatch, axis, angle):
+    # Gravity seen by a brick held still, rotated by angle about one sensor axis
+    tilt = math.radians(angle)
+    acc = (0.0, math.sin(tilt), math.cos(tilt)) if axis == 0 else (-math.sin(tilt), 0.0, math.cos(tilt))
+    frames = [struct.pack('<I6f', index * 100, *acc, 0, 0, 0) for index in range(600)]
+    euler, quaternion = filter_mode_rotations(monkeypatch, frames)
+    assert rotation_between(euler, unity_euler(0, 0, 0)) > abs(angle) - 1  # Not left at rest
+    assert rotation_between(euler, quaternion) < 0.5
+
+
+def test_filter_modes_agree_on_integrated_yaw(monkeypatch):
+    # Flat brick turning at 45°/s for 2 s
+    frames = [struct.pack('<I6f', index * 100, 0, 0, 1, 0, 0, 45) for index in range(21)]
+    euler, quaternion = filter_mode_rotations(monkeypatch, frames)
+    assert rotation_between(euler, unity_euler(0, 0, 0)) > 80
+    assert rotation_between(euler, quaternion) < 0.5
+
+
+def test_fuse_recording_matches_replayed_pipeline(tmp_path):
+    import replay
+    from telemetry import TelemetryRecorder, fuse_recording, load_recordings
+
+    # Noisy motion that wraps the uint32 clock, with a repeated and a late frame and a dropout
+    samples = random_samples(400)
+    samples['timestamp'] = (2**32 - 3000 + np.cumsum(np.full(400, 20))) % 2**32
+    samples['timestamp'][100] = samples['timestamp'][99]
+    samples['timestamp'][200] = samples['timestamp'][198]
+    samples['timestamp'][300:] += 5000
+    recorder = TelemetryRecorder(str(tmp_path))
+    for index, frame in enumerate(samples):
+        recorder.record('brick', frame.tobytes(), arrival=1000.0 + index * 0.02)
+    recorder.close()
+
+    recordings = load_recordings(str(tmp_path))
+    emitted = replay.replay_baseline(recordings)['brick']
+    timestamps, angles = fuse_recording(recordings['brick'], alpha=0.98, gyro_deadband=3.0)
+    assert len(emitted) == len(angles) == 398
+    np.testing.assert_array_equal(emitted[:, 0], timestamps)
+    # Default AXIS_MAPPING: x -> x, yaw z -> y, y -> -z
+    np.testing.assert_allclose(emitted[:, 1:], np.column_stack([angles[:, 0], angles[:, 2], -angles[:, 1]]),
+                               rtol=0, atol=1e-9)
+
+    baseline = tmp_path / 'baseline.npz'
+    np.savez(baseline, **replay.replay_baseline(recordings))
+    assert replay.check_baseline(recordings, str(baseline))
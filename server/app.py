@@ -1,59 +1,747 @@
-from flask import Flask, request, jsonify, send_from_directory
-from flask_cors import CORS
-from flask_socketio import SocketIO, emit
+import atexit
+import logging
+import math
 import os
 
+# Production runs use an event-loop server (gevent) instead of a thread per
+# connection; the stdlib must be patched before anything else imports it
+ASYNC_MODE = os.environ.get('ASYNC_MODE', 'threading')
+if ASYNC_MODE == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+from flask import Flask, Response, request, jsonify, stream_with_context
+from flask_cors import CORS
+from flask_socketio import SocketIO, emit, join_room, leave_room
+import numpy as np
+import threading
+import time
+
+from assets import send_asset
+from compact import CompactStream
+from export import EXPORT_FORMATS, EXPORTERS, MotionSummary
+from fusion_pool import DEFAULT_SAMPLE_INTERVAL, RAW_FRAME, SAMPLE_INTERVAL_RANGE, FusionPool, normalize_config
+from history import RotationHistory, bucket_columns, sample_columns
+from logs import setup_logging
+from metrics import Metrics
+from state import create_state_store
+
+# Log records are written by a background thread; LOG_LEVEL=DEBUG adds
+# per-connection and per-status lines. Every LOG_SUMMARY_INTERVAL seconds the
+# broadcast loop logs viewer count, sample and broadcast rates and load
+setup_logging(os.environ.get('LOG_LEVEL', 'INFO'), os.environ.get('LOG_FILE') or None)
+logger = logging.getLogger('server')
+LOG_SUMMARY_INTERVAL = float(os.environ.get('LOG_SUMMARY_INTERVAL', 60))
+
 app = Flask(__name__, static_folder='static')
 CORS(app)  # Enable CORS for Unity WebGL
-socketio = SocketIO(app, cors_allowed_origins="*", async_mode='threading')
 
-# Store current rotation state
-current_rotation = {
-    'x': 0.0,
-    'y': 0.0,
-    'z': 0.0
-}
+# Let a front proxy (Apache/lighttpd X-Sendfile) send static files instead of this process
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE') == '1'
+
+# Optional message queue (e.g. redis://localhost:6379/0) shared by several
+# worker processes: broadcasts reach clients of every worker and device state
+# is stored in the queue's Redis instead of this process's memory
+MESSAGE_QUEUE = os.environ.get('MESSAGE_QUEUE') or None
+
+socketio = SocketIO(app, cors_allowed_origins="*", async_mode=ASYNC_MODE,
+                    message_queue=MESSAGE_QUEUE)
+
+# Rotation updates per device kept for reconnecting viewers to catch up on
+# (default 300, ten seconds at the default tick rate)
+UPDATE_LOG_SIZE = int(os.environ.get('UPDATE_LOG_SIZE', 300))
 
-# Store BLE connection status
-ble_connection_status = {
-    'connected': False,
-    'device_name': None
+# Device registry: rotation and BLE status per device id, and the update log
+store = create_state_store(MESSAGE_QUEUE, UPDATE_LOG_SIZE)
+
+# Device used by clients that don't send a device_id (single-brick setups)
+DEFAULT_DEVICE_ID = 'default'
+
+# Devices each publishing client (BLE client) of this worker has reported for, keyed by sid
+publisher_devices = {}
+
+# Devices each viewer of this worker is subscribed to, keyed by sid
+client_devices = {}
+
+# Keys of the two rotation payload variants: Euler angles in degrees, and a
+# quaternion (from quaternion-domain filters) that is relayed unchanged
+EULER_KEYS = ('x', 'y', 'z')
+QUATERNION_KEYS = ('qw', 'qx', 'qy', 'qz')
+
+# Binary rotation frames sent by the BLE client in 'rotation_batch' events,
+# by 'format': little-endian uint32 device timestamp (ms) + float32 values
+ROTATION_FRAMES = {
+    format: (np.dtype([('ts', '<u4')] + [(key, '<f4') for key in keys]), keys)
+    for format, keys in (('euler', EULER_KEYS), ('quaternion', QUATERNION_KEYS))
 }
 
+# Server-side fusion of raw IMU frames ('raw_batch' events): FUSION_WORKERS
+# worker processes (default: one per core, 0 fuses inline), started on first
+# use. Devices without a fusion config of their own use FUSION_FILTER with
+# default parameters
+FUSION_WORKERS = int(os.environ.get('FUSION_WORKERS', os.cpu_count() or 1))
+DEFAULT_FUSION_CONFIG = normalize_config({'filter': os.environ.get('FUSION_FILTER', 'complementary')})
+fusion_pool = None
+fusion_pool_lock = threading.Lock()
+
+# Fusion configs read from the store, cached for FUSION_CONFIG_TTL seconds so
+# raw batches don't hit Redis; changes made on other workers apply within that time
+FUSION_CONFIG_TTL = 1.0
+fusion_configs = {}
+
+# Rotation history of every device: the latest HISTORY_RING_SIZE samples per
+# device in memory, and all samples of the last HISTORY_RETENTION seconds in
+# the SQLite file HISTORY_DB (set it empty to keep only the in-memory history)
+history = RotationHistory(os.environ.get('HISTORY_DB', 'history.db'),
+                          ring_size=int(os.environ.get('HISTORY_RING_SIZE', 6000)),
+                          retention=float(os.environ.get('HISTORY_RETENTION', 7 * 86400)))
+atexit.register(history.close)
+
+# History query limits: default window (seconds), samples and buckets per response
+DEFAULT_HISTORY_WINDOW = 60.0
+MAX_HISTORY_SAMPLES = 10000
+MAX_HISTORY_BUCKETS = 10000
+
+# Rows read from the history per chunk of a bulk export or summary
+EXPORT_CHUNK_SIZE = 2000
+
+# Motion summaries are computed within the request: default window and the
+# longest range (seconds) a single request may cover
+SUMMARY_DEFAULT_WINDOW = 3600.0
+MAX_SUMMARY_SPAN = 86400.0
+
+# Optional timing fields of rotation samples, carried through to viewers:
+# ESP32 sample timestamp (ms, device clock) and the BLE client's receive and
+# send times (Unix seconds). The server adds 'server_received_at' and
+# 'relayed_at' (Unix seconds)
+TIMING_KEYS = ('ts', 'received_at', 'sent_at')
+
+# Latency stages viewers report in 'latency_report' events, the maximum
+# number of samples accepted per stage and report, and the longest latency
+# (seconds) recorded; longer reported values are capped to it
+VIEWER_LATENCY_STAGES = ('delivery', 'render', 'total')
+MAX_LATENCY_REPORT = 200
+MAX_REPORTED_LATENCY = 60.0
+
+# Latency histograms and message counters served at /metrics (this worker only)
+metrics = Metrics()
+
+# Send queue depth and drop count last reported by each device's BLE client
+publisher_queues = {}
+
+# ESP32 sample interval (ms) last reported by each device's BLE client
+sample_intervals = {}
+
+# BLE link statistics last reported by each device's BLE client
+link_health = {}
+
+# Rate at which coalesced rotation updates are pushed to viewers (Hz)
+VIEWER_TICK_RATE = float(os.environ.get('VIEWER_TICK_RATE', 30))
+
+# Server load feedback for adaptive sample rates: the broadcast loop measures
+# load as the smoothed share of each tick spent flushing or lost to scheduling
+# lag, and every LOAD_REPORT_INTERVAL tells the BLE clients ('publishers' room)
+# a minimum sample interval once it exceeds LOAD_THRESHOLD
+LOAD_REPORT_INTERVAL = 2.0  # Seconds
+LOAD_THRESHOLD = 0.5
+LOAD_BASE_INTERVAL = 10  # ms, minimum interval is this / (1 - load)
+LOAD_MAX_INTERVAL = 1000
+server_load = 0.0
+
+# Latest rotation values per device received since the last flush
+pending_rotations = {}
+pending_lock = threading.Lock()
+
+# Viewers that asked for fewer updates than VIEWER_TICK_RATE, keyed by sid:
+# {'interval': seconds, 'last_sent': monotonic time, 'sent': {device_id: rotation},
+#  'streams': {device_id: CompactStream}}
+# They stay out of the rotation rooms and are served from the store at their own pace
+rate_limited_clients = {}
+
+# Backpressure: viewers whose Engine.IO send queue holds OUTBOUND_QUEUE_HIGH
+# packets or more leave the rotation rooms and get no updates until it drains
+# to OUTBOUND_QUEUE_LOW; then they get the latest rotation only. Viewers
+# still behind after SLOW_CONSUMER_EVICT_AFTER seconds are disconnected.
+# Queues are checked every BACKPRESSURE_INTERVAL seconds
+OUTBOUND_QUEUE_HIGH = int(os.environ.get('OUTBOUND_QUEUE_HIGH', 64))
+OUTBOUND_QUEUE_LOW = int(os.environ.get('OUTBOUND_QUEUE_LOW', 8))
+SLOW_CONSUMER_EVICT_AFTER = float(os.environ.get('SLOW_CONSUMER_EVICT_AFTER', 30))
+BACKPRESSURE_INTERVAL = 0.25
+
+# Lagging viewers: sid -> monotonic time since which they have been behind
+lagging_clients = {}
+last_backpressure_check = 0.0
+
+# Viewers that negotiated the compact rotation encoding (?encoding=compact), by sid.
+# They receive quantized delta frames ('rotation_compact', see compact.py)
+# instead of 'rotation_update' objects
+compact_clients = set()
+
+# Compact encoder of each device's broadcasts, shared by its compact viewers
+compact_streams = {}
+
+# Rotation change (degrees) below which compact viewers get no update
+COMPACT_DEADBAND = float(os.environ.get('COMPACT_DEADBAND', 0.1))
+
+broadcast_task = None
+broadcast_task_lock = threading.Lock()
+
+
+def device_room(device_id):
+    """Socket.IO room holding the viewers subscribed to a device (BLE status)"""
+    return f'device:{device_id}'
+
+
+def rotation_room(device_id, compact=False):
+    """Socket.IO room receiving a device's live rotation broadcasts in one encoding"""
+    return f'compact:{device_id}' if compact else f'rotation:{device_id}'
+
+
+def client_rotation_room(device_id):
+    """Live rotation room of a device for the current client's encoding"""
+    return rotation_room(device_id, request.sid in compact_clients)
+
+
+def publisher_room(device_id):
+    """Socket.IO room holding the BLE client(s) publishing a device"""
+    return f'publisher:{device_id}'
+
+
+def device_id_from(data):
+    """Extract the device id from an event payload, falling back to the default device"""
+    if isinstance(data, dict) and data.get('device_id'):
+        return str(data['device_id'])
+    return DEFAULT_DEVICE_ID
+
+
+def register_publisher(device_id):
+    """Remember that the current client publishes data for a device"""
+    owned = publisher_devices.setdefault(request.sid, set())
+    if device_id not in owned:
+        owned.add(device_id)
+        join_room(publisher_room(device_id))
+        join_room('publishers')
+
+
+def receives_broadcasts(sid):
+    """Whether a viewer gets rotations through the rotation rooms (not rate-limited or lagging)"""
+    return sid not in rate_limited_clients and sid not in lagging_clients
+
+
+def subscribe_client(device_id):
+    """Subscribe the current client to a device"""
+    client_devices.setdefault(request.sid, set()).add(device_id)
+    join_room(device_room(device_id))
+    if receives_broadcasts(request.sid):
+        join_room(client_rotation_room(device_id))
+
+
+def set_client_encoding(encoding):
+    """Switch the current client between 'json' (default) and 'compact' rotation updates"""
+    compact = encoding == 'compact'
+    if compact == (request.sid in compact_clients):
+        return
+    live = receives_broadcasts(request.sid)
+    subscribed = client_devices.get(request.sid, ())
+    for device_id in subscribed:
+        if live:
+            leave_room(client_rotation_room(device_id))
+    if compact:
+        compact_clients.add(request.sid)
+    else:
+        compact_clients.discard(request.sid)
+    for device_id in subscribed:
+        if live:
+            join_room(client_rotation_room(device_id))
+        emit_current_rotation(device_id)
+
+
+def compact_stream(device_id):
+    """Shared compact encoder of a device's broadcasts"""
+    stream = compact_streams.get(device_id)
+    if stream is None:
+        stream = compact_streams[device_id] = CompactStream(device_id, COMPACT_DEADBAND)
+    return stream
+
+
+def parse_seq(value):
+    """Sequence number sent by a resuming viewer, None if missing or invalid"""
+    try:
+        seq = int(value)
+    except (ValueError, TypeError):
+        return None
+    return seq if seq >= 0 else None
+
+
+def catchup_columns(device_id, latest, updates):
+    """Missed updates as a 'rotation_catchup' payload: sequence numbers, relay times and value columns"""
+    columns = {'device_id': device_id, 'seq': list(range(latest - len(updates) + 1, latest + 1)),
+               't': [update['t'] for update in updates]}
+    for key in ('ts',) + EULER_KEYS + QUATERNION_KEYS:
+        if any(key in update for update in updates):
+            columns[key] = [update.get(key) for update in updates]
+    return columns
+
+
+def resync_client(device_id, seq=None):
+    """
+    Bring the current client up to date on a device: the updates it missed
+    since seq when the update log still covers them, a snapshot otherwise
+    """
+    # Compact streams resynchronize with a keyframe, and rate-limited viewers
+    # only want the latest rotation anyway
+    if seq is not None and request.sid not in compact_clients and request.sid not in rate_limited_clients:
+        missed = store.updates_since(device_id, seq)
+        if missed is not None:
+            emit('rotation_catchup', catchup_columns(device_id, *missed))
+            emit('ble_status', store.get_ble_status(device_id))
+            return
+    emit_current_rotation(device_id)
+    emit('ble_status', store.get_ble_status(device_id))
+
+
+def emit_current_rotation(device_id, sid=None):
+    """Send a device's current rotation to a client (default: the current one), in its encoding"""
+    sid = sid or request.sid
+    rotation = store.get_rotation(device_id)
+    if sid not in compact_clients:
+        socketio.emit('rotation_update', rotation, to=sid)
+        return
+
+    client = rate_limited_clients.get(sid)
+    if client is not None:
+        stream = client['streams'].setdefault(device_id, CompactStream(device_id, COMPACT_DEADBAND))
+        frame = stream.encode(rotation, keyframe=True)
+    else:
+        # Join the shared stream where it is; a stream on another worker
+        # resynchronizes at its next keyframe
+        frame = compact_stream(device_id).keyframe() or CompactStream(device_id).encode(rotation)
+    socketio.emit('rotation_compact', frame, to=sid)
+
+
+def set_client_rate_limit(max_rate):
+    """Cap the rotation_update rate for the current client (None/0 removes the cap)"""
+    try:
+        max_rate = float(max_rate) if max_rate else 0.0
+    except (ValueError, TypeError):
+        max_rate = 0.0
+    subscribed = client_devices.get(request.sid, ())
+
+    if 0 < max_rate < VIEWER_TICK_RATE:
+        if request.sid not in rate_limited_clients:
+            for device_id in subscribed:
+                leave_room(client_rotation_room(device_id))
+        rate_limited_clients[request.sid] = {
+            'interval': 1.0 / max_rate,
+            'last_sent': 0.0,
+            'sent': {},
+            'streams': {}
+        }
+    elif rate_limited_clients.pop(request.sid, None) is not None and request.sid not in lagging_clients:
+        for device_id in subscribed:
+            join_room(client_rotation_room(device_id))
+
+
+def parse_rotation(data):
+    """
+    Return the float values of an Euler or quaternion rotation payload, None if keys are missing
+
+    Raises:
+        ValueError: A value is not a finite number ("nan" and "inf" parse as floats)
+    """
+    keys = QUATERNION_KEYS if all(key in data for key in QUATERNION_KEYS) else EULER_KEYS
+    if not all(key in data for key in keys):
+        return None
+    values = {key: float(data[key]) for key in keys}
+    if not all(math.isfinite(value) for value in values.values()):
+        raise ValueError('rotation values must be finite')
+    return values
+
+
+def is_number(value):
+    """Whether a JSON value is a number (not a boolean)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def parse_timing(data):
+    """Return the numeric timing fields of a rotation payload"""
+    return {key: float(data[key]) for key in TIMING_KEYS
+            if is_number(data.get(key)) and math.isfinite(data[key])}
+
+
+def unpack_rotation_frames(frames, format='euler'):
+    """Packed rotation frames as a structured array with a 'ts' field and one field per value key"""
+    frame, keys = ROTATION_FRAMES[format]
+    if not isinstance(frames, (bytes, bytearray)):
+        raise TypeError('frames must be binary')
+    if not frames or len(frames) % frame.itemsize:
+        raise ValueError(f'frames length must be a non-zero multiple of {frame.itemsize} bytes')
+    samples = np.frombuffer(frames, dtype=frame)
+    if not all(np.isfinite(samples[key]).all() for key in keys):
+        raise ValueError('rotation values must be finite')
+    return samples, keys
+
+
+def append_rotation_frames(device_id, samples, keys, timing):
+    """Add every sample to the history and queue the latest one for the device's viewers"""
+    # Samples are timed by their ESP32 timestamp relative to the last one;
+    # viewers only ever see the latest sample
+    timestamps = samples['ts'].astype(np.float64)
+    times = timing['server_received_at'] - np.maximum(0.0, timestamps[-1] - timestamps) / 1000.0
+    history.extend(device_id, times.tolist(), timestamps.tolist(), {key: samples[key].tolist() for key in keys})
+    queue_rotation_update(device_id, {**{key: float(samples[key][-1]) for key in keys}, **timing})
+
+
+def get_fusion_pool():
+    """Start the fusion worker pool once, on first use"""
+    global fusion_pool
+    with fusion_pool_lock:
+        if fusion_pool is None:
+            fusion_pool = FusionPool(FUSION_WORKERS)
+            atexit.register(fusion_pool.close)
+    return fusion_pool
+
+
+def fusion_config(device_id):
+    """Server-side fusion config of a device (cached for FUSION_CONFIG_TTL)"""
+    now = time.monotonic()
+    cached = fusion_configs.get(device_id)
+    if cached is None or now - cached[1] >= FUSION_CONFIG_TTL:
+        cached = fusion_configs[device_id] = (store.get_fusion_config(device_id) or DEFAULT_FUSION_CONFIG, now)
+    return cached[0]
+
+
+def record_rotation_received(device_id, timing, samples=1):
+    """Count received samples and record the client-side latency stages"""
+    now = time.time()
+    metrics.count_samples(device_id, samples)
+    metrics.observe_latency('client_queue', timing.get('received_at'), timing.get('sent_at'))
+    metrics.observe_latency('network', timing.get('sent_at'), now)
+    return {**timing, 'server_received_at': now}
+
+
+def queue_rotation_update(device_id, values):
+    """Record a device's latest rotation; the broadcast loop stores and sends it"""
+    with pending_lock:
+        pending_rotations[device_id] = values
+
+
+def flush_rotation_updates():
+    """Store the latest rotation of every changed device and send it to its viewers"""
+    global pending_rotations
+    with pending_lock:
+        dirty, pending_rotations = pending_rotations, {}
+
+    # Rotations read or written this tick, so each device costs one store read
+    # however many rate-limited viewers watch it
+    rotations = {}
+    for device_id, values in dirty.items():
+        # One bad update must not cost the other devices their broadcast
+        try:
+            values['relayed_at'] = time.time()
+            metrics.observe_latency('relay', values.get('server_received_at'), values['relayed_at'])
+            metrics.count_broadcast(device_id)
+            update = {key: values[key] for key in ('ts',) + EULER_KEYS + QUATERNION_KEYS if key in values}
+            values['seq'] = store.append_update(device_id, {**update, 't': values['relayed_at']})
+            rotation = rotations[device_id] = store.set_rotation(device_id, values)
+            socketio.emit('rotation_update', rotation, to=rotation_room(device_id))
+            frame = compact_stream(device_id).encode(values)
+            if frame is not None:
+                socketio.emit('rotation_compact', frame, to=rotation_room(device_id, compact=True))
+        except Exception:
+            logger.exception('Broadcast of %s failed', device_id)
+
+    # Updates lagging viewers miss; they get the latest rotation once they catch up
+    for sid in list(lagging_clients):
+        for device_id in client_devices.get(sid, ()):
+            if device_id in dirty:
+                metrics.count_dropped(device_id)
+
+    now = time.monotonic()
+    for sid, client in list(rate_limited_clients.items()):
+        if now - client['last_sent'] < client['interval'] or sid in lagging_clients:
+            continue
+        client['last_sent'] = now
+        for device_id in list(client_devices.get(sid, ())):
+            rotation = rotations.get(device_id)
+            if rotation is None:
+                rotation = rotations[device_id] = store.get_rotation(device_id)
+            if client['sent'].get(device_id) == rotation:
+                continue
+            client['sent'][device_id] = dict(rotation)
+            if sid in compact_clients:
+                stream = client['streams'].setdefault(device_id, CompactStream(device_id, COMPACT_DEADBAND))
+                frame = stream.encode(rotation)
+                if frame is not None:
+                    socketio.emit('rotation_compact', frame, to=sid)
+            else:
+                socketio.emit('rotation_update', rotation, to=sid)
+
+
+def outbound_queue_depth(sid):
+    """Packets waiting in a client's Engine.IO send queue"""
+    eio_socket = socketio.server.eio.sockets.get(socketio.server.manager.eio_sid_from_sid(sid, '/'))
+    return eio_socket.queue.qsize() if eio_socket is not None else 0
+
+
+def check_slow_consumers():
+    """Pause rotation updates to viewers that fall behind, resume them once caught up, evict stuck ones"""
+    now = time.monotonic()
+    for sid in [sid for sid in client_devices if sid not in publisher_devices]:
+        depth = outbound_queue_depth(sid)
+        since = lagging_clients.get(sid)
+        if since is None:
+            if depth >= OUTBOUND_QUEUE_HIGH:
+                lagging_clients[sid] = now
+                if sid not in rate_limited_clients:
+                    for device_id in client_devices.get(sid, ()):
+                        socketio.server.leave_room(sid, rotation_room(device_id, sid in compact_clients))
+                logger.warning('Slow consumer %s: %d packets queued, pausing rotation updates', sid, depth)
+        elif depth <= OUTBOUND_QUEUE_LOW:
+            del lagging_clients[sid]
+            for device_id in list(client_devices.get(sid, ())):
+                if sid not in rate_limited_clients:
+                    socketio.server.enter_room(sid, rotation_room(device_id, sid in compact_clients))
+                # Latest value wins: the updates missed meanwhile are not sent
+                emit_current_rotation(device_id, sid)
+        elif now - since >= SLOW_CONSUMER_EVICT_AFTER:
+            logger.warning('Slow consumer %s: still %d packets behind after %.0fs, disconnecting',
+                           sid, depth, SLOW_CONSUMER_EVICT_AFTER)
+            metrics.count_evicted()
+            del lagging_clients[sid]
+            socketio.server.disconnect(sid)
+
+
+def load_min_interval(load):
+    """Minimum sample interval (ms) asked of the BLE clients at a server load, 0 for none"""
+    if load < LOAD_THRESHOLD:
+        return 0
+    if load >= 1:
+        return LOAD_MAX_INTERVAL
+    return min(LOAD_MAX_INTERVAL, round(LOAD_BASE_INTERVAL / (1 - load)))
+
+
+def broadcast_loop():
+    """Background task flushing coalesced rotation updates at VIEWER_TICK_RATE"""
+    global server_load, last_backpressure_check
+    tick = 1.0 / VIEWER_TICK_RATE
+    deadline = time.monotonic()
+    last_report = deadline
+    last_summary = deadline
+    last_totals = metrics.totals()
+    while True:
+        started = time.monotonic()
+        # Time the loop woke up late, e.g. because request handlers hogged the workers
+        lag = max(0.0, started - deadline)
+        try:
+            flush_rotation_updates()
+            history.flush_if_due()
+            if started - last_backpressure_check >= BACKPRESSURE_INTERVAL:
+                last_backpressure_check = started
+                check_slow_consumers()
+        except Exception:
+            logger.exception('Broadcast loop error')
+        finished = time.monotonic()
+        server_load += 0.1 * (min(1.0, (finished - started + lag) / tick) - server_load)
+
+        if finished - last_report >= LOAD_REPORT_INTERVAL:
+            last_report = finished
+            if publisher_devices:
+                socketio.emit('server_load', {'load': round(server_load, 3),
+                                              'min_interval': load_min_interval(server_load)},
+                              to='publishers')
+
+        if finished - last_summary >= LOG_SUMMARY_INTERVAL:
+            totals = metrics.totals()
+            elapsed = finished - last_summary
+            logger.info('%d viewer(s), %d publisher(s), %.1f samples/s, %.1f broadcasts/s, load %.2f',
+                        sum(sid not in publisher_devices for sid in client_devices), len(publisher_devices),
+                        (totals[0] - last_totals[0]) / elapsed, (totals[1] - last_totals[1]) / elapsed,
+                        server_load)
+            last_summary, last_totals = finished, totals
+
+        deadline = finished + max(0.0, tick - (finished - started))
+        socketio.sleep(deadline - finished)
+
+
+def ensure_broadcast_task():
+    """Start the broadcast loop once, on first use"""
+    global broadcast_task
+    with broadcast_task_lock:
+        if broadcast_task is None:
+            broadcast_task = socketio.start_background_task(broadcast_loop)
+
 @app.route('/')
 def index():
     """Serve the main HTML page"""
-    response = send_from_directory('static', 'index.html')
-    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-    response.headers['Pragma'] = 'no-cache'
-    response.headers['Expires'] = '0'
-    return response
+    # Always revalidated (cheap 304 via ETag) so page updates show up immediately
+    return send_asset('static', 'index.html', cache_control='no-cache')
+
+@app.route('/api/devices', methods=['GET'])
+def list_devices():
+    """List known devices with their rotation and BLE status"""
+    return jsonify(store.all_devices())
 
 @app.route('/api/rotation', methods=['GET'])
-def get_rotation():
+@app.route('/api/rotation/<device_id>', methods=['GET'])
+def get_rotation(device_id=DEFAULT_DEVICE_ID):
     """Get current rotation angles"""
-    return jsonify(current_rotation)
+    if device_id != DEFAULT_DEVICE_ID and not store.has_device(device_id):
+        return jsonify({'error': f'Unknown device: {device_id}'}), 404
+    return jsonify(store.get_rotation(device_id))
 
 @app.route('/api/rotation', methods=['POST'])
-def set_rotation():
+@app.route('/api/rotation/<device_id>', methods=['POST'])
+def set_rotation(device_id=DEFAULT_DEVICE_ID):
     """Update rotation angles"""
     data = request.json
 
+    try:
+        values = parse_rotation(data)
+    except (ValueError, TypeError):
+        return jsonify({'error': 'Invalid rotation values'}), 400
+
     # Validate input
-    if not all(key in data for key in ['x', 'y', 'z']):
+    if values is None:
         return jsonify({'error': 'Missing rotation parameters'}), 400
 
+    values.update(record_rotation_received(device_id, parse_timing(data)))
+    history.append(device_id, values['server_received_at'], values, values.get('ts'))
+    rotation = store.set_rotation(device_id, values)
+
+    # Push to the device's viewers so REST updates show up live as well
+    ensure_broadcast_task()
+    queue_rotation_update(device_id, dict(values))
+
+    return jsonify({
+        'success': True,
+        'rotation': rotation
+    })
+
+@app.route('/api/history/<device_id>', methods=['GET'])
+def get_history(device_id):
+    """Rotation history of a device: raw samples, or min/max/mean per bucket with ?bucket=<seconds>"""
     try:
-        current_rotation['x'] = float(data['x'])
-        current_rotation['y'] = float(data['y'])
-        current_rotation['z'] = float(data['z'])
-
-        return jsonify({
-            'success': True,
-            'rotation': current_rotation
-        })
+        end = float(request.args.get('end', time.time()))
+        start = float(request.args.get('start', end - DEFAULT_HISTORY_WINDOW))
+        bucket = float(request.args['bucket']) if 'bucket' in request.args else None
+        limit = min(int(request.args.get('limit', MAX_HISTORY_SAMPLES)), MAX_HISTORY_SAMPLES)
     except ValueError:
-        return jsonify({'error': 'Invalid rotation values'}), 400
+        return jsonify({'error': 'Invalid history parameters'}), 400
+
+    if not start <= end or limit <= 0:
+        return jsonify({'error': 'Invalid history range'}), 400
+    result = {'device_id': device_id, 'start': start, 'end': end}
+
+    if bucket is None:
+        rows, truncated = history.query(device_id, start, end, limit)
+        result.update(count=len(rows), truncated=truncated, samples=sample_columns(rows))
+        return jsonify(result)
+
+    if bucket <= 0 or (end - start) / bucket > MAX_HISTORY_BUCKETS:
+        return jsonify({'error': f'bucket must be positive and give at most {MAX_HISTORY_BUCKETS} buckets'}), 400
+    buckets = history.aggregate(device_id, start, end, bucket)
+    result.update(bucket=bucket, buckets=bucket_columns(buckets, start, bucket))
+    return jsonify(result)
+
+def export_range(default_window=None):
+    """(start, end) of an export or summary request, by default the whole history (or default_window seconds)"""
+    end = float(request.args.get('end', time.time()))
+    start = float(request.args.get('start', 0 if default_window is None else end - default_window))
+    if not (math.isfinite(start) and math.isfinite(end)):
+        raise ValueError('start and end must be finite')
+    if not start <= end:
+        raise ValueError('start must not be after end')
+    return start, end
+
+@app.route('/api/export/<device_id>', methods=['GET'])
+def export_history(device_id):
+    """Stream a device's rotation history as CSV, NDJSON or binary columns (?format=...)"""
+    export_format = request.args.get('format', 'csv')
+    if export_format not in EXPORTERS:
+        return jsonify({'error': f"format must be one of {', '.join(EXPORTERS)}"}), 400
+    try:
+        start, end = export_range()
+    except ValueError:
+        return jsonify({'error': 'Invalid export range'}), 400
+
+    chunks = history.iter_rows(device_id, start, end, EXPORT_CHUNK_SIZE)
+    extension = 'bin' if export_format == 'binary' else export_format
+    filename = ''.join(c if c.isalnum() or c in '-_.' else '_' for c in device_id)
+    return Response(stream_with_context(EXPORTERS[export_format](chunks)), mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}.{extension}"'})
+
+@app.route('/api/summary/<device_id>', methods=['GET'])
+def summarize_history(device_id):
+    """Total rotation and moving/stationary segments of a device's rotation history"""
+    try:
+        start, end = export_range(SUMMARY_DEFAULT_WINDOW)
+        summary = MotionSummary(motion_speed=float(request.args.get('motion_speed', 5.0)),
+                                min_segment=float(request.args.get('min_segment', 0.5)))
+    except ValueError:
+        return jsonify({'error': 'Invalid summary parameters'}), 400
+    if end - start > MAX_SUMMARY_SPAN:
+        return jsonify({'error': f'Summary range must not exceed {MAX_SUMMARY_SPAN:g} seconds'}), 400
+
+    for rows in history.iter_rows(device_id, start, end, EXPORT_CHUNK_SIZE):
+        summary.add(rows)
+        socketio.sleep(0)  # Let other requests and the broadcast loop run between chunks
+    return jsonify({'device_id': device_id, 'start': start, 'end': end, **summary.result()})
+
+@app.route('/api/fusion/<device_id>', methods=['GET'])
+def get_fusion_config(device_id):
+    """Server-side fusion config of a device"""
+    return jsonify(store.get_fusion_config(device_id) or DEFAULT_FUSION_CONFIG)
+
+@app.route('/api/fusion/<device_id>', methods=['PUT'])
+def set_fusion_config(device_id):
+    """Change the server-side fusion filter or its parameters; the device's filter restarts"""
+    try:
+        config = normalize_config(request.get_json(silent=True))
+    except (ValueError, TypeError) as e:
+        return jsonify({'error': str(e)}), 400
+
+    store.set_fusion_config(device_id, config)
+    fusion_configs.pop(device_id, None)
+    logger.info('Fusion config [%s]: %s', device_id, config)
+    return jsonify(config)
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Latency histograms, message counters, queue depths and client counts (Prometheus format)"""
+    viewers = [sid for sid in client_devices if sid not in publisher_devices]
+    device_viewers = {}
+    for sid in viewers:
+        for device_id in client_devices.get(sid, ()):
+            device_viewers[device_id] = device_viewers.get(device_id, 0) + 1
+
+    gauges = [
+        ('lego_connected_viewers', 'Connected viewer clients', {(): len(viewers)}),
+        ('lego_connected_publishers', 'Connected BLE clients', {(): len(publisher_devices)}),
+        ('lego_rate_limited_viewers', 'Viewers with a max_rate below the tick rate',
+         {(): len(rate_limited_clients)}),
+        ('lego_lagging_viewers', 'Viewers paused because their send queue is full',
+         {(): len(lagging_clients)}),
+        ('lego_device_viewers', 'Viewers subscribed per device',
+         {(('device_id', device_id),): count for device_id, count in device_viewers.items()}),
+        ('lego_pending_rotations', 'Devices with a rotation waiting for the next broadcast tick',
+         {(): len(pending_rotations)}),
+        ('lego_client_send_queue', 'BLE client send queue depth per device',
+         {(('device_id', device_id),): queue['depth'] for device_id, queue in publisher_queues.items()}),
+        ('lego_client_send_queue_dropped', 'Messages dropped by the BLE client send queue per device',
+         {(('device_id', device_id),): queue['dropped'] for device_id, queue in publisher_queues.items()}),
+        ('lego_sample_interval_ms', 'ESP32 sample interval per device',
+         {(('device_id', device_id),): interval for device_id, interval in sample_intervals.items()}),
+        ('lego_ble_loss_rate', 'Share of recent ESP32 samples lost on the BLE link per device',
+         {(('device_id', device_id),): link['loss_rate'] for device_id, link in link_health.items()
+          if is_number(link.get('loss_rate'))}),
+        ('lego_ble_dt_jitter_p95_ms', '95th percentile deviation of ESP32 sample spacing from the interval',
+         {(('device_id', device_id),): link['dt_jitter_ms']['p95'] for device_id, link in link_health.items()
+          if isinstance(link.get('dt_jitter_ms'), dict) and is_number(link['dt_jitter_ms'].get('p95'))}),
+        ('lego_server_load', 'Smoothed share of each broadcast tick spent flushing or lagging',
+         {(): round(server_load, 3)}),
+    ]
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
 
 @app.route('/health', methods=['GET'])
 def health_check():
@@ -64,35 +752,87 @@ def health_check():
 @socketio.on('connect')
 def handle_connect():
     """Handle client connection"""
-    print(f'Client connected')
-    # Send current rotation and BLE status immediately upon connection
-    emit('rotation_update', current_rotation)
-    emit('ble_status', ble_connection_status)
+    # Viewers pick their brick with ?device_id=...; legacy clients get the default device
+    device_id = request.args.get('device_id') or DEFAULT_DEVICE_ID
+    logger.debug('Client connected (device: %s)', device_id)
+    ensure_broadcast_task()
+    # Slow consumers can ask for fewer updates with ?max_rate=<Hz>, and for
+    # quantized delta frames with ?encoding=compact
+    set_client_rate_limit(request.args.get('max_rate'))
+    if request.args.get('encoding') == 'compact':
+        compact_clients.add(request.sid)
+    subscribe_client(device_id)
+    # Send current rotation and BLE status immediately upon connection, or
+    # only the missed updates to a viewer resuming with ?seq=<last seen seq>
+    resync_client(device_id, parse_seq(request.args.get('seq')))
 
 @socketio.on('disconnect')
 def handle_disconnect():
     """Handle client disconnection"""
-    print('Client disconnected')
-    # If the disconnecting client was the one with BLE connection, update status
-    # Check if this was the BLE client by seeing if it had sent BLE status
-    # Reset BLE status and notify all remaining clients
-    global ble_connection_status
-    if ble_connection_status['connected']:
-        print('BLE client disconnected - resetting BLE status')
-        ble_connection_status['connected'] = False
-        ble_connection_status['device_name'] = None
-        socketio.emit('ble_status', ble_connection_status)
+    logger.debug('Client disconnected')
+    client_devices.pop(request.sid, None)
+    rate_limited_clients.pop(request.sid, None)
+    lagging_clients.pop(request.sid, None)
+    compact_clients.discard(request.sid)
+    # If the disconnecting client was publishing for any devices, reset their
+    # BLE status and notify the viewers of those devices
+    for device_id in publisher_devices.pop(request.sid, ()):
+        publisher_queues.pop(device_id, None)
+        sample_intervals.pop(device_id, None)
+        link_health.pop(device_id, None)
+        if store.get_ble_status(device_id)['connected']:
+            logger.info('BLE client for %s disconnected - resetting BLE status', device_id)
+            status = store.set_ble_status(device_id, False, None)
+            socketio.emit('ble_status', status, to=device_room(device_id))
+
+@socketio.on('subscribe')
+def handle_subscribe(data):
+    """Start receiving updates for a device"""
+    device_id = device_id_from(data)
+    if isinstance(data, dict) and 'max_rate' in data:
+        set_client_rate_limit(data['max_rate'])
+    if isinstance(data, dict) and 'encoding' in data:
+        set_client_encoding(data['encoding'])
+    subscribe_client(device_id)
+    resync_client(device_id, parse_seq(data.get('seq')) if isinstance(data, dict) else None)
+
+@socketio.on('unsubscribe')
+def handle_unsubscribe(data):
+    """Stop receiving updates for a device"""
+    device_id = device_id_from(data)
+    leave_room(device_room(device_id))
+    leave_room(client_rotation_room(device_id))
+    client_devices.get(request.sid, set()).discard(device_id)
+    client = rate_limited_clients.get(request.sid)
+    if client is not None:
+        client['sent'].pop(device_id, None)
+        client['streams'].pop(device_id, None)
 
 @socketio.on('ble_status')
 def handle_ble_status(data):
     """Handle BLE connection status update from client"""
     try:
-        ble_connection_status['connected'] = bool(data.get('connected', False))
-        ble_connection_status['device_name'] = data.get('device_name')
+        device_id = device_id_from(data)
+        was_connected = store.get_ble_status(device_id)['connected']
+        # Link statistics of the BLE client (loss, jitter, see the BLE client's
+        # stream_health.py) are relayed to viewers as part of the status
+        link = data.get('link') if isinstance(data.get('link'), dict) else None
+        status = store.set_ble_status(device_id, bool(data.get('connected', False)),
+                                      data.get('device_name'), link)
+        register_publisher(device_id)
+        if 'send_queue' in data:
+            publisher_queues[device_id] = {'depth': int(data['send_queue']),
+                                           'dropped': int(data.get('send_queue_dropped', 0))}
+        if is_number(data.get('sample_interval')):
+            sample_intervals[device_id] = data['sample_interval']
+        if link is not None:
+            link_health[device_id] = link
 
-        # Broadcast BLE status to all connected clients
-        emit('ble_status', ble_connection_status, broadcast=True)
-        print(f"BLE Status: {'Connected' if ble_connection_status['connected'] else 'Disconnected'}")
+        # Broadcast BLE status to the device's viewers
+        emit('ble_status', status, to=device_room(device_id))
+        # BLE clients re-send their status periodically; only changes are logged at INFO
+        logger.log(logging.INFO if status['connected'] != was_connected else logging.DEBUG,
+                   'BLE Status [%s]: %s', device_id, 'Connected' if status['connected'] else 'Disconnected')
 
     except Exception as e:
         emit('error', {'message': f'Invalid BLE status: {str(e)}'})
@@ -101,21 +841,80 @@ def handle_ble_status(data):
 def handle_rotation_update(data):
     """Handle rotation update from BLE client"""
     try:
-        # Validate input
-        if not all(key in data for key in ['x', 'y', 'z']):
+        # Validate input (Euler x/y/z or quaternion qw/qx/qy/qz)
+        values = parse_rotation(data)
+        if values is None:
             emit('error', {'message': 'Missing rotation parameters'})
             return
 
-        current_rotation['x'] = float(data['x'])
-        current_rotation['y'] = float(data['y'])
-        current_rotation['z'] = float(data['z'])
-
-        # Broadcast to all connected clients (including Unity WebGL)
-        emit('rotation_update', current_rotation, broadcast=True)
+        # Coalesced: the broadcast loop sends the latest value to the device's
+        # viewers (including Unity WebGL) at VIEWER_TICK_RATE
+        device_id = device_id_from(data)
+        values.update(record_rotation_received(device_id, parse_timing(data)))
+        history.append(device_id, values['server_received_at'], values, values.get('ts'))
+        queue_rotation_update(device_id, values)
 
     except (ValueError, TypeError) as e:
         emit('error', {'message': f'Invalid rotation values: {str(e)}'})
 
+@socketio.on('rotation_batch')
+def handle_rotation_batch(data):
+    """Handle a batch of packed binary rotation frames from BLE client"""
+    try:
+        samples, keys = unpack_rotation_frames(data['frames'], data.get('format', 'euler'))
+        device_id = device_id_from(data)
+        timing = record_rotation_received(device_id, {**parse_timing(data), 'ts': float(samples['ts'][-1])},
+                                          samples=len(samples))
+        append_rotation_frames(device_id, samples, keys, timing)
+
+    except (KeyError, ValueError, TypeError) as e:
+        emit('error', {'message': f'Invalid rotation batch: {str(e)}'})
+
+@socketio.on('raw_batch')
+def handle_raw_batch(data):
+    """Handle a batch of raw IMU frames from a BLE client using server-side fusion"""
+    try:
+        frames = data['frames']
+        if not isinstance(frames, (bytes, bytearray)):
+            raise TypeError('frames must be binary')
+        if not frames or len(frames) % RAW_FRAME.size:
+            raise ValueError(f'frames length must be a non-zero multiple of {RAW_FRAME.size} bytes')
+        # Sensor values (all but the leading uint32 timestamp) must be finite
+        if not np.isfinite(np.frombuffer(frames, '<f4').reshape(-1, RAW_FRAME.size // 4)[:, 1:]).all():
+            raise ValueError('sensor values must be finite')
+
+        interval = data.get('interval', DEFAULT_SAMPLE_INTERVAL)
+        if not is_number(interval) or not SAMPLE_INTERVAL_RANGE[0] <= interval <= SAMPLE_INTERVAL_RANGE[1]:
+            raise ValueError('interval must be between %d and %d ms' % SAMPLE_INTERVAL_RANGE)
+
+        device_id = device_id_from(data)
+        timing = record_rotation_received(device_id, parse_timing(data), samples=len(frames) // RAW_FRAME.size)
+
+        def fused(format, output):
+            metrics.observe_latency('fusion', timing['server_received_at'], time.time())
+            if not output:
+                return  # Only duplicate or late frames
+            samples, keys = unpack_rotation_frames(output, format)
+            append_rotation_frames(device_id, samples, keys, {**timing, 'ts': float(samples['ts'][-1])})
+
+        get_fusion_pool().submit(device_id, fusion_config(device_id), bytes(frames), interval, fused)
+
+    except (KeyError, ValueError, TypeError) as e:
+        emit('error', {'message': f'Invalid raw batch: {str(e)}'})
+
+@socketio.on('latency_report')
+def handle_latency_report(data):
+    """Record the delivery/render/total latencies (seconds) measured by a viewer"""
+    if not isinstance(data, dict):
+        return
+    for stage in VIEWER_LATENCY_STAGES:
+        samples = data.get(stage)
+        if isinstance(samples, list):
+            # NaN, infinite or negative values would poison the histogram's sum
+            metrics.observe_durations(stage, [min(value, MAX_REPORTED_LATENCY)
+                                              for value in samples[:MAX_LATENCY_REPORT]
+                                              if is_number(value) and math.isfinite(value) and value >= 0])
+
 @socketio.on('update_timer_interval')
 def handle_timer_interval_update(data):
     """Handle timer interval update request from UI"""
@@ -126,17 +925,22 @@ def handle_timer_interval_update(data):
             emit('error', {'message': 'Timer interval must be between 10 and 1000 ms'})
             return
 
-        # Forward to BLE client
-        emit('update_timer_interval', {'interval': interval}, broadcast=True)
-        print(f"Timer interval update request: {interval}ms")
+        # Forward to the BLE client publishing this device
+        device_id = device_id_from(data)
+        emit('update_timer_interval', {'device_id': device_id, 'interval': interval},
+             to=publisher_room(device_id))
+        logger.info('Timer interval update request [%s]: %dms', device_id, interval)
 
     except (ValueError, TypeError) as e:
         emit('error', {'message': f'Invalid timer interval: {str(e)}'})
 
 @app.route('/webgl/<path:path>')
 def serve_webgl(path):
-    """Serve WebGL files"""
-    return send_from_directory('static/webgl', path)
+    """Serve WebGL files (precompressed, cached, Range-capable)"""
+    return send_asset('static/webgl', path)
 
 if __name__ == '__main__':
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    # Development (threading) runs with the debug reloader; production (gevent) without
+    debug = os.environ.get('FLASK_DEBUG', '1' if ASYNC_MODE == 'threading' else '0') == '1'
+    port = int(os.environ.get('PORT', 5000))
+    socketio.run(app, debug=debug, host='0.0.0.0', port=port)
@@ -0,0 +1,171 @@
+"""Static asset serving for the Unity WebGL build.
+
+Build files are served from disk with:
+- precompressed variants: a requested `.gz` file is sent with
+  `Content-Encoding: gzip` (or its `.br` sibling with `br` when the browser
+  accepts Brotli), and plain files are swapped for a `.br`/`.gz` sibling when
+  one exists
+- strong ETags from a content hash, computed once per file version
+- `immutable` one-year caching for content-hashed file names, revalidation
+  (`no-cache`, answered with 304) for everything else
+- Range requests and `wsgi.file_wrapper`/X-Sendfile through Flask's send_file
+
+Run `python assets.py static/webgl` after a build to create `.gz` (and,
+with the `brotli` package installed, `.br`) siblings of compressible files.
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+import re
+import sys
+import threading
+
+from flask import abort, current_app, request, send_file
+from werkzeug.security import safe_join
+
+# Precompressed variants by preference, as (file suffix, Content-Encoding)
+ENCODINGS = (('.br', 'br'), ('.gz', 'gzip'))
+
+# Content types of Unity WebGL build files, by extension of the uncompressed name
+CONTENT_TYPES = {
+    '.wasm': 'application/wasm',
+    '.data': 'application/octet-stream',
+    '.js': 'application/javascript',
+    '.symbols.json': 'application/octet-stream',
+}
+
+# Unity's "Name Files As Hashes" and most bundlers put a hex content hash in the name
+HASHED_NAME = re.compile(r'(^|[.\-_])[0-9a-f]{16,}([.\-_]|$)')
+
+# Uncompressed files worth precompressing, by extension
+COMPRESSIBLE = ('.js', '.css', '.html', '.json', '.svg', '.wasm', '.data', '.txt')
+PRECOMPRESS_MIN_SIZE = 1024  # Bytes
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+REVALIDATE_CACHE = 'no-cache'
+
+# Strong ETags by (path, size, mtime), so each file version is hashed once
+etags = {}
+etags_lock = threading.Lock()
+
+
+def content_type(name):
+    """Content type of a file by its name without the compression suffix"""
+    for suffix, _ in ENCODINGS:
+        if name.endswith(suffix):
+            name = name[:-len(suffix)]
+    for extension, mimetype in CONTENT_TYPES.items():
+        if name.endswith(extension):
+            return mimetype
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+def accepts(coding):
+    """Whether the client accepts a content coding"""
+    return request.accept_encodings.quality(coding) > 0
+
+
+def select_variant(path):
+    """
+    File to send for a requested path and its Content-Encoding
+
+    Returns:
+        (file path, Content-Encoding or None, True if another variant could have been chosen)
+    """
+    for suffix, coding in ENCODINGS:
+        if path.endswith(suffix):
+            # The name already says how it's compressed (e.g. Unity's .gz URLs);
+            # prefer a Brotli sibling of the same content
+            base = path[:-len(suffix)]
+            if coding != 'br' and accepts('br') and os.path.isfile(base + '.br'):
+                return base + '.br', 'br', True
+            return path, coding, os.path.isfile(base + '.br')
+
+    varies = False
+    for suffix, coding in ENCODINGS:
+        if os.path.isfile(path + suffix):
+            varies = True
+            if accepts(coding):
+                return path + suffix, coding, True
+    return path, None, varies
+
+
+def file_etag(path):
+    """Strong ETag (content hash) of a file, cached per size and modification time"""
+    stat = os.stat(path)
+    key = (path, stat.st_size, stat.st_mtime_ns)
+    with etags_lock:
+        etag = etags.get(key)
+    if etag is None:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        etag = digest.hexdigest()[:32]
+        with etags_lock:
+            etags[key] = etag
+    return etag
+
+
+def send_asset(directory, path, cache_control=None):
+    """
+    Send a static file with precompressed variants, ETag, caching and Range support
+
+    Args:
+        directory: Directory the path is relative to (relative to the app's root)
+        path: Requested file
+        cache_control: Cache-Control header, by default immutable for hashed names
+    """
+    requested = safe_join(os.path.join(current_app.root_path, directory), path)
+    if requested is None or not os.path.isfile(requested):
+        abort(404)
+
+    filename, coding, varies = select_variant(requested)
+    response = send_file(filename, mimetype=content_type(os.path.basename(requested)),
+                         etag=file_etag(filename), conditional=True, max_age=None)
+
+    if coding is not None:
+        response.headers['Content-Encoding'] = coding
+    if varies:
+        response.vary.add('Accept-Encoding')
+    if cache_control is None:
+        cache_control = IMMUTABLE_CACHE if HASHED_NAME.search(os.path.basename(path)) else REVALIDATE_CACHE
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+
+def precompress(directory):
+    """Write .gz (and .br, if brotli is installed) siblings next to compressible build files"""
+    try:
+        import brotli
+    except ImportError:  # Brotli variants are optional
+        brotli = None
+
+    for root, _, names in os.walk(directory):
+        for name in names:
+            path = os.path.join(root, name)
+            if name.endswith('.gz') and brotli is not None and not os.path.exists(path[:-3] + '.br'):
+                # Unity's prebuilt .gz files get a smaller Brotli sibling of the same content
+                with gzip.open(path, 'rb') as f:
+                    data = f.read()
+                write_variant(path[:-3] + '.br', brotli.compress(data))
+                continue
+            if not name.endswith(COMPRESSIBLE) or os.path.getsize(path) < PRECOMPRESS_MIN_SIZE:
+                continue
+            with open(path, 'rb') as f:
+                data = f.read()
+            if not os.path.exists(path + '.gz'):
+                write_variant(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))
+            if brotli is not None and not os.path.exists(path + '.br'):
+                write_variant(path + '.br', brotli.compress(data))
+
+
+def write_variant(path, data):
+    with open(path, 'wb') as f:
+        f.write(data)
+    print(f"✓ {path} ({len(data)} bytes)")
+
+
+if __name__ == '__main__':
+    precompress(sys.argv[1] if len(sys.argv) > 1 else 'static/webgl')
@@ -0,0 +1,412 @@
+"""Load test and latency benchmark for the Flask-SocketIO server.
+
+Starts app.py locally (or targets a running server with --url), connects N
+synthetic BLE publishers sending rotation_update at a fixed rate plus M viewers
+spread over their devices, and reports throughput, publish -> receive latency
+percentiles, missed updates and server CPU/RSS. Usage:
+
+    python benchmark.py --publishers 4 --rate 100 --viewers 200 --duration 20
+    python benchmark.py --async-mode threading --json threading.json
+    python benchmark.py --json current.json --check baseline.json   # exit 1 on regression
+"""
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+
+import aiohttp
+import socketio
+
+try:
+    import psutil
+except ImportError:  # Server CPU/RSS are only reported with psutil installed
+    psutil = None
+
+SERVER_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# The benchmark runs the server without a terminal, which Werkzeug (threading
+# mode) refuses unless explicitly allowed
+SERVER_COMMAND = ("import app; app.socketio.run(app.app, host='127.0.0.1', port={port}, "
+                  "allow_unsafe_werkzeug=True)")
+
+SERVER_START_TIMEOUT = 15.0  # Seconds to wait for /health
+CONNECT_BATCH = 50  # Clients connecting concurrently
+SETTLE_TIME = 1.0  # Seconds after publishers stop for the last updates to arrive
+
+# Metrics compared by --check: (path in the results, True if higher is better)
+CHECKED_METRICS = [
+    (('latency_ms', 'p50'), False),
+    (('latency_ms', 'p99'), False),
+    (('viewer_rate',), True),
+    (('rest', 'rate'), True),
+    (('rest', 'latency_ms', 'p99'), False),
+    (('server', 'cpu_avg'), False),
+    (('server', 'rss_max_mb'), False),
+]
+
+
+def clock():
+    """Benchmark clock; publishers and viewers share it since they run in one process"""
+    return time.perf_counter()
+
+
+def percentiles(values):
+    """p50/p90/p99/max of a list of seconds, in milliseconds"""
+    if not values:
+        return {'p50': None, 'p90': None, 'p99': None, 'max': None}
+    values = sorted(values)
+
+    def at(fraction):
+        return round(values[min(len(values) - 1, int(fraction * len(values)))] * 1000, 3)
+
+    return {'p50': at(0.50), 'p90': at(0.90), 'p99': at(0.99), 'max': round(values[-1] * 1000, 3)}
+
+
+class Publisher:
+    """Synthetic BLE client publishing one device at a fixed rate"""
+    def __init__(self, device_id, rate):
+        self.device_id = device_id
+        self.rate = rate
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.seq = 0  # Sequence number of the last sample sent, carried in 'x'
+        self.sent = 0
+        self.errors = 0
+        self.sio.on('error', self.on_error)
+
+    def on_error(self, data):
+        self.errors += 1
+
+    async def connect(self, url):
+        await self.sio.connect(url, transports=['websocket'])
+        await self.sio.emit('ble_status', {'device_id': self.device_id, 'connected': True,
+                                           'device_name': 'benchmark'})
+
+    async def run(self, stop):
+        """Send rotation_update at self.rate until stop is set"""
+        loop = asyncio.get_running_loop()
+        interval = 1.0 / self.rate
+        next_send = loop.time()
+        while not stop.is_set():
+            self.seq += 1
+            try:
+                # 'x' carries the sequence number and 'y' the send time for the viewers
+                await self.sio.emit('rotation_update', {'device_id': self.device_id,
+                                                        'x': float(self.seq), 'y': clock(), 'z': 0.0})
+                self.sent += 1
+            except Exception:
+                self.errors += 1
+            next_send += interval
+            delay = next_send - loop.time()
+            if delay < -interval:
+                next_send = loop.time()  # Fell behind; don't burst to catch up
+            await asyncio.sleep(max(0.0, delay))
+
+    def reset(self):
+        self.sent = 0
+        self.errors = 0
+
+
+class Viewer:
+    """Synthetic web viewer subscribed to one device"""
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.latencies = []
+        self.received = 0
+        self.last_seq = 0
+        self.sio.on('rotation_update', self.on_rotation_update)
+
+    def on_rotation_update(self, data):
+        # Skip the initial state sent on connect and other devices
+        if data.get('device_id') != self.device_id or data.get('x', 0) < 1:
+            return
+        self.latencies.append(clock() - data['y'])
+        self.received += 1
+        self.last_seq = data['x']
+
+    async def connect(self, url):
+        await self.sio.connect(f'{url}?device_id={self.device_id}', transports=['websocket'])
+
+    def reset(self):
+        self.latencies = []
+        self.received = 0
+
+
+class RestClient:
+    """Polls GET /api/rotation/<device_id> back to back"""
+    def __init__(self, device_id):
+        self.device_id = device_id
+        self.latencies = []
+        self.errors = 0
+
+    async def run(self, session, url, stop):
+        while not stop.is_set():
+            started = clock()
+            try:
+                async with session.get(f'{url}/api/rotation/{self.device_id}') as response:
+                    await response.read()
+                    if response.status != 200:
+                        self.errors += 1
+                        continue
+            except aiohttp.ClientError:
+                self.errors += 1
+                continue
+            self.latencies.append(clock() - started)
+
+    def reset(self):
+        self.latencies = []
+        self.errors = 0
+
+
+class ServerMonitor:
+    """Samples CPU, RSS and thread count of the server process"""
+    def __init__(self, pid):
+        self.process = psutil.Process(pid) if psutil and pid else None
+        self.samples = []
+
+    async def run(self, stop, interval=0.5):
+        if self.process is None:
+            return
+        self.process.cpu_percent()
+        while not stop.is_set():
+            await asyncio.sleep(interval)
+            try:
+                with self.process.oneshot():
+                    self.samples.append((self.process.cpu_percent(),
+                                         self.process.memory_info().rss,
+                                         self.process.num_threads()))
+            except psutil.Error:
+                return
+
+    def reset(self):
+        self.samples = []
+
+    def summary(self):
+        if not self.samples:
+            return None
+        cpu = [sample[0] for sample in self.samples]
+        return {
+            'cpu_avg': round(sum(cpu) / len(cpu), 1),
+            'cpu_max': round(max(cpu), 1),
+            'rss_max_mb': round(max(sample[1] for sample in self.samples) / 2**20, 1),
+            'threads_max': max(sample[2] for sample in self.samples),
+        }
+
+
+def start_server(port, async_mode, tick_rate):
+    """Start app.py in a subprocess"""
+    # Synthetic samples stay in memory instead of the real history database
+    env = dict(os.environ, ASYNC_MODE=async_mode, FLASK_DEBUG='0', HISTORY_DB='')
+    if tick_rate:
+        env['VIEWER_TICK_RATE'] = str(tick_rate)
+    return subprocess.Popen([sys.executable, '-c', SERVER_COMMAND.format(port=port)],
+                            cwd=SERVER_DIR, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+async def wait_for_server(url, server=None):
+    """Poll /health until the server answers"""
+    deadline = clock() + SERVER_START_TIMEOUT
+    async with aiohttp.ClientSession() as session:
+        while clock() < deadline:
+            if server is not None and server.poll() is not None:
+                raise RuntimeError(f'Server exited with code {server.returncode}')
+            try:
+                async with session.get(f'{url}/health') as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f'Server at {url} did not become healthy')
+
+
+async def connect_all(clients, url):
+    """Connect clients CONNECT_BATCH at a time; returns the number that failed"""
+    failures = 0
+    for start in range(0, len(clients), CONNECT_BATCH):
+        results = await asyncio.gather(*(client.connect(url) for client in clients[start:start + CONNECT_BATCH]),
+                                       return_exceptions=True)
+        failures += sum(isinstance(result, Exception) for result in results)
+    return failures
+
+
+async def run_benchmark(args, url, server_pid=None):
+    """Run one load test against url and return the results"""
+    device_ids = [f'bench-{index}' for index in range(args.publishers)]
+    publishers = [Publisher(device_id, args.rate) for device_id in device_ids]
+    viewers = [Viewer(device_ids[index % len(device_ids)]) for index in range(args.viewers)]
+    rest_clients = [RestClient(device_ids[index % len(device_ids)]) for index in range(args.rest_clients)]
+    monitor = ServerMonitor(server_pid)
+
+    connect_started = clock()
+    connect_failures = await connect_all(publishers, url) + await connect_all(viewers, url)
+    connect_time = clock() - connect_started
+    print(f"Connected {len(publishers)} publisher(s) and {len(viewers)} viewer(s) "
+          f"in {connect_time:.1f}s ({connect_failures} failed)")
+
+    stop = asyncio.Event()
+    async with aiohttp.ClientSession() as session:
+        tasks = [asyncio.create_task(publisher.run(stop)) for publisher in publishers
+                 if publisher.sio.connected]
+        tasks += [asyncio.create_task(client.run(session, url, stop)) for client in rest_clients]
+        tasks.append(asyncio.create_task(monitor.run(stop)))
+
+        # Measure after the warmup only
+        await asyncio.sleep(args.warmup)
+        for client in publishers + viewers + rest_clients + [monitor]:
+            client.reset()
+        measure_started = clock()
+        await asyncio.sleep(args.duration)
+        duration = clock() - measure_started
+
+        stop.set()
+        await asyncio.gather(*tasks)
+        await asyncio.sleep(SETTLE_TIME)
+
+    # Every viewer should end up with the last sample of its device
+    last_seq = {publisher.device_id: publisher.seq for publisher in publishers}
+    stale_viewers = sum(viewer.sio.connected and viewer.last_seq != last_seq[viewer.device_id]
+                        for viewer in viewers)
+    disconnected = sum(not client.sio.connected for client in publishers + viewers)
+
+    await asyncio.gather(*(client.sio.disconnect() for client in publishers + viewers
+                           if client.sio.connected), return_exceptions=True)
+
+    published = sum(publisher.sent for publisher in publishers)
+    delivered = sum(viewer.received for viewer in viewers)
+    rest_latencies = [latency for client in rest_clients for latency in client.latencies]
+    return {
+        'config': {
+            'publishers': args.publishers,
+            'rate': args.rate,
+            'viewers': args.viewers,
+            'rest_clients': args.rest_clients,
+            'duration': args.duration,
+            'async_mode': args.async_mode if server_pid else None,
+        },
+        'connect_time': round(connect_time, 2),
+        'connect_failures': connect_failures,
+        'disconnected': disconnected,
+        'published': published,
+        'publish_rate': round(published / duration, 1),
+        'delivered': delivered,
+        'delivery_rate': round(delivered / duration, 1),
+        'viewer_rate': round(delivered / duration / len(viewers), 2) if viewers else None,
+        'latency_ms': percentiles([latency for viewer in viewers for latency in viewer.latencies]),
+        'stale_viewers': stale_viewers,
+        'errors': sum(publisher.errors for publisher in publishers),
+        'rest': {
+            'requests': len(rest_latencies),
+            'rate': round(len(rest_latencies) / duration, 1),
+            'errors': sum(client.errors for client in rest_clients),
+            'latency_ms': percentiles(rest_latencies),
+        } if rest_clients else None,
+        'server': monitor.summary(),
+    }
+
+
+def print_results(results):
+    """Print a human-readable summary"""
+    latency = results['latency_ms']
+    print("=" * 80)
+    print(f"Published:  {results['published']} updates ({results['publish_rate']}/s), "
+          f"{results['errors']} error(s)")
+    print(f"Delivered:  {results['delivered']} updates ({results['delivery_rate']}/s, "
+          f"{results['viewer_rate']}/s per viewer)")
+    print(f"Latency:    p50 {latency['p50']} ms, p90 {latency['p90']} ms, "
+          f"p99 {latency['p99']} ms, max {latency['max']} ms")
+    print(f"Missed:     {results['stale_viewers']} viewer(s) without the final update, "
+          f"{results['connect_failures']} failed connection(s), {results['disconnected']} disconnected")
+    rest = results['rest']
+    if rest:
+        print(f"REST:       {rest['requests']} requests ({rest['rate']}/s), {rest['errors']} error(s), "
+              f"p50 {rest['latency_ms']['p50']} ms, p99 {rest['latency_ms']['p99']} ms")
+    server = results['server']
+    if server:
+        print(f"Server:     CPU {server['cpu_avg']}% avg / {server['cpu_max']}% max, "
+              f"RSS {server['rss_max_mb']} MB, {server['threads_max']} thread(s)")
+    print("=" * 80)
+
+
+def metric(results, path):
+    """Value at a path of nested result keys, None if absent"""
+    for key in path:
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+
+def check_regressions(results, baseline, tolerance):
+    """Compare results with a baseline; True when no metric got worse by more than tolerance"""
+    if results['config'] != baseline.get('config'):
+        print(f"⚠ Baseline was measured with a different configuration: {baseline.get('config')}")
+    ok = True
+    for path, higher_is_better in CHECKED_METRICS:
+        current, expected = metric(results, path), metric(baseline, path)
+        if current is None or expected is None:
+            continue
+        if higher_is_better:
+            regressed = current < expected * (1 - tolerance)
+        else:
+            regressed = current > expected * (1 + tolerance)
+        ok = ok and not regressed
+        print(f"{'✗' if regressed else '✓'} {'.'.join(path)}: {current} (baseline {expected})")
+    return ok
+
+
+async def main_async(args):
+    server = None
+    url = args.url
+    if url is None:
+        url = f'http://127.0.0.1:{args.port}'
+        server = start_server(args.port, args.async_mode, args.tick_rate)
+    try:
+        await wait_for_server(url, server)
+        return await run_benchmark(args, url, server.pid if server else None)
+    finally:
+        if server is not None:
+            server.terminate()
+            server.wait()
+
+
+def main():
+    """Entry point"""
+    parser = argparse.ArgumentParser(description='Load test the LEGO rotation server')
+    parser.add_argument('--publishers', type=int, default=1, help='Synthetic BLE clients, one device each')
+    parser.add_argument('--rate', type=float, default=100, help='rotation_update rate per publisher (Hz)')
+    parser.add_argument('--viewers', type=int, default=100, help='Viewer clients, spread over the devices')
+    parser.add_argument('--rest-clients', type=int, default=0, help='Clients polling GET /api/rotation')
+    parser.add_argument('--duration', type=float, default=10, help='Measured seconds')
+    parser.add_argument('--warmup', type=float, default=2, help='Seconds of load before measuring')
+    parser.add_argument('--url', help='Benchmark a running server instead of starting one')
+    parser.add_argument('--port', type=int, default=5099, help='Port of the started server')
+    parser.add_argument('--async-mode', default='gevent', choices=['gevent', 'threading'],
+                        help='ASYNC_MODE of the started server')
+    parser.add_argument('--tick-rate', type=float, help='VIEWER_TICK_RATE of the started server')
+    parser.add_argument('--json', metavar='FILE', help='Write the results as JSON')
+    parser.add_argument('--check', metavar='FILE', help='Fail when results regress against a JSON baseline')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed relative regression (default 20%%)')
+    args = parser.parse_args()
+    if args.publishers < 1:
+        parser.error('--publishers must be at least 1')
+
+    results = asyncio.run(main_async(args))
+    print_results(results)
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.check:
+        with open(args.check) as f:
+            baseline = json.load(f)
+        if not check_regressions(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
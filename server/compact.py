@@ -0,0 +1,109 @@
+"""Compact rotation encoding for viewers that negotiate it (?encoding=compact).
+
+Instead of full rotation objects, compact viewers get 'rotation_compact'
+events carrying short JSON arrays:
+
+    [device_id, kind, v1, v2, v3(, v4)]
+
+kind 0/1 is an Euler keyframe/delta, 2/3 a quaternion keyframe/delta. Euler
+angles are quantized to integer centidegrees wrapped to [-180°, 180°) and
+quaternion components to integers scaled by 32767, both within int16 range.
+Keyframes carry the quantized values, deltas the difference to the previous
+frame of the stream (Euler deltas wrap around ±180°). Changes within the
+dead-band of the last frame are not sent at all, and every
+KEYFRAME_INTERVAL-th frame is a keyframe so viewers resynchronize.
+"""
+import math
+
+EULER_KEYS = ('x', 'y', 'z')
+QUATERNION_KEYS = ('qw', 'qx', 'qy', 'qz')
+
+EULER_SCALE = 100  # Centidegrees
+QUATERNION_SCALE = 32767
+FULL_TURN = 360 * EULER_SCALE
+
+EULER_KEYFRAME, EULER_DELTA, QUATERNION_KEYFRAME, QUATERNION_DELTA = range(4)
+
+KEYFRAME_INTERVAL = 30  # Frames (one second at the default viewer tick rate)
+
+
+def wrap_centidegrees(value):
+    """Wrap an angle in centidegrees to [-18000, 18000)"""
+    return (value + FULL_TURN // 2) % FULL_TURN - FULL_TURN // 2
+
+
+def quantize(values):
+    """(True if quaternion, tuple of ints) of a rotation's Euler or quaternion values"""
+    if all(key in values for key in QUATERNION_KEYS):
+        return True, tuple(max(-QUATERNION_SCALE, min(QUATERNION_SCALE, round(values[key] * QUATERNION_SCALE)))
+                           for key in QUATERNION_KEYS)
+    return False, tuple(wrap_centidegrees(round(values[key] * EULER_SCALE)) for key in EULER_KEYS)
+
+
+class CompactStream:
+    """Encoder of one device's rotations for one audience (a room or a single viewer)"""
+    def __init__(self, device_id, deadband=0.1):
+        """
+        Args:
+            device_id: Device the frames belong to
+            deadband: Rotation change (degrees) below which nothing is sent
+        """
+        self.device_id = device_id
+        self.euler_deadband = max(1, round(deadband * EULER_SCALE))
+        self.quaternion_deadband = max(1, round(QUATERNION_SCALE * math.sin(math.radians(deadband) / 2)))
+        self.quaternion = False
+        self.last = None  # Quantized values of the last frame
+        self.since_keyframe = 0
+
+    def encode(self, values, keyframe=False):
+        """Frame for a new rotation, None when it is within the dead-band of the last frame"""
+        quaternion, quantized = quantize(values)
+        if self.last is None or quaternion != self.quaternion:
+            keyframe = True
+
+        if not keyframe:
+            deltas = [new - old for new, old in zip(quantized, self.last)]
+            if not quaternion:
+                deltas = [wrap_centidegrees(delta) for delta in deltas]
+            deadband = self.quaternion_deadband if quaternion else self.euler_deadband
+            if max(abs(delta) for delta in deltas) < deadband:
+                return None
+            if self.since_keyframe + 1 < KEYFRAME_INTERVAL:
+                self.since_keyframe += 1
+                self.last = quantized
+                return [self.device_id, QUATERNION_DELTA if quaternion else EULER_DELTA, *deltas]
+
+        self.quaternion = quaternion
+        self.last = quantized
+        self.since_keyframe = 0
+        return [self.device_id, QUATERNION_KEYFRAME if quaternion else EULER_KEYFRAME, *quantized]
+
+    def keyframe(self):
+        """Keyframe of the last frame, for a viewer joining the stream; None before the first frame"""
+        if self.last is None:
+            return None
+        return [self.device_id, QUATERNION_KEYFRAME if self.quaternion else EULER_KEYFRAME, *self.last]
+
+
+class CompactDecoder:
+    """Rebuilds rotation dicts from compact frames, for Python viewers"""
+    def __init__(self):
+        self.last = {}  # device_id -> quantized values of the last frame
+
+    def decode(self, frame):
+        """Rotation dict of a frame, None for a delta received before any keyframe"""
+        device_id, kind, *numbers = frame
+        quaternion = kind in (QUATERNION_KEYFRAME, QUATERNION_DELTA)
+        if kind in (EULER_DELTA, QUATERNION_DELTA):
+            previous = self.last.get(device_id)
+            if previous is None:
+                return None
+            numbers = [old + delta for old, delta in zip(previous, numbers)]
+            if not quaternion:
+                numbers = [wrap_centidegrees(value) for value in numbers]
+        self.last[device_id] = numbers
+
+        if quaternion:
+            return {'device_id': device_id,
+                    **{key: value / QUATERNION_SCALE for key, value in zip(QUATERNION_KEYS, numbers)}}
+        return {'device_id': device_id, **{key: value / EULER_SCALE for key, value in zip(EULER_KEYS, numbers)}}
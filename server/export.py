@@ -0,0 +1,284 @@
+"""Bulk export and motion summaries of a device's rotation history.
+
+Exports are generators over the history's row chunks (see
+RotationHistory.iter_rows), so a response of any length is streamed in
+constant memory. Formats:
+
+- csv: header line, then one line per sample; missing values are empty
+- ndjson: one JSON object per sample; missing values are left out
+- binary: columnar blocks, read back with read_binary_export:
+
+      b'LGX1', uint8 column count, per column: uint8 name length, name, type
+      ('d' float64 or 'f' float32); then blocks of uint32 row count followed
+      by each column's values, little-endian, missing values NaN; a block
+      with row count 0 ends the stream
+
+Summaries are computed in one pass over the same chunks: the total
+rotation, peak angular speed, and the moving / stationary segments. Speeds
+use the ESP32 timestamp steps where samples have them.
+"""
+import json
+import math
+import struct
+import sys
+from array import array
+
+from history import HISTORY_KEYS
+
+COLUMNS = ('t', 'ts') + HISTORY_KEYS
+BINARY_MAGIC = b'LGX1'
+BINARY_TYPES = ('d', 'd') + ('f',) * len(HISTORY_KEYS)  # t and ts need float64
+
+EXPORT_FORMATS = {
+    'csv': 'text/csv',
+    'ndjson': 'application/x-ndjson',
+    'binary': 'application/octet-stream',
+}
+
+EULER_SLICE = slice(2, 5)  # x, y, z in a row
+QUATERNION_SLICE = slice(5, 9)  # qw, qx, qy, qz in a row
+
+TIMESTAMP_WRAP = 1 << 32  # ESP32 timestamps ('ts') are uint32 milliseconds
+MIN_STEP = 0.001  # Shortest time step (s) a speed is computed over
+
+
+def present(value):
+    return value is not None and not math.isnan(value)
+
+
+def csv_export(chunks):
+    """CSV text chunks of history row chunks"""
+    yield ','.join(COLUMNS) + '\n'
+    for rows in chunks:
+        lines = []
+        for row in rows:
+            t, ts, *values = row
+            fields = ['%.6f' % t, '%.10g' % ts if present(ts) else '']
+            fields.extend('%.7g' % value if present(value) else '' for value in values)
+            lines.append(','.join(fields))
+        yield '\n'.join(lines) + '\n'
+
+
+def ndjson_export(chunks):
+    """Newline-delimited JSON chunks of history row chunks"""
+    for rows in chunks:
+        lines = []
+        for row in rows:
+            sample = {'t': row[0]}
+            for name, value in zip(COLUMNS[1:], row[1:]):
+                if present(value):
+                    sample[name] = float('%.10g' % value) if name == 'ts' else float('%.7g' % value)
+            lines.append(json.dumps(sample, separators=(',', ':')))
+        yield '\n'.join(lines) + '\n'
+
+
+def binary_export(chunks):
+    """Columnar binary blocks of history row chunks"""
+    header = bytearray(BINARY_MAGIC)
+    header.append(len(COLUMNS))
+    for name, kind in zip(COLUMNS, BINARY_TYPES):
+        header.append(len(name))
+        header.extend(name.encode())
+        header.extend(kind.encode())
+    yield bytes(header)
+
+    for rows in chunks:
+        block = bytearray(struct.pack('<I', len(rows)))
+        for index, kind in enumerate(BINARY_TYPES):
+            column = array(kind, (math.nan if row[index] is None else row[index] for row in rows))
+            if sys.byteorder == 'big':
+                column.byteswap()
+            block.extend(column.tobytes())
+        yield bytes(block)
+    yield struct.pack('<I', 0)
+
+
+EXPORTERS = {
+    'csv': csv_export,
+    'ndjson': ndjson_export,
+    'binary': binary_export,
+}
+
+
+def read_binary_export(data):
+    """
+    Decode a binary export
+
+    Returns:
+        {column name: list of values}, missing values as NaN
+    Raises:
+        ValueError: Not a complete binary export
+    """
+    if data[:4] != BINARY_MAGIC:
+        raise ValueError('Not a binary export')
+    offset = 5
+    columns = []
+    for _ in range(data[4]):
+        length = data[offset]
+        columns.append((data[offset + 1:offset + 1 + length].decode(), chr(data[offset + 1 + length])))
+        offset += length + 2
+
+    result = {name: [] for name, _ in columns}
+    while True:
+        if offset + 4 > len(data):
+            raise ValueError('Truncated binary export')
+        count, = struct.unpack_from('<I', data, offset)
+        offset += 4
+        if count == 0:
+            return result
+        for name, kind in columns:
+            column = array(kind)
+            size = column.itemsize * count
+            if offset + size > len(data):
+                raise ValueError('Truncated binary export')
+            column.frombytes(data[offset:offset + size])
+            if sys.byteorder == 'big':
+                column.byteswap()
+            result[name].extend(column)
+            offset += size
+
+
+def wrap_degrees(angle):
+    """Wrap an angle difference to [-180, 180)"""
+    return (angle + 180.0) % 360.0 - 180.0
+
+
+def step_time(previous, row):
+    """
+    Seconds between two samples: from the ESP32 timestamps when both have one
+    (server times of batched samples are back-dated and may only differ by
+    the history's tie-break step), otherwise from the server times
+
+    Returns:
+        Time step, None if the device timestamps go backwards
+    """
+    if present(previous[1]) and present(row[1]):
+        delta = (int(row[1]) - int(previous[1])) % TIMESTAMP_WRAP
+        if delta >= TIMESTAMP_WRAP // 2:
+            return None  # Out of order or the ESP32 restarted
+        return delta / 1000.0
+    return row[0] - previous[0]
+
+
+def step_rotation(previous, row):
+    """
+    Rotation (degrees) between two samples, None if they aren't comparable
+
+    Returns:
+        (total angle, (x, y, z) changes or None)
+    """
+    q0, q1 = previous[QUATERNION_SLICE], row[QUATERNION_SLICE]
+    if all(map(present, q0)) and all(map(present, q1)):
+        dot = min(1.0, abs(sum(a * b for a, b in zip(q0, q1))))
+        return math.degrees(2 * math.acos(dot)), None
+    e0, e1 = previous[EULER_SLICE], row[EULER_SLICE]
+    if all(map(present, e0)) and all(map(present, e1)):
+        deltas = tuple(wrap_degrees(b - a) for a, b in zip(e0, e1))
+        # Small steps: the rotation angle is about the length of the Euler change
+        return math.sqrt(sum(delta * delta for delta in deltas)), deltas
+    return None
+
+
+class MotionSummary:
+    """Total rotation and moving / stationary segments of a stream of history rows"""
+    def __init__(self, motion_speed=5.0, min_segment=0.5, max_gap=1.0):
+        """
+        Args:
+            motion_speed: Angular speed (°/s) from which the brick counts as moving
+            min_segment: Seconds a new state must last before it starts a segment
+            max_gap: Seconds without samples that end the current segment
+        Raises:
+            ValueError: A parameter is negative or not finite
+        """
+        for name, value in (('motion_speed', motion_speed), ('min_segment', min_segment), ('max_gap', max_gap)):
+            if not (math.isfinite(value) and value >= 0):
+                raise ValueError(f'{name} must be a non-negative number')
+        self.motion_speed = motion_speed
+        self.min_segment = min_segment
+        self.max_gap = max_gap
+
+        self.samples = 0
+        self.first = None
+        self.previous = None
+        self.total_rotation = 0.0
+        self.axis_rotation = [0.0, 0.0, 0.0]
+        self.peak_speed = 0.0
+        self.segments = []
+        self.segment = None  # Open segment: {'state', 'start', 'end', 'rotation'}
+        self.change = None  # (start time, rotation) of a state change not yet min_segment long
+
+    def add(self, rows):
+        """Feed a chunk of (t, ts, *HISTORY_KEYS values) rows, oldest first"""
+        for row in rows:
+            self.samples += 1
+            previous, self.previous = self.previous, row
+            if previous is None:
+                self.first = row[0]
+                continue
+            dt = step_time(previous, row)
+            if dt is None or dt > self.max_gap or row[0] - previous[0] > self.max_gap:
+                self._close()
+                continue
+            step = step_rotation(previous, row)
+            if step is None:
+                continue
+            angle, deltas = step
+            self.total_rotation += angle
+            if deltas is not None:
+                for axis, delta in enumerate(deltas):
+                    self.axis_rotation[axis] += abs(delta)
+            if dt < MIN_STEP:
+                # Samples with (nearly) equal times, e.g. repeated ones, only add rotation
+                if self.segment is not None:
+                    self.segment['rotation'] += angle
+                continue
+
+            speed = angle / dt
+            self.peak_speed = max(self.peak_speed, speed)
+            self._track('moving' if speed >= self.motion_speed else 'stationary', previous[0], row[0], angle)
+
+    def _track(self, state, start, end, angle):
+        segment = self.segment
+        if segment is None:
+            self.segment = {'state': state, 'start': start, 'end': end, 'rotation': angle}
+            return
+        segment['end'] = end
+        segment['rotation'] += angle
+        if state == segment['state']:
+            self.change = None
+            return
+        if self.change is None:
+            self.change = (start, 0.0)
+        self.change = (self.change[0], self.change[1] + angle)
+        if end - self.change[0] >= self.min_segment:
+            # The new state held long enough: it starts a segment where it began
+            change_start, change_rotation = self.change
+            segment['end'] = change_start
+            segment['rotation'] -= change_rotation
+            self.segments.append(segment)
+            self.segment = {'state': state, 'start': change_start, 'end': end, 'rotation': change_rotation}
+            self.change = None
+
+    def _close(self):
+        if self.segment is not None:
+            self.segments.append(self.segment)
+        self.segment = None
+        self.change = None
+
+    def result(self):
+        """JSON-ready summary"""
+        self._close()
+        durations = {'moving': 0.0, 'stationary': 0.0}
+        for segment in self.segments:
+            durations[segment['state']] += segment['end'] - segment['start']
+        return {
+            'samples': self.samples,
+            'first': self.first,
+            'last': self.previous[0] if self.previous is not None else None,
+            'total_rotation': round(self.total_rotation, 3),
+            'axis_rotation': dict(zip(('x', 'y', 'z'), (round(value, 3) for value in self.axis_rotation))),
+            'peak_speed': round(self.peak_speed, 3),
+            'moving_time': round(durations['moving'], 3),
+            'stationary_time': round(durations['stationary'], 3),
+            'segments': [{**segment, 'rotation': round(segment['rotation'], 3)} for segment in self.segments],
+        }
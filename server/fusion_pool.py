@@ -0,0 +1,192 @@
+"""Server-side sensor fusion of raw IMU frames.
+
+BLE clients running with SERVER_FUSION send the ESP32's raw 28-byte
+SensorData notifications in 'raw_batch' events instead of fused rotations.
+The server runs the filter configured for each device and turns every batch
+into the same packed frames a 'rotation_batch' would carry.
+
+Fusion runs in a pool of worker processes so it scales across cores. Each
+device is pinned to one worker (by a hash of its id), which keeps the device's
+filter state and processes its batches in arrival order. With no workers,
+batches are fused inline in the calling process.
+
+Time steps follow the BLE client's StreamHealth rules: uint32 timestamp
+wrap-around, duplicate and late frames dropped, gaps clamped to a few sample
+intervals, and one interval for the first frame of a stream.
+
+fusion.py and stream_health.py are vendored copies of the BLE client's
+modules, so both sides fuse identically; test_fusion_pool.py checks that the
+copies match ../ble_client.
+"""
+import logging
+import math
+import struct
+import zlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from fusion import SENSOR_DTYPE, FusionEngine, MadgwickFilter, complementary_convention
+from stream_health import StreamHealth
+
+logger = logging.getLogger('server.fusion')
+
+# One raw SensorData notification: uint32 timestamp (ms) + acc x/y/z + gyro x/y/z
+RAW_FRAME = struct.Struct('<I6f')
+
+# Sample interval (ms) assumed for 'raw_batch' events that don't carry one,
+# and the accepted range (the ESP32 timer's)
+DEFAULT_SAMPLE_INTERVAL = 100
+SAMPLE_INTERVAL_RANGE = (10, 1000)
+
+# Filters and their parameters with defaults (the BLE client's defaults)
+FILTERS = {
+    'complementary': {'alpha': 0.98, 'gyro_deadband': 3.0},
+    'madgwick': {'beta': 0.1, 'gyro_deadband': 3.0},
+}
+
+# Output frames per filter: ('rotation_batch' format, frame layout)
+OUTPUT_FRAMES = {
+    'complementary': ('euler', struct.Struct('<I3f')),
+    'madgwick': ('quaternion', struct.Struct('<I4f')),
+}
+
+# (output axis, sensor axis index, inverted) as in the BLE client's AXIS_MAPPING
+AXIS_MAPPING = (
+    ('x', 0, False),  # Pitch (front/back tilt)
+    ('y', 2, False),  # Yaw (rotation)
+    ('z', 1, True),  # Roll (left/right tilt)
+)
+
+
+def normalize_config(config):
+    """
+    Complete and validate a fusion config
+
+    Args:
+        config: {'filter': name, <parameter>: value, ...}; missing entries get defaults
+    Returns:
+        {'filter': name, **parameters}
+    Raises:
+        ValueError: Unknown filter or parameter, or an invalid value
+    """
+    config = dict(config or {})
+    name = config.pop('filter', 'complementary')
+    if name not in FILTERS:
+        raise ValueError(f"Unknown filter '{name}', expected one of {', '.join(FILTERS)}")
+    parameters = dict(FILTERS[name])
+    for key, value in config.items():
+        if key not in parameters:
+            raise ValueError(f"Unknown parameter '{key}' for the {name} filter")
+        if not isinstance(value, (int, float)) or isinstance(value, bool) or not math.isfinite(value):
+            raise ValueError(f"'{key}' must be a number")
+        parameters[key] = float(value)
+    if not 0 <= parameters.get('alpha', 0) <= 1:
+        raise ValueError("'alpha' must be between 0 and 1")
+    if parameters.get('beta', 0) < 0 or parameters['gyro_deadband'] < 0:
+        raise ValueError('Filter parameters must not be negative')
+    return {'filter': name, **parameters}
+
+
+class DeviceFusion:
+    """Filter state of one device"""
+    def __init__(self, config, interval=DEFAULT_SAMPLE_INTERVAL):
+        self.config = config
+        self.format, self.frame = OUTPUT_FRAMES[config['filter']]
+        self.health = StreamHealth(interval)
+        if config['filter'] == 'madgwick':
+            self.filter = MadgwickFilter(beta=config['beta'], gyro_deadband=config['gyro_deadband'])
+        else:
+            self.engine = FusionEngine(alpha=config['alpha'], gyro_deadband=config['gyro_deadband'])
+
+    def process(self, frames, interval=DEFAULT_SAMPLE_INTERVAL):
+        """Packed output frames for a block of raw frames; duplicate and late frames are left out"""
+        samples = np.frombuffer(frames, dtype=SENSOR_DTYPE)
+        self.health.set_interval(interval)
+        keep = np.ones(len(samples), dtype=bool)
+        dt = np.empty(len(samples))
+        for index, timestamp in enumerate(samples['timestamp'].tolist()):
+            timestep = self.health.timestep(timestamp)
+            if timestep is None:
+                keep[index] = False
+            else:
+                dt[index] = timestep[1]
+        if not keep.all():
+            samples, dt = samples[keep], dt[keep]
+            if not len(samples):
+                return b''
+        if self.config['filter'] == 'madgwick':
+            return self._madgwick(samples, dt)
+
+        angles = self.engine.process(samples, dt)
+        output = np.empty(len(samples), dtype=[('ts', '<u4'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+        output['ts'] = samples['timestamp']
+        for key, sensor_axis, invert in AXIS_MAPPING:
+            output[key] = -angles[:, sensor_axis] if invert else angles[:, sensor_axis]
+        return output.tobytes()
+
+    def _madgwick(self, samples, dt):
+        out = bytearray()
+        for sample, step in zip(samples.tolist(), dt.tolist()):
+            timestamp, acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z = sample
+            quaternion = self.filter.update(acc_x, acc_y, acc_z, gyro_x, gyro_y, gyro_z, dt=step)
+            qw, *vector = complementary_convention(quaternion)
+            mapped = [-vector[sensor_axis] if invert else vector[sensor_axis]
+                      for _, sensor_axis, invert in AXIS_MAPPING]
+            out.extend(self.frame.pack(timestamp, qw, *mapped))
+        return bytes(out)
+
+
+# Filter state of the devices fused by this process, by device id
+devices = {}
+
+
+def fuse(device_id, config, frames, interval=DEFAULT_SAMPLE_INTERVAL):
+    """
+    Fuse a batch of raw frames of a device, restarting its filter when the config changed
+
+    Args:
+        interval: Sample interval (ms) the brick is configured with
+    Returns:
+        ('rotation_batch' format, packed frames); no frames if all were dropped
+    """
+    device = devices.get(device_id)
+    if device is None or device.config != config:
+        device = devices[device_id] = DeviceFusion(config, interval)
+    return device.format, device.process(frames, interval)
+
+
+class FusionPool:
+    """Worker processes fusing raw frames, each device pinned to one worker"""
+    def __init__(self, workers=0):
+        """
+        Args:
+            workers: Worker processes, 0 to fuse inline in this process
+        """
+        self.shards = [ProcessPoolExecutor(max_workers=1) for _ in range(workers)]
+
+    def shard(self, device_id):
+        return self.shards[zlib.crc32(device_id.encode()) % len(self.shards)]
+
+    def submit(self, device_id, config, frames, interval, callback):
+        """
+        Fuse a batch and call callback(format, frames) with the result: right away
+        without workers, otherwise from the pool's result thread, in batch order per device
+        """
+        if not self.shards:
+            callback(*fuse(device_id, config, frames, interval))
+            return
+
+        def done(future):
+            try:
+                result = future.result()
+            except Exception as e:
+                logger.error('Fusion error [%s]: %s', device_id, e)
+                return
+            callback(*result)
+
+        self.shard(device_id).submit(fuse, device_id, config, frames, interval).add_done_callback(done)
+
+    def close(self):
+        for shard in self.shards:
+            shard.shutdown(cancel_futures=True)
@@ -0,0 +1,344 @@
+"""Per-device rotation history for the Flask server.
+
+Recent samples of each device are kept in a fixed-size in-memory ring
+buffer (one compact array per column). Every sample is also appended, in
+batches, to a SQLite database, which holds the history beyond the ring and
+survives restarts. Range queries are served from the ring when it covers
+the range, and otherwise from SQLite plus the ring. Downsampled queries
+return min/max/mean per time bucket.
+"""
+import math
+import sqlite3
+import threading
+import time
+from array import array
+from itertools import accumulate, chain, repeat
+
+# Value columns of a sample: Euler angles or quaternion, the other set is NaN/NULL
+HISTORY_KEYS = ('x', 'y', 'z', 'qw', 'qx', 'qy', 'qz')
+
+FLUSH_INTERVAL = 1.0  # Seconds between writes of pending samples to SQLite
+PRUNE_INTERVAL = 60.0  # Seconds between deletions of samples older than the retention
+
+# Minimum time step between samples of a device. Times are kept strictly
+# increasing, so no sample shares its time with one already evicted from the ring
+TIME_STEP = 1e-6
+
+
+class RotationRing:
+    """Fixed-size ring of one device's latest samples, in arrival order"""
+    def __init__(self, size):
+        self.size = size
+        self.t = array('d', bytes(8 * size))  # Server time (Unix seconds)
+        self.ts = array('d', bytes(8 * size))  # ESP32 timestamp (ms), NaN if unknown
+        self.values = {key: array('f', bytes(4 * size)) for key in HISTORY_KEYS}
+        self.start = 0  # Index of the oldest sample
+        self.count = 0
+
+    def append(self, t, ts, values):
+        index = (self.start + self.count) % self.size
+        if self.count == self.size:
+            self.start = (self.start + 1) % self.size
+        else:
+            self.count += 1
+        self.t[index] = t
+        self.ts[index] = ts
+        for key, column in self.values.items():
+            column[index] = values.get(key, math.nan)
+
+    def extend(self, times, timestamps, columns):
+        """Append many samples given as columns (lists); missing value columns become NaN"""
+        count = len(times)
+        if count > self.size:
+            # Only the newest samples fit
+            skip = count - self.size
+            times, timestamps = times[skip:], timestamps[skip:]
+            columns = {key: values[skip:] for key, values in columns.items()}
+            count = self.size
+
+        first = (self.start + self.count) % self.size
+        # Destination slices, split where the ring wraps around
+        parts = [(first, min(self.size, first + count), 0)]
+        if first + count > self.size:
+            parts.append((0, first + count - self.size, self.size - first))
+        for begin, end, offset in parts:
+            source = slice(offset, offset + end - begin)
+            self.t[begin:end] = array('d', times[source])
+            self.ts[begin:end] = array('d', timestamps[source])
+            for key, column in self.values.items():
+                values = columns.get(key)
+                column[begin:end] = array('f', repeat(math.nan, end - begin) if values is None else values[source])
+
+        overflow = max(0, self.count + count - self.size)
+        self.start = (self.start + overflow) % self.size
+        self.count = min(self.size, self.count + count)
+
+    def oldest(self):
+        """Time of the oldest sample, None if empty"""
+        return self.t[self.start] if self.count else None
+
+    def latest(self):
+        """Time of the newest sample, None if empty"""
+        return self.t[(self.start + self.count - 1) % self.size] if self.count else None
+
+    def rows(self, start, end):
+        """(t, ts, *values) of the samples with start <= t <= end, oldest first"""
+        for offset in range(self.count):
+            index = (self.start + offset) % self.size
+            t = self.t[index]
+            if start <= t <= end:
+                yield (t, self.ts[index]) + tuple(self.values[key][index] for key in HISTORY_KEYS)
+
+
+class RotationHistory:
+    """Rotation history of all devices: in-memory rings plus an optional SQLite store"""
+    def __init__(self, path=None, ring_size=6000, flush_size=500, retention=7 * 86400):
+        """
+        Args:
+            path: SQLite database file, None to keep only the in-memory rings
+            ring_size: Samples kept in memory per device
+            flush_size: Pending samples that trigger a write before FLUSH_INTERVAL
+            retention: Seconds of history kept in SQLite
+        """
+        self.ring_size = ring_size
+        # Samples must reach SQLite before their ring slot is reused
+        self.flush_size = min(flush_size, ring_size)
+        self.retention = retention
+        self.rings = {}
+        self.pending = []  # Row iterables waiting for SQLite
+        self.pending_count = 0
+        self.lock = threading.Lock()
+        self.last_flush = time.monotonic()
+        self.last_prune = 0.0
+
+        self.db = None
+        if path:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.execute('CREATE TABLE IF NOT EXISTS samples (device_id TEXT NOT NULL, t REAL NOT NULL, '
+                            'ts REAL, ' + ', '.join(f'{key} REAL' for key in HISTORY_KEYS) + ')')
+            self.db.execute('CREATE INDEX IF NOT EXISTS samples_device_t ON samples (device_id, t)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS samples_t ON samples (t)')
+            self.db.commit()
+
+    def append(self, device_id, t, values, ts=None):
+        """Record one sample (Euler or quaternion values) received at server time t"""
+        with self.lock:
+            ring = self.rings.get(device_id)
+            if ring is None:
+                ring = self.rings[device_id] = RotationRing(self.ring_size)
+            # Keep each device's history ordered even if batch-derived times overlap
+            latest = ring.latest()
+            if latest is not None and t < latest + TIME_STEP:
+                t = latest + TIME_STEP
+            ring.append(t, math.nan if ts is None else ts, values)
+
+            if self.db is not None:
+                self.pending.append(((device_id, t, ts) + tuple(values.get(key) for key in HISTORY_KEYS),))
+                self.pending_count += 1
+                if self.pending_count >= self.flush_size:
+                    self._flush()
+
+    def extend(self, device_id, times, timestamps, columns):
+        """
+        Record many samples of a device at once, as columns
+
+        Args:
+            times: Server times (Unix seconds) of the samples, a list
+            timestamps: ESP32 timestamps (ms), a list like times
+            columns: {key: list of values} for the HISTORY_KEYS present
+        """
+        if not times:
+            return
+        with self.lock:
+            ring = self.rings.get(device_id)
+            if ring is None:
+                ring = self.rings[device_id] = RotationRing(self.ring_size)
+            # Keep each device's history ordered even if batch-derived times overlap
+            latest = ring.latest()
+            times = list(accumulate(times, lambda previous, t: t if t >= previous + TIME_STEP else previous + TIME_STEP,
+                                    initial=-math.inf if latest is None else latest))[1:]
+
+            if self.db is not None:
+                # Rows are only built when they are written; written before
+                # the ring overwrites any of them
+                self.pending.append(zip(repeat(device_id), times, timestamps,
+                                        *(columns.get(key, repeat(None)) for key in HISTORY_KEYS)))
+                self.pending_count += len(times)
+                if self.pending_count >= self.flush_size:
+                    self._flush()
+            ring.extend(times, timestamps, columns)
+
+    def flush_if_due(self):
+        """Write pending samples every FLUSH_INTERVAL and prune old ones every PRUNE_INTERVAL"""
+        now = time.monotonic()
+        if self.db is None or now - self.last_flush < FLUSH_INTERVAL:
+            return
+        with self.lock:
+            self._flush()
+            if now - self.last_prune >= PRUNE_INTERVAL:
+                self.last_prune = now
+                self.db.execute('DELETE FROM samples WHERE t < ?', (time.time() - self.retention,))
+                self.db.commit()
+
+    def _flush(self):
+        self.last_flush = time.monotonic()
+        if not self.pending:
+            return
+        self.db.executemany(f'INSERT INTO samples VALUES ({", ".join("?" * (len(HISTORY_KEYS) + 3))})',
+                            chain.from_iterable(self.pending))
+        self.db.commit()
+        self.pending = []
+        self.pending_count = 0
+
+    def close(self):
+        if self.db is not None:
+            with self.lock:
+                self._flush()
+                self.db.close()
+                self.db = None
+
+    def _sources(self, device_id, start, end):
+        """
+        Split a range between SQLite and the ring
+
+        Returns:
+            (ring or None, end of the SQLite part or None if SQLite isn't needed)
+        """
+        ring = self.rings.get(device_id)
+        oldest = ring.oldest() if ring is not None else None
+        if oldest is not None and start >= oldest:
+            return ring, None
+        if self.db is None:
+            return ring, None
+        # Everything older than the ring's oldest sample has been written to SQLite
+        return ring, (oldest if oldest is not None else math.inf)
+
+    def query(self, device_id, start, end, limit):
+        """
+        Raw samples with start <= t <= end, oldest first
+
+        Returns:
+            (rows of (t, ts, *HISTORY_KEYS values), True if more than limit samples matched)
+        """
+        with self.lock:
+            ring, db_end = self._sources(device_id, start, end)
+            rows = []
+            if db_end is not None:
+                rows = self.db.execute(
+                    'SELECT t, ts, ' + ', '.join(HISTORY_KEYS) + ' FROM samples '
+                    'WHERE device_id = ? AND t >= ? AND t <= ? AND t < ? ORDER BY t LIMIT ?',
+                    (device_id, start, end, db_end, limit + 1)).fetchall()
+            if ring is not None and len(rows) <= limit:
+                for row in ring.rows(start, end):
+                    rows.append(row)
+                    if len(rows) > limit:
+                        break
+        return rows[:limit], len(rows) > limit
+
+    def iter_rows(self, device_id, start, end, chunk_size=1000):
+        """
+        All samples with start <= t <= end, oldest first, in chunks
+
+        Memory stays bounded by chunk_size and the ring size however long the
+        range is. The lock is held per chunk only, so recording goes on while
+        a long export is read.
+
+        Yields:
+            Lists of (t, ts, *HISTORY_KEYS values) rows
+        """
+        after = (-math.inf, 0)  # (t, rowid) of the last SQLite row yielded
+        while True:
+            with self.lock:
+                ring, db_end = self._sources(device_id, start, end)
+                rows = []
+                if db_end is not None:
+                    rows = self.db.execute(
+                        'SELECT t, ts, ' + ', '.join(HISTORY_KEYS) + ', rowid FROM samples '
+                        'WHERE device_id = ? AND t >= ? AND t <= ? AND t < ? AND (t > ? OR (t = ? AND rowid > ?)) '
+                        'ORDER BY t, rowid LIMIT ?',
+                        (device_id, start, end, db_end, after[0], after[0], after[1], chunk_size)).fetchall()
+                if len(rows) == chunk_size:
+                    after = (rows[-1][0], rows[-1][-1])
+                else:
+                    # Rest of the range is in the ring, which can't move while the lock is held
+                    tail = list(ring.rows(start, end)) if ring is not None else []
+            if len(rows) == chunk_size:
+                yield [row[:-1] for row in rows]
+                continue
+            if rows:
+                yield [row[:-1] for row in rows]
+            for index in range(0, len(tail), chunk_size):
+                yield tail[index:index + chunk_size]
+            return
+
+    def aggregate(self, device_id, start, end, bucket):
+        """
+        Downsampled history: count and min/max/mean of every value per bucket
+
+        Returns:
+            {bucket index: [count, {key: [count, sum, min, max]}]}, buckets
+            starting at start + index * bucket
+        """
+        buckets = {}
+        with self.lock:
+            ring, db_end = self._sources(device_id, start, end)
+            if db_end is not None:
+                columns = ', '.join(f'COUNT({key}), SUM({key}), MIN({key}), MAX({key})' for key in HISTORY_KEYS)
+                for row in self.db.execute(
+                        f'SELECT CAST((t - ?) / ? AS INTEGER) AS b, COUNT(*), {columns} FROM samples '
+                        'WHERE device_id = ? AND t >= ? AND t <= ? AND t < ? GROUP BY b',
+                        (start, bucket, device_id, start, end, db_end)):
+                    stats = {}
+                    for index, key in enumerate(HISTORY_KEYS):
+                        count, total, low, high = row[2 + 4 * index:6 + 4 * index]
+                        if count:
+                            stats[key] = [count, total, low, high]
+                    buckets[row[0]] = [row[1], stats]
+
+            if ring is not None:
+                for row in ring.rows(start, end):
+                    entry = buckets.setdefault(int((row[0] - start) // bucket), [0, {}])
+                    entry[0] += 1
+                    for key, value in zip(HISTORY_KEYS, row[2:]):
+                        if math.isnan(value):
+                            continue
+                        stats = entry[1].get(key)
+                        if stats is None:
+                            entry[1][key] = [1, value, value, value]
+                        else:
+                            stats[0] += 1
+                            stats[1] += value
+                            stats[2] = min(stats[2], value)
+                            stats[3] = max(stats[3], value)
+        return buckets
+
+
+def sample_columns(rows):
+    """Raw rows as JSON-ready columns; value columns without any data are left out"""
+    names = ('t', 'ts') + HISTORY_KEYS
+    columns = {name: [] for name in names}
+    for row in rows:
+        for name, value in zip(names, row):
+            columns[name].append(None if value is None or math.isnan(value) else value)
+    return {name: values for name, values in columns.items()
+            if name in ('t', 'ts') or any(value is not None for value in values)}
+
+
+def bucket_columns(buckets, start, bucket):
+    """Aggregated buckets as JSON-ready columns (bucket start times, counts, min/max/mean per value)"""
+    indexes = sorted(buckets)
+    columns = {
+        't': [start + index * bucket for index in indexes],
+        'count': [buckets[index][0] for index in indexes]
+    }
+    for key in HISTORY_KEYS:
+        stats = [buckets[index][1].get(key) for index in indexes]
+        if any(stats):
+            columns[key] = {
+                'min': [entry[2] if entry else None for entry in stats],
+                'max': [entry[3] if entry else None for entry in stats],
+                'mean': [entry[1] / entry[0] if entry else None for entry in stats]
+            }
+    return columns
@@ -0,0 +1,37 @@
+"""Logging for the server.
+
+Log records go through a queue to a background thread that formats and
+writes them, so Socket.IO handlers and the broadcast loop never wait for
+console or file I/O.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+
+LOG_FORMAT = '%(asctime)s %(levelname)-7s %(name)s: %(message)s'
+
+
+def setup_logging(level='INFO', log_file=None):
+    """
+    Send all log records through a queue to a console (and optional file) writer thread
+
+    Args:
+        level: Root log level name or number
+        log_file: Optional file to append records to as well
+    """
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [logging.StreamHandler()]
+    if log_file:
+        handlers.append(logging.FileHandler(log_file))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    records = queue.SimpleQueue()
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)  # Flushes records still queued at exit
+
+    root = logging.getLogger()
+    root.handlers[:] = [logging.handlers.QueueHandler(records)]
+    root.setLevel(level)
@@ -0,0 +1,134 @@
+"""Latency histograms and counters for the server's /metrics endpoint.
+
+Rotation samples carry wall-clock timestamps from each hop (BLE client
+receive and send, server receive and relay, viewer render), and the
+differences are collected per pipeline stage. Output uses the Prometheus
+text exposition format. Metrics are kept per worker process.
+"""
+import bisect
+import threading
+
+# Histogram bucket upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Pipeline stages, in order:
+#   client_queue - BLE notification received -> emitted by the BLE client (send queue, batching)
+#   network      - BLE client emit -> server receive
+#   fusion       - server receive -> raw frames fused (server-side fusion only)
+#   relay        - server receive -> broadcast to viewers (coalescing tick)
+#   delivery     - server broadcast -> viewer receive (reported by viewers)
+#   render       - viewer receive -> next frame drawn (reported by viewers)
+#   total        - BLE notification received -> viewer frame drawn (reported by viewers)
+LATENCY_STAGES = ('client_queue', 'network', 'fusion', 'relay', 'delivery', 'render', 'total')
+
+
+class Histogram:
+    """Cumulative-bucket histogram of observed values"""
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        # Small negative values come from clock skew between hosts
+        value = max(0.0, value)
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """Latency histograms per stage and sample counters per device"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = {stage: Histogram() for stage in LATENCY_STAGES}
+        self.samples = {}  # device_id -> rotation samples received
+        self.broadcasts = {}  # device_id -> rotation updates broadcast to viewers
+        self.dropped = {}  # device_id -> rotation updates not sent to lagging viewers
+        self.evicted = 0  # Viewers disconnected for staying behind
+
+    def observe_latency(self, stage, start, end):
+        """Record end - start (seconds) for a stage if both timestamps are known"""
+        if start is None or end is None or stage not in self.latency:
+            return
+        with self.lock:
+            self.latency[stage].observe(end - start)
+
+    def observe_durations(self, stage, durations):
+        """Record already measured durations (seconds) for a stage"""
+        if stage not in self.latency:
+            return
+        with self.lock:
+            for duration in durations:
+                self.latency[stage].observe(duration)
+
+    def count_samples(self, device_id, count=1):
+        with self.lock:
+            self.samples[device_id] = self.samples.get(device_id, 0) + count
+
+    def count_broadcast(self, device_id):
+        with self.lock:
+            self.broadcasts[device_id] = self.broadcasts.get(device_id, 0) + 1
+
+    def count_dropped(self, device_id, count=1):
+        with self.lock:
+            self.dropped[device_id] = self.dropped.get(device_id, 0) + count
+
+    def count_evicted(self):
+        with self.lock:
+            self.evicted += 1
+
+    def totals(self):
+        """(rotation samples received, updates broadcast) over all devices"""
+        with self.lock:
+            return sum(self.samples.values()), sum(self.broadcasts.values())
+
+    def render(self, gauges=()):
+        """
+        Prometheus text exposition of all metrics
+
+        Args:
+            gauges: (name, help, {labels: value}) tuples sampled by the caller,
+                    labels being a tuple of (label, value) pairs
+        """
+        lines = []
+        with self.lock:
+            lines += ['# HELP lego_latency_seconds Rotation pipeline latency per stage',
+                      '# TYPE lego_latency_seconds histogram']
+            for stage, histogram in self.latency.items():
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + ('+Inf',), histogram.counts):
+                    cumulative += count
+                    lines.append(f'lego_latency_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+                lines.append(f'lego_latency_seconds_sum{{stage="{stage}"}} {histogram.sum:.6f}')
+                lines.append(f'lego_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+            lines += _series('lego_rotation_samples_total', 'counter',
+                             'Rotation samples received per device',
+                             {(('device_id', device_id),): count for device_id, count in self.samples.items()})
+            lines += _series('lego_rotation_broadcasts_total', 'counter',
+                             'Coalesced rotation updates broadcast per device',
+                             {(('device_id', device_id),): count for device_id, count in self.broadcasts.items()})
+            lines += _series('lego_rotation_updates_dropped_total', 'counter',
+                             'Rotation updates skipped for lagging viewers per device',
+                             {(('device_id', device_id),): count for device_id, count in self.dropped.items()})
+            lines += _series('lego_slow_consumers_evicted_total', 'counter',
+                             'Viewers disconnected for staying behind', {(): self.evicted})
+
+        for name, help_text, values in gauges:
+            lines += _series(name, 'gauge', help_text, values)
+        return '\n'.join(lines) + '\n'
+
+
+def _series(name, kind, help_text, values):
+    """Exposition lines of one metric family"""
+    lines = [f'# HELP {name} {help_text}', f'# TYPE {name} {kind}']
+    for labels, value in values.items():
+        label_text = ','.join(f'{label}="{_escape(str(label_value))}"' for label, label_value in labels)
+        lines.append(f'{name}{{{label_text}}} {value}' if label_text else f'{name} {value}')
+    return lines
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
@@ -0,0 +1,200 @@
+"""Device state storage for the Flask server.
+
+The in-process store is the default and keeps everything in this worker's
+memory. The Redis store keeps device state in a Redis-compatible server so
+several worker processes (behind a load balancer) share the same devices.
+
+Both stores number the rotation updates broadcast for each device and keep
+the latest ones in a bounded update log, from which reconnecting viewers
+catch up on what they missed.
+"""
+import collections
+import json
+
+
+def default_rotation(device_id):
+    """Rotation of a device that hasn't reported yet"""
+    return {'device_id': device_id, 'x': 0.0, 'y': 0.0, 'z': 0.0}
+
+
+def default_ble_status(device_id):
+    """BLE status of a device that hasn't reported yet"""
+    return {'device_id': device_id, 'connected': False, 'device_name': None}
+
+
+class MemoryStateStore:
+    """Device state held in this process (single worker)"""
+
+    def __init__(self, update_log_size=300):
+        # device_id -> {'rotation': {...}, 'ble_status': {...}}
+        self.devices = {}
+        self.update_log_size = update_log_size
+        # device_id -> (sequence number of the latest update, deque of the latest updates)
+        self.update_logs = {}
+        # device_id -> server-side fusion config, for devices that have one set
+        self.fusion_configs = {}
+
+    def _entry(self, device_id):
+        device = self.devices.get(device_id)
+        if device is None:
+            device = {
+                'rotation': default_rotation(device_id),
+                'ble_status': default_ble_status(device_id)
+            }
+            self.devices[device_id] = device
+        return device
+
+    def has_device(self, device_id):
+        """Whether the device has ever reported"""
+        return device_id in self.devices
+
+    def get_rotation(self, device_id):
+        """Latest rotation of a device"""
+        device = self.devices.get(device_id)
+        return device['rotation'] if device else default_rotation(device_id)
+
+    def get_ble_status(self, device_id):
+        """Latest BLE status of a device"""
+        device = self.devices.get(device_id)
+        return device['ble_status'] if device else default_ble_status(device_id)
+
+    def set_rotation(self, device_id, values):
+        """Store a new rotation (Euler x/y/z or quaternion qw/qx/qy/qz values) and return it"""
+        rotation = {'device_id': device_id, **values}
+        self._entry(device_id)['rotation'] = rotation
+        return rotation
+
+    def set_ble_status(self, device_id, connected, device_name, link=None):
+        """Store a new BLE status, with the BLE client's link statistics if given, and return it"""
+        status = self._entry(device_id)['ble_status']
+        status['connected'] = connected
+        status['device_name'] = device_name
+        if link is not None:
+            status['link'] = link
+        else:
+            status.pop('link', None)
+        return status
+
+    def append_update(self, device_id, update):
+        """Add a broadcast update to the device's update log and return its sequence number"""
+        seq, updates = self.update_logs.get(device_id) or (0, collections.deque(maxlen=self.update_log_size))
+        seq += 1
+        updates.append(update)
+        self.update_logs[device_id] = (seq, updates)
+        return seq
+
+    def updates_since(self, device_id, seq):
+        """
+        Updates of a device after sequence number seq, oldest first
+
+        Returns:
+            (sequence number of the latest update, list of updates), or None when
+            seq is not covered by the update log
+        """
+        latest, updates = self.update_logs.get(device_id) or (0, ())
+        updates = list(updates)  # Snapshot; the broadcast loop may be appending
+        return select_updates(latest, updates, seq)
+
+    def get_fusion_config(self, device_id):
+        """Server-side fusion config of a device, None if not set"""
+        return self.fusion_configs.get(device_id)
+
+    def set_fusion_config(self, device_id, config):
+        """Store a device's server-side fusion config"""
+        self.fusion_configs[device_id] = config
+
+    def all_devices(self):
+        """All known devices with their rotation and BLE status"""
+        return self.devices
+
+
+class RedisStateStore:
+    """Device state shared by all workers through a Redis-compatible server"""
+
+    def __init__(self, url, prefix='lego', update_log_size=300):
+        import redis  # Only needed when a Redis URL is configured
+
+        self.redis = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.update_log_size = update_log_size
+        self.rotation_key = f'{prefix}:rotation'
+        self.ble_status_key = f'{prefix}:ble_status'
+        self.fusion_config_key = f'{prefix}:fusion_config'
+
+    def has_device(self, device_id):
+        return bool(self.redis.hexists(self.rotation_key, device_id) or
+                    self.redis.hexists(self.ble_status_key, device_id))
+
+    def get_rotation(self, device_id):
+        value = self.redis.hget(self.rotation_key, device_id)
+        return json.loads(value) if value else default_rotation(device_id)
+
+    def get_ble_status(self, device_id):
+        value = self.redis.hget(self.ble_status_key, device_id)
+        return json.loads(value) if value else default_ble_status(device_id)
+
+    def set_rotation(self, device_id, values):
+        rotation = {'device_id': device_id, **values}
+        self.redis.hset(self.rotation_key, device_id, json.dumps(rotation))
+        return rotation
+
+    def set_ble_status(self, device_id, connected, device_name, link=None):
+        status = {'device_id': device_id, 'connected': connected, 'device_name': device_name}
+        if link is not None:
+            status['link'] = link
+        self.redis.hset(self.ble_status_key, device_id, json.dumps(status))
+        return status
+
+    def append_update(self, device_id, update):
+        # One transaction, so list positions and the counter stay consistent
+        pipe = self.redis.pipeline()
+        pipe.incr(f'{self.prefix}:seq:{device_id}')
+        pipe.rpush(f'{self.prefix}:updates:{device_id}', json.dumps(update))
+        pipe.ltrim(f'{self.prefix}:updates:{device_id}', -self.update_log_size, -1)
+        return pipe.execute()[0]
+
+    def updates_since(self, device_id, seq):
+        pipe = self.redis.pipeline()
+        pipe.get(f'{self.prefix}:seq:{device_id}')
+        pipe.lrange(f'{self.prefix}:updates:{device_id}', 0, -1)
+        latest, updates = pipe.execute()
+        return select_updates(int(latest or 0), [json.loads(update) for update in updates], seq)
+
+    def get_fusion_config(self, device_id):
+        value = self.redis.hget(self.fusion_config_key, device_id)
+        return json.loads(value) if value else None
+
+    def set_fusion_config(self, device_id, config):
+        self.redis.hset(self.fusion_config_key, device_id, json.dumps(config))
+
+    def all_devices(self):
+        pipe = self.redis.pipeline()
+        pipe.hgetall(self.rotation_key)
+        pipe.hgetall(self.ble_status_key)
+        rotations, statuses = pipe.execute()
+
+        devices = {}
+        for device_id in set(rotations) | set(statuses):
+            name = device_id.decode()
+            devices[name] = {
+                'rotation': json.loads(rotations[device_id]) if device_id in rotations
+                else default_rotation(name),
+                'ble_status': json.loads(statuses[device_id]) if device_id in statuses
+                else default_ble_status(name)
+            }
+        return devices
+
+
+def select_updates(latest, updates, seq):
+    """(latest, updates after seq) from an update log ending at sequence number latest, None if not covered"""
+    oldest = latest - len(updates) + 1
+    if seq > latest or seq < oldest - 1:
+        return None
+    return latest, updates[len(updates) - (latest - seq):]
+
+
+def create_state_store(url=None, update_log_size=300):
+    """Redis store when a redis:// URL is given, in-process store otherwise"""
+    if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+        return RedisStateStore(url, update_log_size=update_log_size)
+    return MemoryStateStore(update_log_size)
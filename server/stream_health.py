@@ -0,0 +1,153 @@
+"""BLE stream health of one brick.
+
+Checks every notification's ESP32 timestamp against the previous one and
+the configured sample interval:
+
+- Duplicates (same timestamp) and late packets (older timestamp) are
+  counted and dropped before fusion
+- Gaps longer than 1.5 intervals count the missing samples as lost
+- A timestamp far behind the previous one means the ESP32 restarted; the
+  stream starts over
+- The time step handed to the filter is clamped to MAX_GAP_INTERVALS
+  intervals. Shorter gaps are integrated over their real length, which
+  holds the gyro rate across the missing samples; a long dropout doesn't
+  integrate one stale reading for seconds
+
+Jitter of the device timestamps and of the notification arrival times, and
+the time from notification to emit, are kept for the last WINDOW samples
+and reported as percentiles in the 'link' field of 'ble_status'.
+"""
+import collections
+import math
+
+TIMESTAMP_WRAP = 1 << 32  # ESP32 timestamps are uint32 milliseconds
+
+
+def percentiles(values, points=(50, 95, 99), digits=1):
+    """{'p50': ..., ...} of a sequence of numbers (nearest rank)"""
+    ordered = sorted(values)
+    if not ordered:
+        return {f'p{point}': None for point in points}
+    return {f'p{point}': round(float(ordered[min(len(ordered) - 1, math.ceil(point / 100 * len(ordered)) - 1)]), digits)
+            for point in points}
+
+
+class StreamHealth:
+    """Packet loss, ordering, jitter and processing time of one brick's notifications"""
+    WINDOW = 500  # Samples the loss rate and percentiles are computed over
+    MAX_GAP_INTERVALS = 5  # Longest time step (in sample intervals) passed to the filter
+    RESET_INTERVALS = 50  # Timestamp jump back (in intervals) taken as an ESP32 restart
+    SETTLE_SAMPLES = 3  # Samples after an interval change not judged for loss and jitter
+
+    def __init__(self, interval=100):
+        """
+        Args:
+            interval: Sample interval (ms) the brick is configured with
+        """
+        self.received = 0
+        self.lost = 0
+        self.duplicates = 0
+        self.out_of_order = 0
+        self.clamped = 0
+        self.resets = 0
+
+        # Per accepted sample: (samples lost before it, |dt - interval| ms,
+        # |arrival interval - dt| ms); processing time (ms) per emitted sample
+        self.window = collections.deque(maxlen=self.WINDOW)
+        self.processing = collections.deque(maxlen=self.WINDOW)
+
+        self.interval = interval
+        self.previous_interval = interval
+        self.settle = 0
+        self.restart()
+
+    def restart(self):
+        """Start a new stream, e.g. after reconnecting; the next sample has no predecessor"""
+        self.last_timestamp = None
+        self.last_arrival = None
+
+    def set_interval(self, interval):
+        """Record the sample interval (ms) written to the brick"""
+        if interval != self.interval:
+            self.previous_interval = self.interval
+            self.interval = interval
+            self.settle = self.SETTLE_SAMPLES
+
+    def timestep(self, timestamp, arrival=None):
+        """
+        Check one notification
+
+        Args:
+            timestamp: ESP32 timestamp (ms)
+            arrival: Notification arrival time (monotonic seconds), None if unknown
+                (e.g. server-side fusion); the arrival jitter then isn't recorded
+        Returns:
+            (measured dt, dt for the filter) in seconds, or None to drop the sample
+        """
+        if self.last_timestamp is None:
+            return self._start(timestamp, arrival)
+
+        delta = (timestamp - self.last_timestamp) % TIMESTAMP_WRAP
+        if delta >= TIMESTAMP_WRAP // 2:
+            delta -= TIMESTAMP_WRAP  # Older than the previous sample
+        if delta == 0:
+            self.duplicates += 1
+            return None
+        if delta < 0:
+            if -delta < self.RESET_INTERVALS * self.interval:
+                self.out_of_order += 1
+                return None
+            self.resets += 1
+            return self._start(timestamp, arrival)
+
+        # While the brick switches rates, samples may come at either interval
+        interval = max(self.interval, self.previous_interval) if self.settle else self.interval
+        lost = 0
+        if not self.settle and delta > 1.5 * interval:
+            lost = round(delta / interval) - 1
+            self.lost += lost
+        self.received += 1
+
+        if self.settle:
+            self.settle -= 1
+        else:
+            arrival_jitter = None
+            if arrival is not None and self.last_arrival is not None:
+                arrival_jitter = abs((arrival - self.last_arrival) * 1000 - delta)
+            self.window.append((lost, abs(delta - interval), arrival_jitter))
+        self.last_timestamp = timestamp
+        self.last_arrival = arrival
+
+        limit = self.MAX_GAP_INTERVALS * interval
+        if delta > limit:
+            self.clamped += 1
+            return delta / 1000.0, limit / 1000.0
+        return delta / 1000.0, delta / 1000.0
+
+    def _start(self, timestamp, arrival):
+        self.received += 1
+        self.last_timestamp = timestamp
+        self.last_arrival = arrival
+        dt = self.interval / 1000.0  # No predecessor: assume one interval
+        return dt, dt
+
+    def processed(self, seconds):
+        """Record the time from notification to the sample being queued for sending"""
+        self.processing.append(seconds * 1000)
+
+    def report(self):
+        """Link statistics for the 'ble_status' event"""
+        window_lost = sum(lost for lost, _, _ in self.window)
+        window_total = len(self.window) + window_lost
+        return {
+            'received': self.received,
+            'lost': self.lost,
+            'duplicates': self.duplicates,
+            'out_of_order': self.out_of_order,
+            'clamped': self.clamped,
+            'resets': self.resets,
+            'loss_rate': round(window_lost / window_total, 4) if window_total else 0.0,
+            'dt_jitter_ms': percentiles(jitter for _, jitter, _ in self.window),
+            'arrival_jitter_ms': percentiles(jitter for _, _, jitter in self.window if jitter is not None),
+            'processing_ms': percentiles(self.processing, digits=3),
+        }
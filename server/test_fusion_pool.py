@@ -0,0 +1,138 @@
+"""Config validation and output of the server-side fusion. Run with pytest."""
+import math
+import os
+
+import numpy as np
+import pytest
+
+from fusion import ComplementaryFilter
+from fusion_pool import RAW_FRAME, fuse, normalize_config
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BLE_CLIENT = os.path.join(HERE, os.pardir, 'ble_client')
+
+
+def raw_frames(count, seed=1):
+    """Packed raw notifications: noisy motion, 10 ms apart"""
+    rng = np.random.default_rng(seed)
+    out = bytearray()
+    for index in range(count):
+        acc = rng.normal(0, 1, 3)
+        gyro = rng.normal(0, 100, 3)
+        out.extend(RAW_FRAME.pack(index * 10, *acc, *gyro))
+    return bytes(out)
+
+
+@pytest.mark.parametrize('config', [
+    {'alpha': -0.1},
+    {'alpha': 1.5},
+    {'alpha': float('nan')},
+    {'alpha': True},
+    {'alpha': '0.5'},
+    {'beta': 0.1},
+    {'filter': 'kalman'},
+    {'filter': 'madgwick', 'beta': -1},
+    {'gyro_deadband': float('inf')},
+])
+def test_rejects_invalid_config(config):
+    with pytest.raises(ValueError):
+        normalize_config(config)
+
+
+def test_fills_defaults():
+    assert normalize_config({'alpha': 0}) == {'filter': 'complementary', 'alpha': 0.0, 'gyro_deadband': 3.0}
+    assert normalize_config({'filter': 'madgwick'}) == {'filter': 'madgwick', 'beta': 0.1, 'gyro_deadband': 3.0}
+
+
+@pytest.mark.parametrize('config', [
+    {'alpha': 0},
+    {'alpha': 1e-300},
+    {'alpha': 1},
+    {},
+    {'filter': 'madgwick'},
+])
+def test_output_is_finite(config):
+    config = normalize_config(config)
+    frames = raw_frames(500)
+    fmt, output = fuse('test-finite', config, frames)
+    values = np.frombuffer(output, dtype=[('ts', '<u4'), ('values', '<f4', 3 if fmt == 'euler' else 4)])
+    assert len(values) == 500
+    assert np.isfinite(values['values']).all()
+
+
+def test_batches_continue_filter_state():
+    config = normalize_config({'alpha': 0.5})
+    frames = raw_frames(300)
+    _, whole = fuse('test-whole', config, frames)
+    split = RAW_FRAME.size * 120
+    _, first = fuse('test-split', config, frames[:split])
+    _, rest = fuse('test-split', config, frames[split:])
+    assert first + rest == whole
+
+
+def test_time_steps_follow_stream_health():
+    # Wraps past 2^32, repeats a frame, sends one late, then drops out for 10 s
+    timestamps = [2**32 - 20, 2**32 - 10, 0, 0, 10, 5, 20, 10020, 10030]
+    rng = np.random.default_rng(2)
+    frames = b''.join(RAW_FRAME.pack(timestamp, *rng.normal(0, 1, 3), *rng.normal(0, 100, 3))
+                      for timestamp in timestamps)
+    _, output = fuse('test-steps', normalize_config({}), frames, interval=10)
+    fused = np.frombuffer(output, dtype=[('ts', '<u4'), ('x', '<f4'), ('y', '<f4'), ('z', '<f4')])
+    assert fused['ts'].tolist() == [2**32 - 20, 2**32 - 10, 0, 10, 20, 10020, 10030]
+
+    # Same as the BLE client: one interval first, real steps, the dropout clamped to 5 intervals
+    comp_filter = ComplementaryFilter(alpha=0.98, gyro_deadband=3.0)
+    kept = [frame for index, frame in enumerate(RAW_FRAME.iter_unpack(frames)) if index not in (3, 5)]
+    expected = [comp_filter.update(*frame[1:], dt=dt)
+                for frame, dt in zip(kept, (0.01, 0.01, 0.01, 0.01, 0.01, 0.05, 0.01))]
+    np.testing.assert_allclose(fused['x'], [angles[0] for angles in expected], atol=1e-4)
+    np.testing.assert_allclose(fused['y'], [angles[2] for angles in expected], atol=1e-4)
+    np.testing.assert_allclose(fused['z'], [-angles[1] for angles in expected], atol=1e-4)
+
+
+def test_only_dropped_frames_give_no_output():
+    config = normalize_config({})
+    frame = RAW_FRAME.pack(1000, 0, 0, 1, 0, 0, 0)
+    fuse('test-dropped', config, frame)
+    assert fuse('test-dropped', config, frame) == ('euler', b'')
+
+
+@pytest.mark.parametrize('module', ['fusion.py', 'stream_health.py'])
+def test_copies_match_ble_client(module):
+    original = os.path.join(BLE_CLIENT, module)
+    if not os.path.exists(original):
+        pytest.skip('BLE client not present (e.g. in the Docker image)')
+    with open(os.path.join(HERE, module), 'rb') as copy, open(original, 'rb') as source:
+        assert copy.read() == source.read(), f'server/{module} differs from ble_client/{module}'
+
+
+def unity_euler(x, y, z):
+    """Unity's Quaternion.Euler(x, y, z) as (w, x, y, z): z first, then x, then y"""
+    def turn(angle, axis):
+        half = math.radians(angle) / 2
+        vector = [0.0, 0.0, 0.0]
+        vector[axis] = math.sin(half)
+        return np.array([math.cos(half), *vector])
+
+    def product(a, b):
+        w1, v1, w2, v2 = a[0], a[1:], b[0], b[1:]
+        return np.array([w1 * w2 - v1 @ v2, *(w1 * v2 + w2 * v1 + np.cross(v1, v2))])
+    return product(product(turn(y, 1), turn(x, 0)), turn(z, 2))
+
+
+@pytest.mark.parametrize('acc, gyro_z', [
+    ((0.0, 0.5, math.sqrt(0.75)), 0.0),  # Still, tilted 30° about the sensor's x axis
+    ((0.5, 0.0, math.sqrt(0.75)), 0.0),  # Still, tilted -30° about y
+    ((0.0, 0.0, 1.0), 45.0),  # Flat, turning at 45°/s
+])
+def test_filters_show_the_same_rotation(acc, gyro_z):
+    count = 600 if gyro_z == 0 else 21
+    frames = b''.join(RAW_FRAME.pack(index * 100, *acc, 0, 0, gyro_z) for index in range(count))
+    _, euler = fuse(f'test-euler-{acc}-{gyro_z}', normalize_config({}), frames)
+    _, quaternion = fuse(f'test-quaternion-{acc}-{gyro_z}', normalize_config({'filter': 'madgwick'}), frames)
+    x, y, z = np.frombuffer(euler, dtype='<f4').reshape(-1, 4)[-1, 1:].tolist()
+    expected = unity_euler(x, y, z)
+    actual = np.frombuffer(quaternion, dtype='<f4').reshape(-1, 5)[-1, 1:].astype(np.float64)
+    assert max(abs(x), abs(y), abs(z)) > 25  # Not left at rest
+    dot = min(1.0, abs(float(expected @ actual)))
+    assert math.degrees(2 * math.acos(dot)) < 0.5
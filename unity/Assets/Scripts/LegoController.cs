@@ -12,7 +12,7 @@ public class LegoController : MonoBehaviour
     public bool smoothRotation = true;
     public float rotationSpeed = 5f;
 
-    private Vector3 targetRotation = Vector3.zero;
+    private Quaternion targetRotation = Quaternion.identity;
 
     void Start()
     {
@@ -32,7 +32,7 @@ public class LegoController : MonoBehaviour
             // Smoothly interpolate to target rotation
             legoPiece.transform.rotation = Quaternion.Lerp(
                 legoPiece.transform.rotation,
-                Quaternion.Euler(targetRotation),
+                targetRotation,
                 Time.deltaTime * rotationSpeed
             );
         }
@@ -44,14 +44,14 @@ public class LegoController : MonoBehaviour
         try
         {
             RotationData data = JsonUtility.FromJson<RotationData>(jsonData);
-            targetRotation = new Vector3(data.x, data.y, data.z);
+            targetRotation = data.ToQuaternion();
 
             if (!smoothRotation && legoPiece != null)
             {
-                legoPiece.transform.rotation = Quaternion.Euler(targetRotation);
+                legoPiece.transform.rotation = targetRotation;
             }
 
-            Debug.Log($"Rotation set to: X={data.x}, Y={data.y}, Z={data.z}");
+            Debug.Log($"Rotation set to: {targetRotation.eulerAngles}");
         }
         catch (System.Exception e)
         {
@@ -74,7 +74,7 @@ public class LegoController : MonoBehaviour
                     try
                     {
                         RotationData data = JsonUtility.FromJson<RotationData>(request.downloadHandler.text);
-                        targetRotation = new Vector3(data.x, data.y, data.z);
+                        targetRotation = data.ToQuaternion();
                     }
                     catch (System.Exception e)
                     {
@@ -89,7 +89,23 @@ public class LegoController : MonoBehaviour
 [System.Serializable]
 public class RotationData
 {
+    // Euler angles in degrees (complementary filter)
     public float x;
     public float y;
     public float z;
+
+    // Quaternion (Madgwick filter); all zero when the payload carries Euler angles
+    public float qw;
+    public float qx;
+    public float qy;
+    public float qz;
+
+    public Quaternion ToQuaternion()
+    {
+        if (qw != 0f || qx != 0f || qy != 0f || qz != 0f)
+        {
+            return new Quaternion(qx, qy, qz, qw);
+        }
+        return Quaternion.Euler(x, y, z);
+    }
 }